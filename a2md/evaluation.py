@@ -0,0 +1,580 @@
+import numpy as np
+from a2md.baseclass import A2MDBaseClass
+from a2md.support import SupportRadial, SupportAngular, SupportHarmonic, SupportEnsemble
+from a2md.mathfunctions import pe_harmonic, generalized_exponential_radius
+from a2md.mathfunctions import short_generalized, long_generalized
+from a2md.mathfunctions import ep_xg_radial0, ep_xg_radial1, ep_xg_radial2, ep_xg_radial3
+from a2md.mathfunctions import ep_xg_angular_constants, INVERSE_DIST_DUMPING
+from scipy.special import gamma
+
+PLAN_BLOCK_SIZE = 2 ** 21  # maximum number of (point, function) pairs evaluated at once
+SCREENING_CELL_SIZE = 4.0  # edge of the cells used to bin points, in Bohr
+
+EP_XG_RADIAL_TERMS = [ep_xg_radial0, ep_xg_radial1, ep_xg_radial2, ep_xg_radial3]
+
+EP_TABLE_MIN_ARGUMENT = 0.5  # below this value of B * r, radial terms are evaluated exactly
+EP_TABLE_NODES = 128  # initial number of nodes of the radial tables
+EP_TABLE_MAX_NODES = 2 ** 16
+RADIAL_TABLES = dict()
+
+
+def flatten_functions(functions):
+    """
+    flatten functions
+    ---
+    yields the support functions of a model together with the index of the model
+    function they belong to. Ensembles (clustered models) are expanded, so all the
+    members of an ensemble share the same index.
+
+    :param functions: list of Support or SupportEnsemble
+    :return: (index, support function)
+    """
+    for i, fun in enumerate(functions):
+        if isinstance(fun, SupportEnsemble):
+            for member in fun.fun:
+                yield i, member
+        else:
+            yield i, fun
+
+
+def split_by_value(*keys):
+    """
+    split by value
+    ---
+    yields a boolean mask for each of the unique combinations of keys. Used to dispatch
+    those kernels that need scalar arguments (polynomial degree, harmonic order).
+
+    :param keys: arrays of the same size
+    :return: (key values, mask)
+    """
+    stacked = np.stack(keys, axis=1)
+    for values in np.unique(stacked, axis=0):
+        yield values, np.all(stacked == values, axis=1)
+
+
+def difference_vectors(x, centers):
+    """
+    components of the vectors joining function centers (f, 3) and points (n, 3)
+    :return: dx, dy, dz (n, f)
+    """
+    return [x[:, i].reshape(-1, 1) - centers[:, i].reshape(1, -1) for i in range(3)]
+
+
+def distances(x, centers):
+    """
+    distances between points (n, 3) and function centers (f, 3)
+    """
+    dx, dy, dz = difference_vectors(x, centers)
+    return np.sqrt(dx * dx + dy * dy + dz * dz)
+
+
+def polar_rep(x, centers, frames):
+    """
+    polar rep
+    ---
+    batched version of a2md.mathfunctions.get_polar_rep. Calculates the cosine of the angle
+    against the z axis of each reference frame and the distance to each of the centers.
+
+    :param x: cartesian coordinates (n, 3)
+    :param centers: function centers (f, 3)
+    :param frames: reference frames (f, 3, 3)
+    :return: cosines (n, f), distances (n, f)
+    """
+    dx, dy, dz = difference_vectors(x, centers)
+    d = np.sqrt(dx * dx + dy * dy + dz * dz)
+    u = dx * frames[:, 2, 0] + dy * frames[:, 2, 1] + dz * frames[:, 2, 2]
+    u /= d.clip(min=1e-12, max=None)
+    u[np.isnan(u)] = 0.0
+    return u.clip(min=-1.0, max=1.0), d
+
+
+def radial_part(A, B, P, d):
+    """
+    generalized exponential for a group of functions, avoiding the
+    power when the polynomial degree is shared by all the functions
+    """
+    u = np.exp(-B * d) * A
+    if np.all(P == P[0]):
+        if P[0] == 1:
+            return u * d
+        elif P[0] != 0:
+            return u * np.power(d, P[0])
+        return u
+    return u * np.power(d, P)
+
+
+def legendre(u, l):
+    """
+    legendre polynomials (m = 0) of the cosine u, as in a2md.mathfunctions.spherical_harmonic
+    """
+    if l == 0:
+        return np.ones(u.shape, dtype='float64')
+    elif l == 1:
+        return u
+    elif l == 2:
+        return 0.5 * (3 * (u * u) - 1)
+    elif l == 3:
+        return 0.5 * (5 * (u * u * u) - 3 * u)
+    else:
+        raise NotImplementedError("only implemented up to l = 3")
+
+
+def cell_partition(x, cell_size):
+    """
+    cell partition
+    ---
+    bins points in cubic cells of a given size
+
+    :param x: cartesian coordinates (n, 3)
+    :param cell_size: edge of the cells
+    :return: yields (point indices, cell center, cell half diagonal) for each occupied cell
+    """
+    if x.shape[0] == 0:
+        return
+    origin = x.min(axis=0)
+    keys = np.floor((x - origin) / cell_size).astype('int64')
+    flat = np.ravel_multi_index(keys.T, dims=keys.max(axis=0) + 1)
+    order = np.argsort(flat, kind='stable')
+    _, starts = np.unique(flat[order], return_index=True)
+    ends = np.append(starts[1:], order.size)
+    half_diagonal = 0.5 * np.sqrt(3.0) * cell_size
+    for i, j in zip(starts, ends):
+        idx = order[i:j]
+        center = origin + (keys[idx[0], :] + 0.5) * cell_size
+        yield idx, center, half_diagonal
+
+
+class RadialTable(A2MDBaseClass):
+
+    def __init__(self, funs, ls, ns, tolerance):
+        """
+        A2MD.evaluation.RadialTable
+        ---
+        Cubic spline tables of scaled radial terms of the electrostatic potential, f(y), where y = B r.
+        Radial terms of all the functions sharing l and P are the same f(y), scaled by a power of B.
+        Several terms can share the same grid, so points are located once for all of them.
+
+        Each spline interpolates f(y) (1 + y)^(l + 1) over a uniform grid of log(y), and the number of nodes
+        is doubled until the relative error at the midpoints between nodes is below the tolerance. Beyond
+        the grid the far field asymptote, Gamma(n) / y^(l + 1), is used. Below EP_TABLE_MIN_ARGUMENT,
+        f(y) is evaluated exactly.
+
+        :param funs: exact radial terms f(y)
+        :param ls: angular momentum of each term
+        :param ns: far field f(y) -> Gamma(n) / y^(l + 1) of each term
+        :param tolerance: relative error
+        """
+        from scipy.interpolate import CubicSpline
+        A2MDBaseClass.__init__(self, name='radial table', verbose=False)
+        self.funs = funs
+        self.ls = [int(l) for l in ls]
+        self.far_fields = [gamma(n) for n in ns]
+        self.tolerance = tolerance
+        self.y_min = EP_TABLE_MIN_ARGUMENT
+
+        self.y_max = 8.0
+        while self.y_max < 1024.0:
+            y = np.array([self.y_max], dtype='float64')
+            deviation = max(
+                np.abs(self.__far(y, i) / fun(y) - 1.0)[0] for i, fun in enumerate(funs)
+            )
+            if deviation < 0.1 * tolerance:
+                break
+            self.y_max *= 2.0
+
+        nodes = EP_TABLE_NODES
+        while True:
+            t = np.linspace(np.log(self.y_min), np.log(self.y_max), nodes)
+            t_mid = 0.5 * (t[1:] + t[:-1])
+            splines = []
+            error = 0.0
+            for i, fun in enumerate(funs):
+                spline = CubicSpline(t, fun(np.exp(t)) * self.__weight(np.exp(t), self.ls[i]))
+                reference = fun(np.exp(t_mid))
+                prediction = spline(t_mid) / self.__weight(np.exp(t_mid), self.ls[i])
+                error = max(error, (np.abs(prediction - reference) / np.abs(reference).clip(min=1e-300)).max())
+                splines.append(spline)
+            if error < tolerance or nodes >= EP_TABLE_MAX_NODES:
+                break
+            nodes *= 2
+        self.log("{:d} nodes, y max {:8.2f}, max relative error {:12.4e}".format(nodes, self.y_max, error))
+
+        self.t0 = t[0]
+        self.h = t[1] - t[0]
+        self.coefficients = [spline.c for spline in splines]
+        self.nnodes = nodes
+
+    @staticmethod
+    def __weight(y, l):
+        w = 1.0 + y
+        v = w
+        for _ in range(l):
+            v = v * w
+        return v
+
+    def __far(self, y, i):
+        v = y
+        for _ in range(self.ls[i]):
+            v = v * y
+        return self.far_fields[i] / v
+
+    def eval(self, y):
+        """
+        :param y: scaled distances, B r
+        :return: list with f(y) of each term
+        """
+        t = np.log(np.minimum(np.maximum(y, self.y_min), self.y_max))
+        k = ((t - self.t0) / self.h).astype('int64')
+        np.minimum(k, self.nnodes - 2, out=k)
+        s = t - (self.t0 + k * self.h)
+        far = y > self.y_max
+        near = y < self.y_min
+        any_far = np.any(far)
+        any_near = np.any(near)
+
+        w = 1.0 + y
+        weight = w
+        l_weight = 0
+        values = []
+        for i, c in enumerate(self.coefficients):
+            while l_weight < self.ls[i]:
+                weight = weight * w
+                l_weight += 1
+            v = c[0, k]
+            for j in range(1, 4):
+                v *= s
+                v += c[j, k]
+            v /= weight
+            if any_far:
+                v[far] = self.__far(y[far], i)
+            if any_near:
+                v[near] = self.funs[i](y[near])
+            values.append(v)
+        return values
+
+
+def get_radial_table(kind, l, P, tolerance):
+    """
+    returns the (cached) radial table of the electrostatic potential for
+        - kind = 'xg' : the terms l = 0, 1, 2, 3 of the angular gaussian (P = 1), scaled as B^-3 f(B r).
+        l and P are ignored
+        - kind = 'harmonic' : radial and harmonic functions, scaled as B^-(2 + P) f(B r)
+
+    :param kind: either xg or harmonic
+    :param l: angular momentum
+    :param P: polynomial degree
+    :param tolerance: relative error
+    :return:
+    :rtype: RadialTable
+    """
+    key = (kind, int(l), float(P), float(tolerance))
+    if key not in RADIAL_TABLES:
+        if kind == 'xg':
+            RADIAL_TABLES[key] = RadialTable(
+                [lambda y, rad=rad: rad(1.0, y) for rad in EP_XG_RADIAL_TERMS],
+                [0, 1, 2, 3], [4, 5, 6, 7], tolerance
+            )
+        elif kind == 'harmonic':
+            RADIAL_TABLES[key] = RadialTable(
+                [lambda y: short_generalized(y, 1.0, int(l), P) + long_generalized(y, 1.0, int(l), P)],
+                [int(l)], [3 + int(l) + P], tolerance
+            )
+        else:
+            raise NotImplementedError("only xg or harmonic radial tables")
+    return RADIAL_TABLES[key]
+
+
+class EvaluationPlan(A2MDBaseClass):
+
+    def __init__(
+            self, functions, block_size=PLAN_BLOCK_SIZE, tolerance=None, cell_size=SCREENING_CELL_SIZE,
+            ep_tolerance=None
+    ):
+        """
+        A2MD.evaluation.EvaluationPlan
+        ---
+        Compiles a list of support functions into packed arrays of centers, parameters and
+        reference frames, grouped by support type. Density and electrostatic potential are then
+        evaluated for all the functions of a group in a few array operations instead of a
+        python loop over support functions.
+
+        Coefficients are not part of the plan, they are provided at evaluation time, so a plan
+        remains valid as long as the functions (and their centers) do not change.
+
+        When a tolerance is given, each function gets a screening radius beyond which its radial
+        part is below the tolerance. Points are then binned in cubic cells, and only those functions
+        whose radius reaches a cell (found using a KD-tree over the function centers) are evaluated
+        there. Screening only applies to density: the electrostatic potential is long ranged.
+
+        The angular constants of the electrostatic potential of angular gaussians are computed once,
+        when the plan is built. When an ep tolerance is given, the radial terms of the electrostatic
+        potential are interpolated from spline tables (see RadialTable) with that relative error.
+
+        :param functions: list of support functions or ensembles (Molecule.functions)
+        :param block_size: maximum number of point-function pairs evaluated at once
+        :param tolerance: screening tolerance for density values. None to disable screening
+        :param cell_size: edge of the cells used to bin points when screening (Bohr)
+        :param ep_tolerance: relative error of the tabulated radial terms. None to evaluate them exactly
+        :type functions: list
+        :type block_size: int
+        :type tolerance: float
+        :type cell_size: float
+        :type ep_tolerance: float
+        """
+        A2MDBaseClass.__init__(self, name='evaluation plan', verbose=False)
+        self.nfunctions = len(functions)
+        self.block_size = block_size
+        self.tolerance = tolerance
+        self.cell_size = cell_size
+        self.ep_tolerance = ep_tolerance
+        radial = []
+        angular = []
+        harmonic = []
+        self.others = []
+
+        for owner, fun in flatten_functions(functions):
+            if isinstance(fun, SupportRadial):
+                radial.append((owner, fun))
+            elif isinstance(fun, SupportAngular):
+                angular.append((owner, fun))
+            elif isinstance(fun, SupportHarmonic):
+                harmonic.append((owner, fun))
+            else:
+                self.others.append((owner, fun))
+
+        self.radial = self.__pack(radial, defaults=dict(P=0))
+        self.angular = self.__pack(angular, defaults=dict(P=1))
+        self.harmonic = self.__pack(harmonic, defaults=dict())
+        self.nleaves = sum(g['owner'].size for _, g in self.get_groups()) + len(self.others)
+        if self.angular is not None:
+            self.angular['ep_constants'] = ep_xg_angular_constants(self.angular['alpha']).T
+
+        if tolerance is not None:
+            from scipy.spatial import cKDTree
+            for _, g in self.get_groups():
+                g['radius'] = generalized_exponential_radius(g['A'], g['B'], g['P'], tolerance)
+                g['tree'] = cKDTree(g['centers'])
+
+    @staticmethod
+    def __pack(functions, defaults):
+        if len(functions) == 0:
+            return None
+        group = dict(
+            owner=np.array([owner for owner, _ in functions], dtype='int64'),
+            centers=np.array([fun.coordinates for _, fun in functions], dtype='float64').reshape(-1, 3)
+        )
+        params = [fun.get_params() for _, fun in functions]
+        for key in set(k for p in params for k in p.keys()).union(defaults.keys()):
+            group[key] = np.array([p.get(key, defaults.get(key)) for p in params], dtype='float64')
+        if functions[0][1].is_anisotropic():
+            for _, fun in functions:
+                if fun.coordinate_system is None:
+                    raise RuntimeError("reference frame was not created. can not calculate angular function")
+            group['frames'] = np.array([fun.coordinate_system for _, fun in functions], dtype='float64')
+        return group
+
+    @staticmethod
+    def __select(g, active):
+        if active is None:
+            return g
+        return dict((key, item[active]) for key, item in g.items() if key != 'tree')
+
+    @staticmethod
+    def __neighbours(g, center, half_diagonal):
+        candidates = g['tree'].query_ball_point(center, g['radius'].max() + half_diagonal)
+        candidates = np.sort(np.array(candidates, dtype='int64'))
+        d = np.linalg.norm(g['centers'][candidates, :] - center, axis=1)
+        return candidates[d <= g['radius'][candidates] + half_diagonal]
+
+    def __blocks(self, x, screen):
+        """
+        yields blocks of points together with the functions of each group that must
+        be evaluated on them (None meaning all of them)
+        """
+        groups = self.get_groups()
+        if not screen or self.tolerance is None:
+            chunk = self.get_chunk_size()
+            for start in range(0, x.shape[0], chunk):
+                yield np.arange(start, min(start + chunk, x.shape[0])), [(name, None) for name, _ in groups]
+            return
+
+        for idx, center, half_diagonal in cell_partition(x, self.cell_size):
+            active = [(name, self.__neighbours(g, center, half_diagonal)) for name, g in groups]
+            active = [(name, sel) for name, sel in active if sel.size > 0]
+            nactive = sum(sel.size for _, sel in active)
+            if nactive == 0:
+                continue
+            chunk = max(1, self.block_size // nactive)
+            for start in range(0, idx.size, chunk):
+                yield idx[start:start + chunk], active
+
+    def get_groups(self):
+        """
+        :return: list of (support type, packed group) for the non-empty groups
+        """
+        groups = [('radial', self.radial), ('angular', self.angular), ('harmonic', self.harmonic)]
+        return [(name, g) for name, g in groups if g is not None]
+
+    def get_chunk_size(self):
+        return max(1, self.block_size // max(1, self.nleaves))
+
+    def get_group(self, name):
+        return getattr(self, name)
+
+    def get_kernel(self, name, kind):
+        kernels = dict(
+            density=dict(
+                radial=self.__radial_density, angular=self.__angular_density, harmonic=self.__harmonic_density
+            ),
+            ep=dict(
+                radial=self.__radial_ep, angular=self.__angular_ep, harmonic=self.__harmonic_ep
+            )
+        )
+        try:
+            return kernels[kind][name]
+        except KeyError:
+            raise NotImplementedError("only density or ep")
+
+    def eval(self, x, coefficients, kind='density'):
+        """
+        evaluates the sum of support functions, weighted by their coefficients
+
+        :param x: cartesian coordinates
+        :param coefficients: one coefficient per model function (Molecule.opt_params)
+        :param kind: either density or ep (electron contribution only, positive sign)
+        :type x: np.ndarray
+        :return: density values (e-/Bohr^3) or potential (Ha)
+        :rtype: np.ndarray
+        """
+        if kind not in ['density', 'ep']:
+            raise NotImplementedError("only density or ep")
+
+        coefficients = np.asarray(coefficients, dtype='float64')
+        y = np.zeros(x.shape[0], dtype='float64')
+        for idx, active in self.__blocks(x, screen=(kind == 'density')):
+            y[idx] += self.eval_selection(x[idx, :], coefficients, active, kind=kind)
+
+        for owner, fun in self.others:
+            if kind == 'density':
+                y += coefficients[owner] * fun.eval(x)
+            else:
+                y += coefficients[owner] * fun.eval_ep(x)
+        return y
+
+    def eval_selection(self, x, coefficients, active, kind='density'):
+        """
+        evaluates the sum of a selection of the packed functions at once, without blocking.
+        Functions of other support types (others) are not included
+
+        :param x: cartesian coordinates
+        :param coefficients: one coefficient per model function (Molecule.opt_params)
+        :param active: list of (support type, indices within the group), None to select the whole group
+        :param kind: either density or ep (electron contribution only, positive sign)
+        :return:
+        """
+        y = np.zeros(x.shape[0], dtype='float64')
+        for name, sel in active:
+            g = self.__select(self.get_group(name), sel)
+            if g['owner'].size == 0:
+                continue
+            y += self.get_kernel(name, kind)(x, g).dot(coefficients[g['owner']])
+        return y
+
+    def eval_basis(self, x):
+        """
+        evaluates the density of each of the model functions separately (ensembles are summed up),
+        without coefficients. This is the design matrix of the least squares problem.
+
+        :param x: cartesian coordinates
+        :type x: np.ndarray
+        :return: density values (functions, points)
+        :rtype: np.ndarray
+        """
+        d = np.zeros((self.nfunctions, x.shape[0]), dtype='float64')
+        for idx, active in self.__blocks(x, screen=True):
+            xb = x[idx, :]
+            for name, sel in active:
+                g = self.__select(self.get_group(name), sel)
+                v = self.get_kernel(name, 'density')(xb, g)
+                owners, starts = np.unique(g['owner'], return_index=True)
+                d[np.ix_(owners, idx)] += np.add.reduceat(v, starts, axis=1).T
+
+        for owner, fun in self.others:
+            d[owner, :] += fun.eval(x)
+        return d
+
+    # Kernels. Each of them returns a (points, functions) matrix of values
+
+    @staticmethod
+    def __radial_density(x, g):
+        d = distances(x, g['centers'])
+        return radial_part(g['A'], g['B'], g['P'], d)
+
+    @staticmethod
+    def __angular_density(x, g):
+        u, d = polar_rep(x, g['centers'], g['frames'])
+        z = np.arccos(u)
+        return radial_part(g['A'], g['B'], g['P'], d) * np.exp(-g['alpha'] * (z * z))
+
+    @staticmethod
+    def __harmonic_density(x, g):
+        u, d = polar_rep(x, g['centers'], g['frames'])
+        v = radial_part(g['A'], g['B'], g['P'], d)
+        for (l,), mask in split_by_value(g['l']):
+            if l != 0:
+                v[:, mask] *= legendre(u[:, mask], int(l))
+        return v
+
+    def __radial_ep(self, x, g):
+        d = distances(x, g['centers'])
+        v = np.zeros(d.shape, dtype='float64')
+        for (p,), mask in split_by_value(g['P']):
+            if self.ep_tolerance is None:
+                v[:, mask] = pe_harmonic(d[:, mask], 0.0, 0, p, g['B'][mask]) * g['A'][mask]
+            else:
+                table = get_radial_table('harmonic', 0, p, self.ep_tolerance)
+                b = g['B'][mask]
+                v[:, mask] = table.eval(d[:, mask] * b)[0] * (4 * np.pi * g['A'][mask] * np.power(b, -2.0 - p))
+        return v
+
+    def __angular_ep(self, x, g):
+        if np.any(g['P'] != 1):
+            raise NotImplementedError("still working in a generalized potential")
+        u, d = polar_rep(x, g['centers'], g['frames'])
+        d = d.clip(min=INVERSE_DIST_DUMPING, max=None)
+        v = np.zeros(d.shape, dtype='float64')
+        if self.ep_tolerance is not None:
+            y = d * g['B']
+            near = y < EP_TABLE_MIN_ARGUMENT
+            tabulated = get_radial_table('xg', 0, 1, self.ep_tolerance).eval(y)
+        for l, rad in enumerate(EP_XG_RADIAL_TERMS):
+            if self.ep_tolerance is None:
+                r = rad(g['B'], d)
+            else:
+                r = tabulated[l]
+                if np.any(near):
+                    # tables are scaled by B^3 and evaluated with the distance bound on y, not on d
+                    r[near] = rad(np.broadcast_to(g['B'], d.shape)[near], d[near]) * np.power(
+                        np.broadcast_to(g['B'], d.shape)[near], 3.0)
+            if l == 0:
+                v += r * g['ep_constants'][:, l]
+            else:
+                v += r * (g['ep_constants'][:, l] * legendre(u, l))
+        if self.ep_tolerance is not None:
+            v *= np.power(g['B'], -3.0)
+        return v * g['A']
+
+    def __harmonic_ep(self, x, g):
+        u, d = polar_rep(x, g['centers'], g['frames'])
+        v = np.zeros(d.shape, dtype='float64')
+        if self.ep_tolerance is None:
+            z = np.arccos(u)
+        for (l, p), mask in split_by_value(g['l'], g['P']):
+            if self.ep_tolerance is None:
+                v[:, mask] = pe_harmonic(d[:, mask], z[:, mask], int(l), p, g['B'][mask]) * g['A'][mask]
+            else:
+                table = get_radial_table('harmonic', int(l), p, self.ep_tolerance)
+                b = g['B'][mask]
+                factor = (4 * np.pi) / ((2 * int(l)) + 1) * g['A'][mask] * np.power(b, -2.0 - p)
+                v[:, mask] = table.eval(d[:, mask] * b)[0] * legendre(u[:, mask], int(l)) * factor
+        return v
@@ -1,8 +1,25 @@
 import numpy as np
+import hashlib
+import os
 from typing import Callable
 from a2mdio.molecules import Mol2
+from a2md.baseclass import A2MDBaseClass
 from a2md.models import Molecule
 
+GRID_BLOCK_SIZE = 2 ** 16
+LEBEDEV_DESIGNS = dict()
+LEBEDEV_DEGREES = dict(coarse=27, medium=53, tight=101)
+BECKE_TOLERANCE = 1e-6  # absolute error on the integral of the atomic probe densities
+BECKE_NEIGHBORS = 16  # nearest atoms competing for each point in the fuzzy partition
+BECKE_LEVELS = [(20, 11), (30, 17), (40, 27), (55, 27), (70, 53), (90, 53), (120, 101)]  # (radial, angular degree)
+BECKE_PRUNING = [(0.25, 0.5), (4.0, 1.0)]  # (r / covalent radius, fraction of the level degree)
+BECKE_TAIL = 0.6  # fraction of the level degree beyond the last pruning region
+TREUTLER_XI = {
+    1: 0.8, 2: 0.9, 3: 1.8, 4: 1.4, 5: 1.3, 6: 1.1, 7: 0.9, 8: 0.9, 9: 0.9, 10: 0.9,
+    11: 1.4, 12: 1.3, 13: 1.3, 14: 1.2, 15: 1.1, 16: 1.0, 17: 1.0, 18: 1.0, 19: 1.5, 20: 1.4,
+    35: 0.9, 53: 1.0
+}
+
 
 def voronoi(x: np.ndarray, r: np.ndarray):
     """
@@ -37,6 +54,49 @@ def split_space(mm: Mol2, fun: Callable):
         yield lambda x: fun(x + r0) * (voronoi(x + r0, r) == i)
 
 
+def lebedev_design(grid='medium'):
+    """
+    lebedev design
+    ---
+    unit vectors and weights of a lebedev design. Designs are read once and kept in memory
+    :param grid: either medium, coarse, tight
+    :return: (n, 3) unit vectors, (n,) weights
+    """
+    if grid not in LEBEDEV_DESIGNS:
+        from a2md import LEBEDEV_DESIGN
+        lebedevdesgin = np.loadtxt(LEBEDEV_DESIGN[grid])
+        lebedev = np.zeros((lebedevdesgin.shape[0], 3), dtype='float64')
+        lebedev[:, 0] = np.cos(np.deg2rad(lebedevdesgin[:, 0])) * np.sin(np.deg2rad(lebedevdesgin[:, 1]))
+        lebedev[:, 1] = np.sin(np.deg2rad(lebedevdesgin[:, 0])) * np.sin(np.deg2rad(lebedevdesgin[:, 1]))
+        lebedev[:, 2] = np.cos(np.deg2rad(lebedevdesgin[:, 1]))
+        LEBEDEV_DESIGNS[grid] = (lebedev, lebedevdesgin[:, 2].copy())
+    return LEBEDEV_DESIGNS[grid]
+
+
+def radial_simpson(r_max=10.0, radial_res=100):
+    """
+    radial simpson
+    ---
+    nodes and weights of the radial quadrature of pi_lebedev. Shells are logarithmically spaced up
+    to r_max, and each one is integrated with the simpson rule on its borders and middle point.
+    Borders shared by consecutive shells are merged into a single node
+    :param r_max:
+    :param radial_res:
+    :return: (2 radial_res + 1) nodes, (2 radial_res + 1) weights (including r^2 dr)
+    """
+    u = np.log(r_max + 1) / radial_res
+    borders = np.exp(np.arange(radial_res + 1) * u) - 1
+    dv = ((borders[1:] ** 3) - (borders[:-1] ** 3)) / 3
+    nodes = np.zeros(2 * radial_res + 1, dtype='float64')
+    nodes[0::2] = borders
+    nodes[1::2] = borders[1:] - 0.5 * (borders[1:] - borders[:-1])
+    weights = np.zeros(2 * radial_res + 1, dtype='float64')
+    weights[0:-1:2] += dv / 6
+    weights[1::2] += 4 * dv / 6
+    weights[2::2] += dv / 6
+    return nodes, weights
+
+
 def pi_lebedev(fun: Callable, r_max=10.0, radial_res=100, grid='medium'):
     """
     polar integral
@@ -48,15 +108,7 @@ def pi_lebedev(fun: Callable, r_max=10.0, radial_res=100, grid='medium'):
     :param grid: either medium, coarse, tight
     :return:
     """
-    from a2md import LEBEDEV_DESIGN
-    lebedevdesgin = np.loadtxt(LEBEDEV_DESIGN[grid])
-
-    lebedev = np.zeros((lebedevdesgin.shape[0], 3), dtype='float64')
-    lebedev[:, 0] = np.cos(np.deg2rad(lebedevdesgin[:, 0])) * np.sin(np.deg2rad(lebedevdesgin[:, 1]))
-    lebedev[:, 1] = np.sin(np.deg2rad(lebedevdesgin[:, 0])) * np.sin(np.deg2rad(lebedevdesgin[:, 1]))
-    lebedev[:, 2] = np.cos(np.deg2rad(lebedevdesgin[:, 1]))
-
-    w = lebedevdesgin[:, 2]
+    lebedev, w = lebedev_design(grid)
     u = np.log(r_max + 1) / radial_res
     r_grid = np.exp(np.arange(1, radial_res + 1) * u) - 1
     integral = 0.0
@@ -83,15 +135,8 @@ def pi_lebedev(fun: Callable, r_max=10.0, radial_res=100, grid='medium'):
 
 
 def pi_lebedev_m(fun: Callable, n_out: int, r_max=10.0, radial_res=100, grid='coarse'):
-    from a2md import LEBEDEV_DESIGN
-    lebedevdesgin = np.loadtxt(LEBEDEV_DESIGN[grid])
-
-    lebedev = np.zeros((lebedevdesgin.shape[0], 3), dtype='float64')
-    lebedev[:, 0] = np.cos(np.deg2rad(lebedevdesgin[:, 0])) * np.sin(np.deg2rad(lebedevdesgin[:, 1]))
-    lebedev[:, 1] = np.sin(np.deg2rad(lebedevdesgin[:, 0])) * np.sin(np.deg2rad(lebedevdesgin[:, 1]))
-    lebedev[:, 2] = np.cos(np.deg2rad(lebedevdesgin[:, 1]))
-
-    w = lebedevdesgin[:, 2].reshape(-1, 1)
+    lebedev, w = lebedev_design(grid)
+    w = w.reshape(-1, 1)
     u = np.log(r_max + 1) / radial_res
     r_grid = np.exp(np.arange(1, radial_res + 1) * u) - 1
     integral = np.zeros(n_out, dtype='float64')
@@ -117,67 +162,463 @@ def pi_lebedev_m(fun: Callable, n_out: int, r_max=10.0, radial_res=100, grid='co
     return integral
 
 
-def integrate_density_functional(functional: Callable, mol: Mol2, grid='coarse', res=100):
-    functional_value = 0.0
-    for fx in split_space(mm=mol, fun=functional):
-        functional_value += pi_lebedev(fx, radial_res=res, grid=grid)
-    return functional_value
+class MolecularGrid(A2MDBaseClass):
+    def __init__(
+            self, coordinates=None, grid='coarse', radial_res=100, r_max=10.0,
+            block_size=GRID_BLOCK_SIZE, verbose=False
+    ):
+        """
+        Molecular Grid
+        ---
+        integration grid of a molecule. Each atom contributes the lebedev x radial simpson grid of
+        pi_lebedev, restricted to its voronoi cell. Points, weights (quadrature times partition) and
+        owner atoms are kept in flat arrays, so functionals are evaluated in a few large calls instead
+        of once per shell. Points outside the voronoi cell of their atom are dropped.
+
+        :param coordinates: (n, 3) atom coordinates (Bohr)
+        :param grid: lebedev design, either coarse, medium or tight
+        :param radial_res: number of radial shells
+        :param r_max: radius of the atomic grids (Bohr)
+        :param block_size: number of points given at once to the functionals
+        :param verbose:
+        """
+        A2MDBaseClass.__init__(self, name='molecular grid', verbose=verbose)
+        self.grid = grid
+        self.radial_res = radial_res
+        self.r_max = r_max
+        self.block_size = block_size
+        self.coordinates = None
+        self.points = None
+        self.weights = None
+        self.atoms = None
+        if coordinates is not None:
+            self.build(coordinates)
+
+    def build(self, coordinates):
+        """
+        lays out the atomic grids and their voronoi partition
+        :param coordinates:
+        :return:
+        """
+        from scipy.spatial import cKDTree
+        self.coordinates = np.asarray(coordinates, dtype='float64').reshape(-1, 3)
+        lebedev, w = lebedev_design(self.grid)
+        nodes, radial_weights = radial_simpson(self.r_max, self.radial_res)
+        # the first node is the nucleus, where all directions of the design meet
+        shell_points = np.concatenate([
+            np.zeros((1, 3), dtype='float64'), (nodes[1:, np.newaxis, np.newaxis] * lebedev).reshape(-1, 3)
+        ])
+        shell_weights = 4 * np.pi * np.concatenate([
+            np.array([radial_weights[0] * w.sum()]), np.outer(radial_weights[1:], w).reshape(-1)
+        ])
+        tree = cKDTree(self.coordinates)
+        points = []
+        weights = []
+        atoms = []
+        for i in range(self.coordinates.shape[0]):
+            x = shell_points + self.coordinates[i, :]
+            _, nearest = tree.query(x)
+            keep = nearest == i
+            points.append(x[keep, :])
+            weights.append(shell_weights[keep])
+            atoms.append(np.full(keep.sum(), i, dtype='int64'))
+        self.points = np.concatenate(points)
+        self.weights = np.concatenate(weights)
+        self.atoms = np.concatenate(atoms)
+        self.log("{:d} atoms, {:d} points".format(self.coordinates.shape[0], self.points.shape[0]))
+        return self
+
+    def get_number_points(self):
+        return self.points.shape[0]
+
+    def integrate(self, functional: Callable):
+        """
+        integrates a functional over the grid. The functional may return one value per point,
+        or a (points, n) array, in which case n integrals are returned
+        :param functional:
+        :return:
+        """
+        integral = 0.0
+        for start in range(0, self.points.shape[0], self.block_size):
+            f = functional(self.points[start:start + self.block_size, :])
+            w = self.weights[start:start + self.block_size]
+            if f.ndim > 1:
+                w = w.reshape(-1, 1)
+            integral = integral + (f * w).sum(0)
+        return integral
+
+    def save(self, filename):
+        np.savez(
+            filename, coordinates=self.coordinates, points=self.points, weights=self.weights, atoms=self.atoms,
+            grid=self.grid, radial_res=self.radial_res, r_max=self.r_max
+        )
+
+    @staticmethod
+    def from_file(filename, block_size=GRID_BLOCK_SIZE, verbose=False):
+        with np.load(filename) as f:
+            mg = MolecularGrid(
+                grid=str(f['grid']), radial_res=int(f['radial_res']), r_max=float(f['r_max']),
+                block_size=block_size, verbose=verbose
+            )
+            mg.coordinates = f['coordinates']
+            mg.points = f['points']
+            mg.weights = f['weights']
+            mg.atoms = f['atoms']
+        return mg
+
+
+def angular_design(degree):
+    """
+    angular design
+    ---
+    unit vectors and weights (adding up to 1) integrating exactly spherical polynomials of the given
+    degree. The lebedev designs of the coarse, medium and tight grids are used for their degrees, and
+    gauss-legendre x uniform product grids otherwise
+    :param degree:
+    :return: (n, 3) unit vectors, (n,) weights
+    """
+    for grid, lebedev_degree in LEBEDEV_DEGREES.items():
+        if degree == lebedev_degree:
+            return lebedev_design(grid)
+    if degree not in LEBEDEV_DESIGNS:
+        t, wt = np.polynomial.legendre.leggauss(degree // 2 + 1)
+        phi = 2 * np.pi * np.arange(degree + 1) / (degree + 1)
+        sin_theta = np.sqrt(1 - t * t)
+        u = np.zeros((t.size, phi.size, 3), dtype='float64')
+        u[:, :, 0] = np.outer(sin_theta, np.cos(phi))
+        u[:, :, 1] = np.outer(sin_theta, np.sin(phi))
+        u[:, :, 2] = t[:, np.newaxis]
+        w = np.outer(wt, np.ones(phi.size)) / (2 * phi.size)
+        LEBEDEV_DESIGNS[degree] = (u.reshape(-1, 3), w.reshape(-1))
+    return LEBEDEV_DESIGNS[degree]
+
+
+def radial_treutler(n, xi=1.0):
+    """
+    radial treutler
+    ---
+    treutler-ahlrichs M4 mapping of a gauss-chebyshev (second kind) quadrature onto [0, inf)
+    :param n: number of nodes
+    :param xi: atomic scale factor
+    :return: (n,) nodes, (n,) weights (including r^2 dr)
+    """
+    t = np.arange(1, n + 1) * np.pi / (n + 1)
+    x = np.cos(t)
+    r = (xi / np.log(2)) * np.power(1 + x, 0.6) * np.log(2 / (1 - x))
+    drdx = (xi / np.log(2)) * (
+        0.6 * np.power(1 + x, -0.4) * np.log(2 / (1 - x)) + np.power(1 + x, 0.6) / (1 - x)
+    )
+    w = (np.pi / (n + 1)) * np.sin(t) * drdx * r * r
+    return r[::-1], w[::-1]
 
 
-def integrate_density_functional_gradient(functional: Callable, mol: Mol2, nfuns: int, grid='coarse', res=100):
-    r = mol.get_coordinates(units='au')
-    n = mol.get_number_atoms()
-    functional_value = np.zeros(nfuns, dtype='float64')
-    for i in range(n):
-        r0 = r[i, :]
-        fx = lambda x: functional(x + r0) * (voronoi(x + r0, r) == i).reshape(-1, 1)
-        functional_value += pi_lebedev_m(fx, nfuns, radial_res=res, grid=grid)
-    return functional_value
+def covalent_radii(atomic_numbers):
+    """
+    covalent radii (Bohr) from the periodic table, used to scale the fuzzy cells and the pruning regions
+    """
+    from a2mdio import PERIODIC_TABLE
+    from a2mdio.molecules import UNITS_TABLE
+    table = PERIODIC_TABLE.set_index('atomic_number')['covalent_radius_pyykko']
+    radii = np.array([table.loc[int(z)] for z in atomic_numbers], dtype='float64')
+    return radii * 0.01 * UNITS_TABLE['angstrom']['au']
 
 
-def kinetic_energy_functional(fun: Callable):
+def becke_weights(x, owner, coordinates, radii, neighbors=BECKE_NEIGHBORS):
+    """
+    becke weights
+    ---
+    fuzzy partition weight of the owner atom at each point, using becke cell functions (three
+    iterations of the smoothing polynomial) with atomic size adjustments. Only the nearest
+    atoms to each point compete for it
+    :param x: (n, 3) points
+    :param owner: (n,) atom of each point
+    :param coordinates: (m, 3) atom coordinates
+    :param radii: (m,) atomic radii
+    :param neighbors: number of competing atoms
+    :return: (n,) weights
+    """
+    from scipy.spatial import cKDTree
+    k = min(neighbors, coordinates.shape[0])
+    _, idx = cKDTree(coordinates).query(x, k=k)
+    idx = idx.reshape(x.shape[0], k)
+    # pair terms are computed once for the atoms met in this block, and gathered
+    local, local_idx = np.unique(idx, return_inverse=True)
+    local_idx = local_idx.reshape(idx.shape)
+    rij = np.linalg.norm(coordinates[local, np.newaxis, :] - coordinates[np.newaxis, local, :], axis=2)
+    np.fill_diagonal(rij, 1.0)
+    chi = radii[local, np.newaxis] / radii[np.newaxis, local]
+    u = (chi - 1) / (chi + 1)
+    a = np.clip(u / (u * u - 1), -0.5, 0.5)
+    pair = (local_idx[:, :, np.newaxis], local_idx[:, np.newaxis, :])
+    r = np.linalg.norm(x[:, np.newaxis, :] - coordinates[idx, :], axis=2)
+    mu = (r[:, :, np.newaxis] - r[:, np.newaxis, :]) / rij[pair]
+    nu = mu + a[pair] * (1 - mu * mu)
+    for _ in range(3):
+        nu = 1.5 * nu - 0.5 * nu * nu * nu
+    s = 0.5 * (1 - nu)
+    diagonal = np.arange(k)
+    s[:, diagonal, diagonal] = 1.0
+    p = s.prod(axis=2)
+    p_owner = (p * (idx == owner[:, np.newaxis])).sum(axis=1)
+    return p_owner / p.sum(axis=1)
+
+
+class BeckeGrid(MolecularGrid):
+    def __init__(
+            self, coordinates=None, atomic_numbers=None, tolerance=BECKE_TOLERANCE, level=None,
+            block_size=GRID_BLOCK_SIZE, verbose=False
+    ):
+        """
+        Becke Grid
+        ---
+        integration grid with smooth becke atomic weights, treutler radial grids and lebedev designs
+        pruned by the distance to the nucleus relative to the covalent radius of each element.
+        The smallest level of BECKE_LEVELS integrating the atomic probe densities within tolerance
+        is used, unless a level is given.
+
+        :param coordinates: (n, 3) atom coordinates (Bohr)
+        :param atomic_numbers: (n,) atomic numbers
+        :param tolerance: absolute error
+        :param level: index in BECKE_LEVELS
+        :param block_size: number of points given at once to the functionals
+        :param verbose:
+        """
+        A2MDBaseClass.__init__(self, name='becke grid', verbose=verbose)
+        self.grid = 'becke'
+        self.tolerance = tolerance
+        self.level = level
+        self.block_size = block_size
+        self.coordinates = None
+        self.atomic_numbers = None
+        self.points = None
+        self.weights = None
+        self.atoms = None
+        if coordinates is not None:
+            self.build(coordinates, atomic_numbers)
+
+    def build(self, coordinates, atomic_numbers=None):
+        """
+        lays out the pruned atomic grids of the chosen level and their fuzzy partition weights
+        :param coordinates:
+        :param atomic_numbers:
+        :return:
+        """
+        if atomic_numbers is None:
+            raise IOError("becke grids need the atomic numbers")
+        self.coordinates = np.asarray(coordinates, dtype='float64').reshape(-1, 3)
+        self.atomic_numbers = np.asarray(atomic_numbers, dtype='int64')
+        levels = range(len(BECKE_LEVELS)) if self.level is None else [self.level]
+        for level in levels:
+            self.__layout(level)
+            error = abs(self.integrate(self.probe) - self.atomic_numbers.sum())
+            self.log("level {:d}, {:d} points, probe error {:12.4e}".format(level, self.points.shape[0], error))
+            if self.level is not None or error < self.tolerance:
+                break
+        else:
+            self.log("tolerance {:e} was not reached".format(self.tolerance))
+        self.level = level
+        return self
+
+    def save(self, filename):
+        np.savez(
+            filename, coordinates=self.coordinates, atomic_numbers=self.atomic_numbers, points=self.points,
+            weights=self.weights, atoms=self.atoms, grid=self.grid, level=self.level, tolerance=self.tolerance
+        )
+
+    @staticmethod
+    def from_file(filename, block_size=GRID_BLOCK_SIZE, verbose=False):
+        with np.load(filename) as f:
+            mg = BeckeGrid(
+                tolerance=float(f['tolerance']), level=int(f['level']), block_size=block_size, verbose=verbose
+            )
+            mg.coordinates = f['coordinates']
+            mg.atomic_numbers = f['atomic_numbers']
+            mg.points = f['points']
+            mg.weights = f['weights']
+            mg.atoms = f['atoms']
+        return mg
+
+    def __layout(self, level):
+        n_radial, degree = BECKE_LEVELS[level]
+        radii = covalent_radii(self.atomic_numbers)
+        points = []
+        weights = []
+        atoms = []
+        for i in range(self.coordinates.shape[0]):
+            nodes, radial_weights = radial_treutler(n_radial, TREUTLER_XI.get(int(self.atomic_numbers[i]), 1.0))
+            shell_degree = np.full(n_radial, self.pruned_degree(degree, BECKE_TAIL), dtype='int64')
+            for limit, fraction in BECKE_PRUNING[::-1]:
+                shell_degree[nodes < limit * radii[i]] = self.pruned_degree(degree, fraction)
+            for shell_design in np.unique(shell_degree):
+                u, w = angular_design(int(shell_design))
+                shells = shell_degree == shell_design
+                points.append((nodes[shells, np.newaxis, np.newaxis] * u).reshape(-1, 3) + self.coordinates[i, :])
+                weights.append(4 * np.pi * np.outer(radial_weights[shells], w).reshape(-1))
+                atoms.append(np.full(shells.sum() * w.size, i, dtype='int64'))
+        points = np.concatenate(points)
+        weights = np.concatenate(weights)
+        atoms = np.concatenate(atoms)
+        partition = np.zeros(points.shape[0], dtype='float64')
+        for start in range(0, points.shape[0], self.block_size):
+            sel = slice(start, start + self.block_size)
+            partition[sel] = becke_weights(points[sel, :], atoms[sel], self.coordinates, radii)
+        weights = weights * partition
+        keep = partition > 0.0
+        self.points = points[keep, :]
+        self.weights = weights[keep]
+        self.atoms = atoms[keep]
+
+    @staticmethod
+    def pruned_degree(degree, fraction):
+        if fraction >= 1.0:
+            return degree
+        return max(5, int(round(fraction * degree)))
+
+    def probe(self, x):
+        """
+        promolecular probe density: each atom holds its core electrons and its valence electrons in
+        two slater functions, with exponents from the slater rules. It integrates to the number of
+        electrons
+        """
+        y = np.zeros(x.shape[0], dtype='float64')
+        for r, z in zip(self.coordinates, self.atomic_numbers):
+            d = np.linalg.norm(x - r, axis=1)
+            if z <= 2:
+                shells = [(z, z - 0.3 * (z - 1))]
+            else:
+                shells = [(2, z - 0.3), (z - 2, max(0.5, (z - 1.7 - 0.35 * (min(z, 10) - 3)) / 2))]
+            for n, zeta in shells:
+                y += n * (zeta ** 3) / np.pi * np.exp(-2 * zeta * d)
+        return y
+
+
+def molecular_grid_key(coordinates, settings, atomic_numbers=None):
+    """
+    name of a molecular grid in the cache. Coordinates are rounded to 1e-8 Bohr
+    """
+    h = hashlib.sha256(np.round(np.asarray(coordinates, dtype='float64'), 8).tobytes())
+    if atomic_numbers is not None:
+        h.update(np.asarray(atomic_numbers, dtype='int64').tobytes())
+    h.update(settings.encode())
+    return h.hexdigest()
+
+
+def get_molecular_grid(mol: Mol2, grid='coarse', res=100, r_max=10.0, cache=None, tolerance=BECKE_TOLERANCE):
+    """
+    get molecular grid
+    ---
+    returns the molecular grid of a molecule, building it only if it is not in the cache folder.
+    :param mol:
+    :param grid: coarse, medium or tight voronoi grids, or becke
+    :param res: radial resolution of voronoi grids
+    :param r_max: radius of voronoi grids
+    :param cache: folder where grids are stored as npz files. None always builds the grid
+    :param tolerance: absolute error of becke grids
+    :return:
+    :rtype: MolecularGrid
+    """
+    coordinates = mol.get_coordinates(units='au')
+    if grid == 'becke':
+        atomic_numbers = mol.get_atomic_numbers()
+        settings = "becke_{:e}".format(tolerance)
+        build = lambda: BeckeGrid(coordinates, atomic_numbers, tolerance=tolerance)
+        load = BeckeGrid.from_file
+    else:
+        atomic_numbers = None
+        settings = "{:s}_{:d}_{:.6f}".format(grid, res, r_max)
+        build = lambda: MolecularGrid(coordinates, grid=grid, radial_res=res, r_max=r_max)
+        load = MolecularGrid.from_file
+    if cache is None:
+        return build()
+    filename = os.path.join(cache, molecular_grid_key(coordinates, settings, atomic_numbers) + '.npz')
+    if os.path.isfile(filename):
+        return load(filename)
+    mg = build()
+    os.makedirs(cache, exist_ok=True)
+    mg.save(filename)
+    return mg
+
+
+def integrate_density_functional(
+        functional: Callable, mol: Mol2, grid='coarse', res=100, cache=None, tolerance=BECKE_TOLERANCE
+):
+    mg = get_molecular_grid(mol, grid=grid, res=res, cache=cache, tolerance=tolerance)
+    return mg.integrate(functional)
+
+
+def integrate_density_functional_gradient(
+        functional: Callable, mol: Mol2, nfuns: int, grid='coarse', res=100, cache=None, tolerance=BECKE_TOLERANCE
+):
+    mg = get_molecular_grid(mol, grid=grid, res=res, cache=cache, tolerance=tolerance)
+    return mg.integrate(functional).reshape(nfuns)
+
+
+def kinetic_energy_integrand(rho):
+    """
+    thomas-fermi kinetic energy density. Negative densities are clipped at zero
+    """
     cf = (3 / 10) * ((3 * np.pi ** 2) ** (2 / 3))
-    ke = lambda x: cf * np.power(fun(x), 5 / 3)
+    return cf * np.power(np.clip(rho, 0.0, None), 5 / 3)
+
+
+def exchange_energy_integrand(rho):
+    """
+    dirac exchange energy density. Negative densities are clipped at zero
+    """
+    cx = -(3 / 4) * ((3 / np.pi) ** (1 / 3))
+    return cx * np.power(np.clip(rho, 0.0, None), 4 / 3)
+
+
+def mse_integrand(rxf, fxf):
+    return rxf * np.power(fxf - rxf, 2.0)
+
+
+def mlse_integrand(rxf, fxf):
+    return rxf * np.log(np.power(fxf - rxf, 2.0))
+
+
+def dkl_integrand(rxf, fxf):
+    return fxf * np.log(fxf / rxf)
+
+
+def vdwvolume_integrand(rxf, eps=1e-3):
+    return (rxf > eps).astype(float)
+
+
+def kinetic_energy_functional(fun: Callable):
+    ke = lambda x: kinetic_energy_integrand(fun(x))
     return ke
 
 
 def exchange_energy_functional(fun: Callable):
-    cx = -(3 / 4) * ((3 / np.pi) ** (1 / 3))
-    xe = lambda x: cx * np.power(fun(x), 4 / 3)
+    xe = lambda x: exchange_energy_integrand(fun(x))
     return xe
 
 
 def mse_functional(ref: Callable, fun: Callable):
     def mse(x):
-        rxf = ref(x)
-        fxf = fun(x)
-        return rxf * np.power(fxf - rxf, 2.0)
+        return mse_integrand(ref(x), fun(x))
 
     return mse
 
 
 def mlse_functional(ref: Callable, fun: Callable):
     def mlse(x):
-        rxf = ref(x)
-        fxf = fun(x)
-        return rxf * np.log(np.power(fxf - rxf, 2.0))
+        return mlse_integrand(ref(x), fun(x))
 
     return mlse
 
 
 def dkl_functional(ref: Callable, fun: Callable):
     def dkl(x):
-        rxf = ref(x)
-        fxf = fun(x)
-        return fxf * np.log(fxf / rxf)
+        return dkl_integrand(ref(x), fun(x))
 
     return dkl
 
 
 def vdwvolume_functional(ref: Callable, eps=1e-3):
     def vdwvol(x):
-        rxf = ref(x)
-        return (rxf > eps).astype(float)
+        return vdwvolume_integrand(ref(x), eps=eps)
 
     return vdwvol
 
@@ -197,3 +638,60 @@ def dkl_gradient_functional(ref: Callable, model: Molecule):
         return u
 
     return dkl_gradient
+
+
+def density_report(mg: MolecularGrid, reference: Callable, candidate: Callable, eps=1e-3):
+    """
+    density report
+    ---
+    compares two electron densities on a molecular grid. Each density is evaluated once per point,
+    and all the functionals (mse, mlse, dkl, volumes, kinetic and exchange energies, charges) are
+    integrated from those values, both for the molecule and for each atom of the grid. Points where
+    mlse or dkl are not defined (zero error, non positive densities) are left out of those integrals,
+    and their number is reported as mlse_excluded and dkl_excluded
+    :param mg: molecular grid
+    :param reference: reference density (e.g. WaveFunction.eval)
+    :param candidate: candidate density (e.g. Molecule.eval)
+    :param eps: volume surface density value
+    :return: dictionary with the molecular integrals, and per atom integrals under the atoms key
+    """
+    n_atoms = mg.coordinates.shape[0]
+    atoms = dict()
+    for start in range(0, mg.get_number_points(), mg.block_size):
+        x = mg.points[start:start + mg.block_size, :]
+        w = mg.weights[start:start + mg.block_size]
+        owner = mg.atoms[start:start + mg.block_size]
+        rxf = reference(x)
+        fxf = candidate(x)
+        # the logarithms are only defined where the error is not zero (mlse) and where both densities
+        # are positive (dkl). The remaining points are left out, and counted
+        mlse_valid = fxf != rxf
+        dkl_valid = (rxf > 0) & (fxf > 0)
+        mlse = np.zeros(x.shape[0], dtype='float64')
+        mlse[mlse_valid] = mlse_integrand(rxf[mlse_valid], fxf[mlse_valid])
+        dkl = np.zeros(x.shape[0], dtype='float64')
+        dkl[dkl_valid] = dkl_integrand(rxf[dkl_valid], fxf[dkl_valid])
+        integrands = dict(
+            mse=mse_integrand(rxf, fxf) * w,
+            mlse=mlse * w,
+            dkl=dkl * w,
+            reference_volume=vdwvolume_integrand(rxf, eps=eps) * w,
+            candidate_volume=vdwvolume_integrand(fxf, eps=eps) * w,
+            reference_kinetic=kinetic_energy_integrand(rxf) * w,
+            candidate_kinetic=kinetic_energy_integrand(fxf) * w,
+            reference_exchange=exchange_energy_integrand(rxf) * w,
+            candidate_exchange=exchange_energy_integrand(fxf) * w,
+            reference_charge=rxf * w,
+            candidate_charge=fxf * w,
+            absolute_error=np.abs(fxf - rxf) * w,
+            mlse_excluded=(~mlse_valid).astype(float),
+            dkl_excluded=(~dkl_valid).astype(float)
+        )
+        for name, integrand in integrands.items():
+            atoms[name] = atoms.get(name, 0.0) + np.bincount(owner, weights=integrand, minlength=n_atoms)
+    report = dict((name, float(value.sum())) for name, value in atoms.items())
+    report['atoms'] = dict((name, value.tolist()) for name, value in atoms.items())
+    for name in ['mlse_excluded', 'dkl_excluded']:
+        report[name] = int(report[name])
+        report['atoms'][name] = [int(n) for n in report['atoms'][name]]
+    return report
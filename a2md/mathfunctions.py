@@ -241,8 +241,8 @@ def ep_xg_angular0(alpha, z):
 
     inside_term_1 = 1 - (np.pi * alpha * (0 + 2j))
     inside_term_2 = 1 + (np.pi * alpha * (0 + 2j))
-    factor2 -= erfi(inside_term_1 / (2 * np.sqrt(alpha)))
-    factor2 -= erfi(inside_term_2 / (2 * np.sqrt(alpha)))
+    factor2 = factor2 - erfi(inside_term_1 / (2 * np.sqrt(alpha)))
+    factor2 = factor2 - erfi(inside_term_2 / (2 * np.sqrt(alpha)))
 
     return factor1 * factor2 * 0.5
 
@@ -258,7 +258,7 @@ def ep_xg_angular1(alpha, z):
 
 def ep_xg_angular2(alpha, z):
     factor = 5 * np.sqrt(np.pi) / (256.0 * np.sqrt(alpha) * np.exp(9 / (4 * alpha)))
-    factor *= (1.0 + 3.0 * np.cos(2 * z))
+    factor = factor * (1.0 + 3.0 * np.cos(2 * z))
 
     sqa = 2.0 * np.sqrt(alpha)
 
@@ -274,7 +274,7 @@ def ep_xg_angular2(alpha, z):
 
 def ep_xg_angular3(alpha, z):
     factor = 7 * np.exp(-4.0 / alpha) * np.sqrt(np.pi) * np.cos(z) / (256.0 * np.sqrt(alpha))
-    factor *= (-3 + 5 * np.power(np.cos(z), 2.0))
+    factor = factor * (-3 + 5 * np.power(np.cos(z), 2.0))
 
     it1 = (2.0j + alpha * np.pi) / np.sqrt(alpha)
     it2 = 1 / np.sqrt(alpha)
@@ -314,6 +314,44 @@ def electrostatic_potential_xexp_gaussian(G, alpha, d, z):
     return electrostatic_potential_buffer
 
 
+def ep_xg_angular_constants(alpha):
+    """
+    constant factors of the angular terms of the electrostatic potential of the angular gaussian.
+    Each angular term of order l is a function of alpha times the legendre polynomial P_l(cos z),
+    so these constants are the terms at z = 0. They include the 4 pi / (2l + 1) factor.
+
+    :param alpha:
+    :return: (4,) array for a single alpha, or (4, n) for an array of alphas
+    """
+    alpha = np.asarray(alpha, dtype='float64')
+    z = np.zeros(alpha.shape, dtype='float64')
+    angular_terms = [ep_xg_angular0, ep_xg_angular1, ep_xg_angular2, ep_xg_angular3]
+    return np.stack([
+        np.broadcast_to(np.real(ang(alpha, z)), alpha.shape) * (4 * np.pi) / ((2 * l) + 1)
+        for l, ang in enumerate(angular_terms)
+    ])
+
+
+def electrostatic_potential_xexp_gaussian_factorized(G, constants, d, z):
+    """
+    electrostatic potential of the angular gaussian, using the angular constants of
+    ep_xg_angular_constants instead of evaluating the angular terms at each point
+
+    :param G:
+    :param constants: see ep_xg_angular_constants
+    :param d:
+    :param z:
+    :return:
+    """
+    radial_terms = [ep_xg_radial0, ep_xg_radial1, ep_xg_radial2, ep_xg_radial3]
+    u = np.cos(z)
+    legendre_terms = [1.0, u, 0.5 * (3 * (u * u) - 1), 0.5 * (5 * (u ** 3) - 3 * u)]
+    electrostatic_potential_buffer = np.zeros(d.shape[0], dtype='float64')
+    for rad, c, p in zip(radial_terms, constants, legendre_terms):
+        electrostatic_potential_buffer = electrostatic_potential_buffer + (rad(G, d) * c * p)
+    return electrostatic_potential_buffer
+
+
 # Electrostatic potential of harmonic functions
 # harmonics
 def yl1m0(t):
@@ -396,3 +434,34 @@ def pe_harmonic(r, t, l, P, B):
         return factor * radial * ((5.0 * u ** 3) - (3.0 * u)) / 2.0
     else:
         raise NotImplementedError("only implemented for 0 < l < 4")
+
+
+def generalized_exponential_radius(A, B, P, tolerance, iterations=64):
+    """
+    generalized exponential radius
+    ---
+    distance beyond which |A| d^P Exp[-B d] stays below tolerance. It is the largest root of:
+
+        ln|A| + P ln(d) - B d = ln(tolerance)
+
+    which is found by fixed point iteration starting after the maximum of the function (d = P/B),
+    where the iteration is contractive.
+
+    :param A: coefficients
+    :param B: exponents
+    :param P: polynomial degrees
+    :param tolerance: smallest value considered as non negligible
+    :param iterations: number of fixed point iterations
+    :return: screening radius (0 for functions that never reach tolerance)
+    """
+    A = np.abs(np.asarray(A, dtype='float64'))
+    B = np.asarray(B, dtype='float64')
+    P = np.asarray(P, dtype='float64') * np.ones_like(B)
+    d_max = P / B
+    peak = generalized_exponential(A, B, d_max, P)
+    log_ratio = np.log(np.clip(A, 1e-300, None) / tolerance)
+    d = np.maximum(d_max, log_ratio / B) + d_max + 1.0
+    for _ in range(iterations):
+        d = (log_ratio + P * np.log(d)) / B
+        d = np.maximum(d, d_max + 1e-12)
+    return np.where(peak > tolerance, d, 0.0)
@@ -7,13 +7,19 @@ from a2md.support import SupportHarmonic
 from a2md import TOPO_RESTRICTED_PARAMS, HARMONIC_TOPO_RESTRICTED_PARAMS, EXTENDED_TOPO_RESTRICTED_PARAMS
 from a2md import SPHERICAL_PARAMS
 from a2md.baseclass import A2MDBaseClass
+from a2md.evaluation import EvaluationPlan
+from a2md.multipole import MultipolePlan
 from a2mdio.molecules import Mol2, PDB
 from a2md.utils import convert_connectivity_tree_to_pairs
 from a2mdio import PDB_PROTEIN_TYPE_CHARGES, PDB_PROTEIN_CHARGES, PDB_PROTEIN_TYPES, PDB_PROTEIN_TOPOLOGY
-from a2mdio import MAP_AN2SYMBOL
+from a2mdio import get_symbol
 from typing import List, Union, Callable
 
 CLUSTERING_TRESHOLD_VALUE = 0.02
+VOLUME_BLOCK_SIZE = 2 ** 15
+DKL_DENSITY_FLOOR = 1e-3  # below this fraction of the reference, the dkl integrand is continued by its expansion
+DKL_TOLERANCE = 1e-10  # newton decrement at which the dkl optimization stops
+DKL_MAX_ITERATIONS = 100
 
 SUPPORT_TYPE = {
     "_SPHERIC": lambda args: SupportRadial(**args),
@@ -79,6 +85,71 @@ def polymer_from_pdb(mol: PDB, chain: str):
     )
 
 
+def get_chunk_size(n_points, n_functions, memory_budget=None):
+    """
+    number of points per chunk, so the design matrix chunk (and its weighted copy)
+    of n_functions fits in memory_budget bytes
+
+    :param n_points: total number of points
+    :param n_functions: number of functions
+    :param memory_budget: bytes. None to use a single chunk
+    :return:
+    """
+    if memory_budget is None:
+        return max(1, n_points)
+    return int(max(1, memory_budget // (2 * 8 * max(1, n_functions))))
+
+
+def get_sample_shards(coordinates, density, weights=None):
+    """
+    arranges a training sample as a list of (coordinates, density, weights) shards. The sample may
+    be given either as arrays (in memory or memory-mapped) or as lists of arrays, one per shard.
+    Shards are only sliced, never copied
+
+    :param coordinates: (n, 3) array or list of (n_i, 3) arrays
+    :param density: (n,) array or list of (n_i,) arrays
+    :param weights: None, (n,) array or list of (n_i,) arrays
+    :return: list of shards
+    """
+    if isinstance(coordinates, (list, tuple)):
+        if not isinstance(density, (list, tuple)) or len(density) != len(coordinates):
+            raise IOError("coordinates and density shards do not match")
+        if weights is None:
+            weights = [None] * len(coordinates)
+        elif not isinstance(weights, (list, tuple)) or len(weights) != len(coordinates):
+            raise IOError("weights shards do not match sample shards")
+        shards = list(zip(coordinates, density, weights))
+    else:
+        shards = [(coordinates, density, weights)]
+
+    for x, r, w in shards:
+        if x.shape[0] != r.shape[0]:
+            raise IOError("density size do not match sample size")
+        if w is not None and x.shape[0] != w.size:
+            raise IOError("weights size do not match sample size")
+    return shards
+
+
+def dkl_terms(rho, reference, floor=DKL_DENSITY_FLOOR):
+    """
+    integrand rho log(rho / reference) of the kullback-leibler divergence, with its first and second
+    derivatives with respect to rho. Below floor * reference, it is continued by its second order
+    expansion, so it stays defined (and convex) for negative model densities
+
+    :param rho: model density
+    :param reference: reference density (positive)
+    :param floor: fraction of the reference density
+    :return: value, first derivative, second derivative
+    """
+    a = np.maximum(rho, floor * reference)
+    log_ratio = np.log(a / reference)
+    d1 = log_ratio + 1
+    d2 = 1 / a
+    delta = rho - a
+    value = a * log_ratio + d1 * delta + 0.5 * d2 * delta * delta
+    return value, d1 + d2 * delta, d2
+
+
 class Molecule(A2MDBaseClass):
     parametrization_default = TOPO_RESTRICTED_PARAMS
     parametrization_harmonic = HARMONIC_TOPO_RESTRICTED_PARAMS
@@ -122,12 +193,17 @@ class Molecule(A2MDBaseClass):
         self.map_function2center = None
         self.map_frozenfunctions = None
         self.functions = None
+        self.evaluation_plan = None
         self.opt_params = None
         self.nfunctions = None
         self.atom_labels = atom_labels
         self.function_names = []
         self.function_types = []
         self.regularization = 0.0001
+        self.screening_tolerance = None
+        self.ep_tolerance = None
+        self.multipole_theta = None
+        self.multipole_plan = None
         self.is_clusterized = False
         self.is_optimized = False
         self.segments = segments  # segments allows to perform semi-restricted optimizations, in which
@@ -168,22 +244,23 @@ class Molecule(A2MDBaseClass):
         functions = copy.copy(self.functions)
         function_names = copy.copy(self.function_names)
         function_types = copy.copy(self.function_types)
-        expanded_fns = []
+        # index maps: (center, name) -> functions, for isotropic (no bond) and anisotropic functions.
+        # functions are kept in their original order
 
+        isotropic_names = dict()
+        isotropic_functions = dict()
+        anisotropic_functions = dict()
         for i in range(len(function_names)):
-            bond_ = function_names[i][2]
+            center_ = function_names[i][0]
             name_ = function_names[i][1]
-            type_ = function_types[i]
-
-            expanded_fns.append(
-                dict(
-                    type=type_,
-                    center=function_names[i][0],
-                    bond=bond_,
-                    name=name_
-                )
-            )
-            del bond_, name_, type_
+            bond_ = function_names[i][2]
+            if bond_ is None:
+                isotropic_names.setdefault(center_, [])
+                if name_ not in isotropic_names[center_]:
+                    isotropic_names[center_].append(name_)
+                isotropic_functions.setdefault((center_, name_), []).append(i)
+            else:
+                anisotropic_functions.setdefault(center_, []).append(i)
 
         # Clusterize charges
 
@@ -209,14 +286,12 @@ class Molecule(A2MDBaseClass):
             # Part 1.1. Find types of functions
 
             current_cluster_function_names = []
+            seen_names = set()
             for atom_idx in cluster:
-                for i, fun_info in enumerate(expanded_fns):
-                    c1 = fun_info['center'] == atom_idx
-                    c2 = fun_info['name'] not in current_cluster_function_names
-                    c3 = fun_info['bond'] is None
-                    if all([c1, c2, c3]):
-                        current_cluster_function_names.append(fun_info['name'])
-                    del c1, c2, c3
+                for fun_name in isotropic_names.get(atom_idx, []):
+                    if fun_name not in seen_names:
+                        seen_names.add(fun_name)
+                        current_cluster_function_names.append(fun_name)
 
             # Part 1.1. Cluster isotropic functions
 
@@ -226,16 +301,11 @@ class Molecule(A2MDBaseClass):
                 current_map2atoms = []
                 current_map2bonds = []
                 for atom_idx in cluster:
-                    for i, fun_info in enumerate(expanded_fns):
-                        c1 = fun_info['center'] == atom_idx
-                        c2 = fun_info['name'] == fun_name
-                        c3 = fun_info['bond'] is None
-                        if all([c1, c2, c3]):
-                            current_cluster_functions.append(functions[i])
-                            is_frozen.append(map_frozenfunction[i])
-                            current_map2atoms.append(atom_idx)
-                            current_map2bonds.append(None)
-                        del c1, c2, c3
+                    for i in isotropic_functions.get((atom_idx, fun_name), []):
+                        current_cluster_functions.append(functions[i])
+                        is_frozen.append(map_frozenfunction[i])
+                        current_map2atoms.append(atom_idx)
+                        current_map2bonds.append(None)
 
                 new_functions.append(
                     SupportEnsemble(
@@ -260,35 +330,30 @@ class Molecule(A2MDBaseClass):
         for bond_cluster in sb:
 
             cluster_0 = sa[bond_cluster[0]]
-            cluster_1 = sa[bond_cluster[1]]
+            cluster_1 = set(sa[bond_cluster[1]])
             # only functions that come from cluster 0 are required
             current_cluster_function_names = []
             current_cluster_function_types = []
+            current_cluster_function_idx = dict()
             for atom_idx in cluster_0:
-
-                for i, fun_info in enumerate(expanded_fns):
-                    c1 = fun_info['center'] == atom_idx
-                    c2 = fun_info['name'] not in current_cluster_function_names
-                    c3 = fun_info['bond'] in cluster_1
-                    if all([c1, c2, c3]):
-                        current_cluster_function_names.append(fun_info['name'])
-                        current_cluster_function_types.append(fun_info['type'])
-                    del c1, c2, c3
+                for i in anisotropic_functions.get(atom_idx, []):
+                    if function_names[i][2] not in cluster_1:
+                        continue
+                    fun_name = function_names[i][1]
+                    if fun_name not in current_cluster_function_idx:
+                        current_cluster_function_idx[fun_name] = []
+                        current_cluster_function_names.append(fun_name)
+                        current_cluster_function_types.append(function_types[i])
+                    current_cluster_function_idx[fun_name].append(i)
 
             for fun_name, fun_type in zip(current_cluster_function_names, current_cluster_function_types):
                 current_cluster_functions = []
                 current_map2atoms = []
                 current_map2bonds = []
-                for atom_idx in cluster_0:
-                    for i, fun_info in enumerate(expanded_fns):
-                        c1 = fun_info['center'] == atom_idx
-                        c2 = fun_info['name'] == fun_name
-                        c3 = fun_info['bond'] in cluster_1
-                        if all([c1, c2, c3]):
-                            current_cluster_functions.append(functions[i])
-                            current_map2atoms.append(atom_idx)
-                            current_map2bonds.append(fun_info['bond'])
-                        del c1, c2, c3
+                for i in current_cluster_function_idx[fun_name]:
+                    current_cluster_functions.append(functions[i])
+                    current_map2atoms.append(function_names[i][0])
+                    current_map2bonds.append(function_names[i][2])
 
                 new_functions.append(
                     SupportEnsemble(
@@ -309,6 +374,7 @@ class Molecule(A2MDBaseClass):
         self.function_names = new_names
         self.function_types = new_functiontypes
         self.functions = new_functions
+        self.evaluation_plan = None
         self.opt_params = np.zeros(len(sa), dtype="float64")
         self.nfunctions = len(new_functions)
         self.is_clusterized = True
@@ -324,17 +390,13 @@ class Molecule(A2MDBaseClass):
         :return: density values  (e-/Bohr^3)
         :type: np.ndarray
         """
-        d = np.zeros(x.shape[0])
-        for i, (sup, c) in enumerate(zip(self.functions, self.opt_params)):
-            if kind == 'density':
-                d += c * sup.eval(x)
-            elif kind == 'ep':
-                d -= c * sup.eval_ep(x)
-            else:
-                raise NotImplementedError("only density or ep")
+        if kind == 'ep' and self.multipole_theta is not None:
+            return self.get_multipole_plan().eval(x, self.opt_params)
+
+        d = self.get_evaluation_plan().eval(x, self.opt_params, kind=kind)
 
         if kind == 'ep':
-            d += self.eval_nuclear_potential(x)
+            d = self.eval_nuclear_potential(x) - d
 
         return d
 
@@ -406,19 +468,27 @@ class Molecule(A2MDBaseClass):
             v += z / d
         return v
 
-    def eval_volume(self, spacing, resolution, kind='density', cutoff=None):
+    def eval_volume(
+            self, spacing, resolution, kind='density', cutoff=None, block_size=VOLUME_BLOCK_SIZE, workers=1
+    ):
         """
         Evaluation of electron density in a grid. Useful to visualize electron density.
         Resulting object can be saved as a .dx file and visualized in Chimera and other
         tools.
 
+        The grid is evaluated by tiles of whole z-columns, stacking as many yz-planes (or as many
+        columns of a single plane) as fit in block_size points. Tiles can be spread over a pool of threads.
+
         :param spacing: amount of space around the min and max of the molecule.
         :param resolution: use Bohr as unit of length
         :param kind: either electron density (-density-) or electrostatic potential (-ep-)
         :param cutoff: truncates values exceding some value.
+        :param block_size: maximum number of grid points evaluated at once
+        :param workers: number of threads
         :return:
         """
         from a2mdio.qm import ElectronDensity
+        from concurrent.futures import ThreadPoolExecutor
         minx, miny, minz = (self.coordinates - spacing).min(axis=0)
         maxx, maxy, maxz = (self.coordinates + spacing).max(axis=0)
 
@@ -427,21 +497,36 @@ class Molecule(A2MDBaseClass):
         zz = np.arange(minz, maxz, resolution)
 
         dx = np.zeros((xx.size, yy.size, zz.size))
-        if cutoff is None:
-            f = lambda x: self.eval(x, kind=kind)
+
+        plane_size = yy.size * zz.size
+        if plane_size <= block_size:
+            n_planes = max(1, block_size // max(1, plane_size))
+            tiles = [(ix, min(ix + n_planes, xx.size), 0, yy.size) for ix in range(0, xx.size, n_planes)]
         else:
-            def f(x):
-                p = self.eval(x, kind=kind)
+            n_columns = max(1, block_size // max(1, zz.size))
+            tiles = [
+                (ix, ix + 1, iy, min(iy + n_columns, yy.size))
+                for ix in range(xx.size) for iy in range(0, yy.size, n_columns)
+            ]
+
+        def fill(tile):
+            ix0, ix1, iy0, iy1 = tile
+            r = np.stack(np.meshgrid(xx[ix0:ix1], yy[iy0:iy1], zz, indexing='ij'), axis=-1).reshape(-1, 3)
+            p = self.eval(r, kind=kind)
+            if cutoff is not None:
                 p[p > cutoff] = cutoff
-                return p
-
-        for ix in range(xx.size):
-            r = np.zeros((zz.size, 3), dtype='float64')
-            r[:, 0] = xx[ix]
-            for iy in range(yy.size):
-                r[:, 1] = yy[iy]
-                r[:, 2] = zz[:]
-                dx[ix, iy, :] = f(r)
+            dx[ix0:ix1, iy0:iy1, :] = p.reshape(ix1 - ix0, iy1 - iy0, zz.size)
+
+        # the plan is built before spreading the tiles, so threads share it
+        self.get_evaluation_plan()
+        if kind == 'ep' and self.multipole_theta is not None:
+            self.get_multipole_plan()
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(fill, tiles))
+        else:
+            for tile in tiles:
+                fill(tile)
 
         vol_density = ElectronDensity(verbose=False)
         vol_density.set_r0(np.array([minx, miny, minz]) * 0.5292)
@@ -488,6 +573,7 @@ class Molecule(A2MDBaseClass):
         self.function_names = new_names
         self.function_types = new_types
         self.functions = new_functions
+        self.evaluation_plan = None
         self.nfunctions = len(new_functions)
         self.opt_params = new_coefficients
         self.is_clusterized = False
@@ -533,6 +619,33 @@ class Molecule(A2MDBaseClass):
         """
         return self.coordinates.copy()
 
+    def get_evaluation_plan(self):
+        """
+        returns the compiled evaluation plan of the current support functions. The plan
+        is built on first use and dropped each time the functions are redefined.
+        :return:
+        :rtype: EvaluationPlan
+        """
+        if self.evaluation_plan is None:
+            self.evaluation_plan = EvaluationPlan(
+                self.functions, tolerance=self.screening_tolerance, ep_tolerance=self.ep_tolerance
+            )
+        return self.evaluation_plan
+
+    def get_multipole_plan(self):
+        """
+        returns the octree of the support functions used to evaluate the electrostatic
+        potential with far-field multipoles. It is rebuilt whenever the evaluation plan is.
+        :return:
+        :rtype: MultipolePlan
+        """
+        plan = self.get_evaluation_plan()
+        if self.multipole_plan is None or self.multipole_plan.plan is not plan:
+            self.multipole_plan = MultipolePlan(
+                plan, self.coordinates, self.atomic_numbers, theta=self.multipole_theta
+            )
+        return self.multipole_plan
+
     def get_function_names(self):
         """
 
@@ -630,7 +743,7 @@ class Molecule(A2MDBaseClass):
         :return:
         """
         if self.atom_labels is None:
-            return [MAP_AN2SYMBOL[i] for i in self.atomic_numbers]
+            return [get_symbol(i) for i in self.atomic_numbers]
         else:
             return self.atom_labels
 
@@ -673,10 +786,130 @@ class Molecule(A2MDBaseClass):
             q[i] += atom_q
         return n_restrictions, unfrozen_map2center, frozen_map2center, q
 
+    def accumulate_normal_equations(
+            self, x: np.ndarray, r: np.ndarray, w: np.ndarray,
+            unfrozen_plan: EvaluationPlan, frozen_plan: EvaluationPlan,
+            memory_budget: int = None
+    ):
+        """
+        accumulates the normal equations of the weighted least squares problem,
+            B = D W D^T
+            p = D W (r - r_frozen)
+        walking over the training points in chunks, so the design matrix D is never
+        built for the whole sample.
+
+        :param x: training coordinates
+        :param r: training density
+        :param w: training weights, either an array or a single weight for all the points
+        :param unfrozen_plan: evaluation plan of the functions to optimize
+        :param frozen_plan: evaluation plan of the frozen functions
+        :param memory_budget: maximum size (bytes) of the design matrix chunks. None for a single chunk
+        :return: B, p
+        """
+        n_coefficients = unfrozen_plan.nfunctions
+        b = np.zeros((n_coefficients, n_coefficients), dtype='float64')
+        p = np.zeros(n_coefficients, dtype='float64')
+        frozen_coefficients = np.ones(frozen_plan.nfunctions, dtype='float64')
+        chunk_size = get_chunk_size(x.shape[0], n_coefficients, memory_budget)
+
+        for start in range(0, x.shape[0], chunk_size):
+            xc = np.asarray(x[start:start + chunk_size, :], dtype='float64')
+            rc = np.asarray(r[start:start + chunk_size], dtype='float64')
+            rc = rc - frozen_plan.eval(xc, frozen_coefficients)
+            wc = w if np.isscalar(w) else np.asarray(w[start:start + chunk_size], dtype='float64')
+            dc = unfrozen_plan.eval_basis(xc)
+            dw = dc * wc
+            b += dw.dot(dc.T)
+            p += dw.dot(rc)
+        return b, p
+
+    @staticmethod
+    def dkl_optimize(c, shards, unfrozen_plan, frozen_plan, unfrozen_map2center, frozen_map2center, charges, gamma):
+        """
+        minimizes sum_k w_k rho'_k log(rho'_k / rho_k) + gamma |c|^2 by newton steps on the KKT system
+        with backtracking. The charge restrictions are imposed with the same quadrature as the
+        divergence, so that the model and the reference are compared with the same normalization.
+        The basis is evaluated on the grid once, and then each step only needs its products with
+        the coefficients and with the gradient terms. Points where the reference density is not
+        positive are left out
+
+        :param c: initial coefficients (e.g. the least squares solution)
+        :param shards: (coordinates, density, weights) shards of the quadrature grid
+        :param unfrozen_plan: evaluation plan of the functions to optimize
+        :param frozen_plan: evaluation plan of the frozen functions
+        :param unfrozen_map2center: restriction of each function to optimize
+        :param frozen_map2center: restriction of each frozen function
+        :param charges: charge of each restriction
+        :param gamma: regularization
+        :return: coefficients, divergence (without the regularization)
+        """
+        basis = []
+        reference = []
+        frozen = []
+        weights = []
+        frozen_integrals = np.zeros(frozen_plan.nfunctions, dtype='float64')
+        for x, r, w in shards:
+            r = np.asarray(r, dtype='float64')
+            keep = r > 0
+            x = np.asarray(x, dtype='float64')[keep, :]
+            w = np.asarray(w, dtype='float64')[keep]
+            frozen_basis = frozen_plan.eval_basis(x)
+            basis.append(unfrozen_plan.eval_basis(x))
+            reference.append(r[keep])
+            frozen.append(frozen_basis.sum(axis=0))
+            weights.append(w)
+            frozen_integrals += frozen_basis.dot(w)
+        basis = np.concatenate(basis, axis=1)
+        reference = np.concatenate(reference)
+        frozen = np.concatenate(frozen)
+        weights = np.concatenate(weights)
+
+        n_coefficients = c.size
+        n_restrictions = len(charges)
+        a = np.zeros((n_restrictions, n_coefficients), dtype='float64')
+        a[unfrozen_map2center, np.arange(n_coefficients)] = basis.dot(weights)
+        q = np.asarray(charges, dtype='float64') - np.bincount(
+            np.asarray(frozen_map2center, dtype='int64'), weights=frozen_integrals, minlength=n_restrictions
+        )
+        c = c + a.T.dot(np.linalg.solve(a.dot(a.T), q - a.dot(c)))
+
+        kkt = np.zeros((n_coefficients + n_restrictions, n_coefficients + n_restrictions), dtype='float64')
+        kkt[n_coefficients:, :n_coefficients] = a
+        kkt[:n_coefficients, n_coefficients:] = a.T
+        rhs = np.zeros(n_coefficients + n_restrictions, dtype='float64')
+
+        def objective(coefficients):
+            rho = coefficients.dot(basis) + frozen
+            value, d1, d2 = dkl_terms(rho, reference)
+            return (weights * value).sum() + gamma * coefficients.dot(coefficients), d1, d2
+
+        loss, d1, d2 = objective(c)
+        for _ in range(DKL_MAX_ITERATIONS):
+            g = basis.dot(weights * d1) + 2 * gamma * c
+            kkt[:n_coefficients, :n_coefficients] = (basis * (weights * d2)).dot(basis.T)
+            kkt[:n_coefficients, :n_coefficients] += 2 * gamma * np.identity(n_coefficients, dtype='float64')
+            rhs[:n_coefficients] = -g
+            rhs[n_coefficients:] = q - a.dot(c)
+            step = np.linalg.solve(kkt, rhs)[:n_coefficients]
+            decrement = -g.dot(step)
+            if decrement < DKL_TOLERANCE:
+                break
+            t = 1.0
+            while t > 1e-10:
+                candidate_loss, candidate_d1, candidate_d2 = objective(c + t * step)
+                if candidate_loss <= loss - 1e-4 * t * decrement:
+                    break
+                t *= 0.5
+            c = c + t * step
+            loss, d1, d2 = candidate_loss, candidate_d1, candidate_d2
+        return c, loss - gamma * c.dot(c)
+
     def optimize(
-            self, training_coordinates: np.ndarray, training_density: np.ndarray,
+            self, training_coordinates: Union[np.ndarray, List[np.ndarray]],
+            training_density: Union[np.ndarray, List[np.ndarray]],
             optimization_mode: str = 'restricted',
-            weights: np.ndarray = None
+            weights: Union[np.ndarray, List[np.ndarray]] = None, memory_budget: int = None,
+            loss: str = 'mse'
     ):
         """
         sets the coefficients associated to each support function by
@@ -686,19 +919,31 @@ class Molecule(A2MDBaseClass):
             - rho : ab-initio density
             - rho' : aAMD density
             - q_{i} : charge of atom i
-        :param training_coordinates: coordinates of nuclei atoms
-        :param training_density: density values
+        With loss dkl, the least squares solution is refined by minimizing the kullback-leibler
+        divergence int rho' log(rho' / rho) dV under the same restrictions. The sample must then be
+        a quadrature grid (e.g. a2md.integrate.MolecularGrid points), with its quadrature weights, and
+        the charges are integrated with that quadrature too, as the divergence is.
+        :param training_coordinates: coordinates of nuclei atoms. Either an array (which may be
+        memory-mapped) or a list of arrays, one for each shard of the sample
+        :param training_density: density values, arranged as training_coordinates
         :param optimization_mode: either restricted, unrestricted or semirestricted
-        :param weights: allows to modify the weight of the input samples
-        :type training_coordinates: np.ndarray
-        :type training_density: np.ndarray
+        :param weights: allows to modify the weight of the input samples, arranged as training_coordinates
+        :param memory_budget: maximum size (bytes) of the design matrix. When the sample does not fit,
+        the normal equations are accumulated over chunks of training points
+        :param loss: either mse or dkl
+        :type training_coordinates: Union[np.ndarray, List[np.ndarray]]
+        :type training_density: Union[np.ndarray, List[np.ndarray]]
         :type optimization_mode: str
+        :type memory_budget: int
         :return: coefficients
         :rtype: np.ndarray
         """
 
-        x = training_coordinates.copy()
-        r = training_density.copy()
+        shards = get_sample_shards(training_coordinates, training_density, weights)
+        if loss not in ['mse', 'dkl']:
+            raise IOError("loss must be either mse or dkl")
+        if loss == 'dkl' and any(w is None for _, _, w in shards):
+            raise IOError("dkl optimization needs the quadrature weights of the grid")
 
         frozen_ensemble = [self.functions[i] for i in range(self.nfunctions) if self.map_frozenfunctions[i]]
         unfrozen_ensemble = [self.functions[i] for i in range(self.nfunctions) if not self.map_frozenfunctions[i]]
@@ -714,29 +959,31 @@ class Molecule(A2MDBaseClass):
         else:
             raise IOError("optimization mode must be either restricted, unrestricted or semirestricted")
 
-        n_training = training_coordinates.shape[0]
-        if weights is None:
-            w = np.ones(n_training, dtype='float64') / n_training
-        else:
-            if n_training != weights.size:
-                raise IOError("weights size do not match sample size")
-            w = weights
+        n_training = sum(x.shape[0] for x, _, _ in shards)
 
+        charges = np.array(q, dtype='float64')
         for i, frozen_fun in enumerate(frozen_ensemble):
             j = frozen_map2center[i]
             q[j] -= frozen_fun.integral()
-        frozen_ensemble = SupportEnsemble(functions=frozen_ensemble, name='frozen_set')
-        r = r - frozen_ensemble.eval(x)
 
-        d = np.zeros((n_coefficients, n_training), dtype='float64')
         p = np.zeros((n_coefficients + n_restrictions), dtype='float64')
         b = np.zeros((n_coefficients + n_restrictions, n_coefficients + n_restrictions), dtype='float64')
 
-        for i, xi in enumerate(unfrozen_ensemble):
-            d[i, :] = xi.eval(x)
+        unfrozen_plan = EvaluationPlan(unfrozen_ensemble, tolerance=self.screening_tolerance)
+        frozen_plan = EvaluationPlan(frozen_ensemble, tolerance=self.screening_tolerance)
+        ddt = np.zeros((n_coefficients, n_coefficients), dtype='float64')
+        dr = np.zeros(n_coefficients, dtype='float64')
+        for x, r, w in shards:
+            ddt_shard, dr_shard = self.accumulate_normal_equations(
+                x, r, 1.0 / n_training if w is None else w,
+                unfrozen_plan=unfrozen_plan, frozen_plan=frozen_plan,
+                memory_budget=memory_budget
+            )
+            ddt += ddt_shard
+            dr += dr_shard
 
         effective_gamma = self.regularization / n_coefficients
-        b[:n_coefficients, :n_coefficients] = 2 * (d * w).dot(d.T)
+        b[:n_coefficients, :n_coefficients] = 2 * ddt
         b[:n_coefficients, :n_coefficients] = b[:n_coefficients, :n_coefficients] + \
                                               2 * effective_gamma * np.identity(n_coefficients, dtype='float64')
 
@@ -745,10 +992,15 @@ class Molecule(A2MDBaseClass):
             b[n_coefficients + j, i] += xi.integral()
             b[i, n_coefficients + j] += xi.integral()
 
-        p[:n_coefficients] = 2 * (d * w).dot(r)
+        p[:n_coefficients] = 2 * dr
         p[n_coefficients:] = q
 
         c = np.linalg.solve(b, p)[:n_coefficients]
+        if loss == 'dkl':
+            c, dkl = self.dkl_optimize(
+                c, shards, unfrozen_plan, frozen_plan, unfrozen_map2center, frozen_map2center, charges,
+                effective_gamma
+            )
         mask = np.array(self.map_frozenfunctions)
         self.opt_params = np.ones(self.nfunctions, dtype='float64')
         self.opt_params[mask == False] = c
@@ -757,8 +1009,15 @@ class Molecule(A2MDBaseClass):
             integral += c * xi.integral()
         self.is_optimized = True
 
-        prediction = self.eval(training_coordinates)
-        loss = np.power((prediction - training_density), 2.0).sum()
+        if loss == 'dkl':
+            return dkl, self.opt_params.copy()
+
+        loss = 0.0
+        chunk_size = get_chunk_size(n_training, n_coefficients, memory_budget)
+        for x, r, _ in shards:
+            for start in range(0, x.shape[0], chunk_size):
+                prediction = self.eval(np.asarray(x[start:start + chunk_size, :], dtype='float64'))
+                loss += np.power((prediction - r[start:start + chunk_size]), 2.0).sum()
         return loss, self.opt_params.copy()
 
     def parametrize(self, param_dict=None):
@@ -789,6 +1048,7 @@ class Molecule(A2MDBaseClass):
 
         self.map_function2center = []
         self.functions = []
+        self.evaluation_plan = None
         self.function_names = []
         self.map_frozenfunctions = []
         self.function_types = []
@@ -885,6 +1145,7 @@ class Molecule(A2MDBaseClass):
         opt_params = np.array(opt_params, dtype='float64')
         self.opt_params = np.array(opt_params)
         self.functions = function_list
+        self.evaluation_plan = None
         self.map_function2center = map_fun2center
         self.map_frozenfunctions = map_funfrozen
         self.function_names = function_names
@@ -899,6 +1160,43 @@ class Molecule(A2MDBaseClass):
         """
         self.regularization = gamma
 
+    def set_ep_tolerance(self, tolerance):
+        """
+        radial terms of the electrostatic potential are interpolated from spline tables
+        with the given relative error, instead of evaluated exactly. The tolerance holds for
+        each term, so where terms cancel, the relative error of the potential may be larger.
+        Use None for exact evaluation.
+
+        :param tolerance:
+        :return:
+        """
+        self.ep_tolerance = tolerance
+        self.evaluation_plan = None
+
+    def set_multipole_theta(self, theta):
+        """
+        the electrostatic potential of distant groups of functions is evaluated from their
+        multipole expansion (charge, dipole, quadrupole). Smaller theta is more accurate,
+        theta = 0 is exact. Use None to always evaluate every function.
+
+        :param theta:
+        :return:
+        """
+        self.multipole_theta = theta
+        self.multipole_plan = None
+
+    def set_screening_tolerance(self, tolerance):
+        """
+        functions are skipped where their density is below tolerance. This makes
+        density evaluation and optimization scale linearly with the size of the
+        molecule. Use None to evaluate every function at every point.
+
+        :param tolerance:
+        :return:
+        """
+        self.screening_tolerance = tolerance
+        self.evaluation_plan = None
+
     def set_opt_coefficients(self, c):
         f = np.array(self.map_frozenfunctions)
         self.opt_params[f == False] = c
@@ -1008,7 +1306,7 @@ class Polymer(Molecule):
             except KeyError:
 
                 missing_keys.append((atom_resname, atom_name))
-                current_label = MAP_AN2SYMBOL[atomic_number]
+                current_label = get_symbol(atomic_number)
                 for fun in self.parametrization_default['_MODEL'][current_label]:
                     if fun['_CONNECT'] == '_NONE':
                         parameters.append(
@@ -1111,6 +1409,7 @@ class ConformerCollection(Molecule):
             raise RuntimeError("there is not conformer {:d}".format(i))
         current_coordinates = self.conformers[i]
         self.current_conformer = i
+        self.evaluation_plan = None
 
         for i, ((atom_idx, _, bond_idx), fun) in enumerate(zip(self.function_names, self.functions)):
             fun.coordinates = current_coordinates[atom_idx, :]
@@ -1123,15 +1422,25 @@ class ConformerCollection(Molecule):
         p = []
         for i, x_c in enumerate(x):
             self.parametrize_conformer(i)
-            p.append(np.zeros(x_c.shape[0], dtype="float64"))
-            for j, (c, fun) in enumerate(zip(self.opt_params, self.functions)):
-                p[-1] += c * fun.eval(x_c)
+            p.append(self.eval(x_c))
 
         return p
 
     def conformer_optimize(
-            self, training_coordinates, training_densities, optimization_mode='restricted'
+            self, training_coordinates, training_densities, optimization_mode='restricted',
+            memory_budget: int = None
     ):
+        """
+        optimizes the coefficients against the densities of all the conformers at the same time.
+        The normal equations of each conformer are accumulated in chunks (see Molecule.optimize),
+        so the design matrices of the conformers are never built nor concatenated.
+
+        :param training_coordinates: list of coordinates, one per conformer
+        :param training_densities: list of densities, one per conformer
+        :param optimization_mode: either restricted, unrestricted or semirestricted
+        :param memory_budget: maximum size (bytes) of the design matrix chunks
+        :return: coefficients
+        """
         if len(training_coordinates) != len(training_densities):
             raise RuntimeError(
                 "the number of conformer densities does not match the number of training coordinates")
@@ -1159,8 +1468,9 @@ class ConformerCollection(Molecule):
             j = frozen_map2center[i]
             q[j] -= frozen_fun.integral()
 
-        d = []
-        r = []
+        n_training = sum(ctd.shape[0] for ctd in training_densities)
+        ddt = np.zeros((n_coefficients, n_coefficients), dtype='float64')
+        dr = np.zeros(n_coefficients, dtype='float64')
         for i, (ctc, ctd) in enumerate(zip(training_coordinates, training_densities)):
 
             self.parametrize_conformer(i)
@@ -1169,28 +1479,17 @@ class ConformerCollection(Molecule):
             unfrozen_ensemble = [self.functions[i] for i in range(self.nfunctions) if
                                  not self.map_frozenfunctions[i]]
 
-            x = ctc.copy()
-            current_r = ctd.copy()
-
-            n_training = current_r.shape[0]
-
-            frozen_ensemble = SupportEnsemble(functions=frozen_ensemble, name='frozen_set')
-            current_r = current_r - frozen_ensemble.eval(x)
-
-            current_d = np.zeros((n_coefficients, n_training), dtype='float64')
-
-            for j, xi in enumerate(unfrozen_ensemble):
-                current_d[j, :] = xi.eval(x)
-
-            d.append(current_d)
-            r.append(current_r)
-
-        d = np.concatenate(d, axis=1)
-        r = np.concatenate(r, axis=0)
+            current_ddt, current_dr = self.accumulate_normal_equations(
+                ctc, ctd, 1.0 / n_training,
+                unfrozen_plan=EvaluationPlan(unfrozen_ensemble, tolerance=self.screening_tolerance),
+                frozen_plan=EvaluationPlan(frozen_ensemble, tolerance=self.screening_tolerance),
+                memory_budget=memory_budget
+            )
+            ddt += current_ddt
+            dr += current_dr
 
-        w = np.ones(d.shape[1], dtype='float64') / d.shape[1]
         effective_gamma = self.regularization / n_coefficients
-        b[:n_coefficients, :n_coefficients] = 2 * (d * w).dot(d.T)
+        b[:n_coefficients, :n_coefficients] = 2 * ddt
         b[:n_coefficients, :n_coefficients] = b[:n_coefficients, :n_coefficients] + \
                                               2 * effective_gamma * np.identity(n_coefficients, dtype='float64')
 
@@ -1199,7 +1498,7 @@ class ConformerCollection(Molecule):
             b[n_coefficients + j, i] += xi.integral()
             b[i, n_coefficients + j] += xi.integral()
 
-        p[:n_coefficients] = 2 * (d * w).dot(r)
+        p[:n_coefficients] = 2 * dr
         p[n_coefficients:] = q
 
         c = np.linalg.solve(b, p)[:n_coefficients]
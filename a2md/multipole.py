@@ -0,0 +1,361 @@
+import numpy as np
+from scipy.special import gamma
+from a2md.baseclass import A2MDBaseClass
+from a2md.evaluation import PLAN_BLOCK_SIZE, cell_partition
+from a2md.mathfunctions import generalized_exponential_radius
+
+MULTIPOLE_THETA = 0.3  # opening criterion: cells are expanded when seen under a ratio radius / distance below theta
+MULTIPOLE_LEAF_SIZE = 6.0  # edge of the leaf cells, in Bohr
+MULTIPOLE_EXTENT_TOLERANCE = 1e-8  # density below which support functions are considered to vanish
+ANGULAR_QUADRATURE_POINTS = 96
+
+
+def angular_moments(alpha, k):
+    """
+    2 pi int_0^pi exp(-alpha theta^2) P_k(cos theta) sin theta dtheta, for k = 0, 1, 2
+
+    :param alpha: exponents of the angular gaussians
+    :param k: order of the legendre polynomial
+    :return:
+    """
+    t, w = np.polynomial.legendre.leggauss(ANGULAR_QUADRATURE_POINTS)
+    theta = 0.5 * np.pi * (t + 1.0)
+    w = 0.5 * np.pi * w
+    u = np.cos(theta)
+    p = [np.ones(u.shape), u, 0.5 * (3 * (u * u) - 1)][k]
+    f = np.exp(-np.outer(np.asarray(alpha, dtype='float64'), theta * theta))
+    return 2 * np.pi * f.dot(w * p * np.sin(theta))
+
+
+def radial_moments(A, B, P, k):
+    """
+    int_0^inf A r^P exp(-B r) r^(2 + k) dr
+    """
+    return A * gamma(P + 3 + k) / np.power(B, P + 3 + k)
+
+
+def shift_moments(q, p, Q, a):
+    """
+    moves cartesian multipoles (charge, dipole, traceless quadrupole Q_ij = int rho (3 r_i r_j - r^2 d_ij))
+    by a displacement a, so they are referred to the point center - a
+
+    :param q: (n,) charges
+    :param p: (n, 3) dipoles
+    :param Q: (n, 3, 3) quadrupoles
+    :param a: (n, 3) displacements (old center - new center)
+    :return: q, p, Q
+    """
+    eye = np.identity(3, dtype='float64')
+    pa = (p * a).sum(axis=1)
+    aa = (a * a).sum(axis=1)
+    new_p = p + q[:, np.newaxis] * a
+    new_Q = Q + 3 * (p[:, :, np.newaxis] * a[:, np.newaxis, :] + a[:, :, np.newaxis] * p[:, np.newaxis, :])
+    new_Q = new_Q - 2 * pa[:, np.newaxis, np.newaxis] * eye
+    new_Q = new_Q + q[:, np.newaxis, np.newaxis] * (
+        3 * a[:, :, np.newaxis] * a[:, np.newaxis, :] - aa[:, np.newaxis, np.newaxis] * eye
+    )
+    return q, new_p, new_Q
+
+
+class MultipolePlan(A2MDBaseClass):
+
+    def __init__(
+            self, plan, coordinates, charges, theta=MULTIPOLE_THETA, leaf_size=MULTIPOLE_LEAF_SIZE,
+            tolerance=MULTIPOLE_EXTENT_TOLERANCE, block_size=PLAN_BLOCK_SIZE
+    ):
+        """
+        A2MD.multipole.MultipolePlan
+        ---
+        Barnes-Hut evaluation of the electrostatic potential of a model (nuclei and support functions).
+
+        Sources (support functions and nuclei) are binned in an octree of cubic cells, whose leaves have
+        an edge of leaf_size. Each source is described by its analytic charge, dipole and quadrupole: the
+        radial part of the moments is an incomplete gamma integral, and the angular part is either
+        trivial (radial and harmonic functions) or a quadrature over the angular gaussian.
+        Multipoles of the cells are built at evaluation time, since coefficients are given then.
+
+        Points are binned in cells of the same size as the leaves. For each of these cells, the tree
+        is walked from the root: a cell is used as a multipole when its radius divided by its distance
+        to the points is below theta, and the points lie beyond the extent of its functions (where their
+        density is below tolerance). Otherwise its children are opened, and the leaves that are too close
+        are evaluated exactly.
+
+        Smaller values of theta are more accurate and more expensive. theta = 0 is the exact sum.
+
+        :param plan: evaluation plan of the model functions
+        :param coordinates: nuclei coordinates (Bohr)
+        :param charges: nuclear charges
+        :param theta: opening criterion
+        :param leaf_size: edge of the leaf cells (Bohr)
+        :param tolerance: density below which a support function is considered to vanish
+        :param block_size: maximum number of point-source pairs evaluated at once
+        :type plan: EvaluationPlan
+        """
+        A2MDBaseClass.__init__(self, name='multipole plan', verbose=False)
+        self.plan = plan
+        self.theta = theta
+        self.leaf_size = leaf_size
+        self.block_size = block_size
+
+        # sources: packed functions of the plan, then nuclei
+
+        names = []
+        index = []
+        positions = []
+        extents = []
+        q_unit = []
+        p_unit = []
+        Q_unit = []
+        for name, g in plan.get_groups():
+            n = g['owner'].size
+            names += [name] * n
+            index.append(np.arange(n))
+            positions.append(g['centers'])
+            extents.append(generalized_exponential_radius(g['A'], g['B'], g['P'], tolerance))
+            q, p, Q = self.__unit_moments(name, g)
+            q_unit.append(q)
+            p_unit.append(p)
+            Q_unit.append(Q)
+
+        charges = np.asarray(charges, dtype='float64')
+        coordinates = np.asarray(coordinates, dtype='float64').reshape(-1, 3)
+        self.nfunctions = len(names)
+        self.charges = charges
+        self.nuclei_coordinates = coordinates
+        names += ['nuclei'] * charges.size
+        index.append(np.arange(charges.size))
+        positions.append(coordinates)
+        extents.append(np.zeros(charges.size, dtype='float64'))
+        q_unit.append(np.ones(charges.size, dtype='float64'))
+        p_unit.append(np.zeros((charges.size, 3), dtype='float64'))
+        Q_unit.append(np.zeros((charges.size, 3, 3), dtype='float64'))
+
+        names = np.array(names)
+        index = np.concatenate(index)
+        positions = np.concatenate(positions)
+        extents = np.concatenate(extents)
+        q_unit = np.concatenate(q_unit)
+        p_unit = np.concatenate(p_unit)
+        Q_unit = np.concatenate(Q_unit)
+
+        # octree. Level 0 are the leaves
+
+        self.origin = positions.min(axis=0) - 1e-6
+        keys = np.floor((positions - self.origin) / leaf_size).astype('int64')
+        self.levels = []
+        level_keys = keys
+        while True:
+            unique_keys, inverse = np.unique(level_keys, axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            size = leaf_size * (2 ** len(self.levels))
+            centers = self.origin + (unique_keys + 0.5) * size
+            radius = np.zeros(unique_keys.shape[0], dtype='float64')
+            extent = np.zeros(unique_keys.shape[0], dtype='float64')
+            if len(self.levels) == 0:
+                source_cell = inverse
+                d = np.linalg.norm(positions - centers[inverse, :], axis=1)
+                np.maximum.at(radius, inverse, d)
+                np.maximum.at(extent, inverse, d + extents)
+            else:
+                previous = self.levels[-1]
+                previous['parent'] = inverse
+                d = np.linalg.norm(previous['centers'] - centers[inverse, :], axis=1)
+                np.maximum.at(radius, inverse, d + previous['radius'])
+                np.maximum.at(extent, inverse, d + previous['extent'])
+            self.levels.append(dict(keys=unique_keys, centers=centers, radius=radius, extent=extent, parent=None))
+            if unique_keys.shape[0] == 1:
+                break
+            level_keys = unique_keys // 2
+
+        for k in range(1, len(self.levels)):
+            parent = self.levels[k - 1]['parent']
+            order = np.argsort(parent, kind='stable')
+            starts = np.searchsorted(parent[order], np.arange(self.levels[k]['keys'].shape[0] + 1))
+            self.levels[k]['children'] = [order[starts[i]:starts[i + 1]] for i in range(starts.size - 1)]
+
+        # unit moments of each source referred to its leaf center, sorted by leaf
+
+        order = np.argsort(source_cell, kind='stable')
+        self.source_order = order
+        self.source_cell = source_cell[order]
+        self.leaf_starts = np.searchsorted(self.source_cell, np.arange(self.levels[0]['keys'].shape[0] + 1))
+        a = positions[order] - self.levels[0]['centers'][self.source_cell, :]
+        self.q_unit, self.p_unit, self.Q_unit = shift_moments(q_unit[order], p_unit[order], Q_unit[order], a)
+        self.source_names = names[order]
+        self.source_index = index[order]
+
+        # exact evaluation of each leaf: indices of its sources within each group of the plan
+
+        self.leaf_active = []
+        for i in range(self.levels[0]['keys'].shape[0]):
+            sl = slice(self.leaf_starts[i], self.leaf_starts[i + 1])
+            leaf_names = self.source_names[sl]
+            leaf_index = self.source_index[sl]
+            self.leaf_active.append(
+                dict((name, leaf_index[leaf_names == name]) for name in np.unique(leaf_names))
+            )
+        self.log("{:d} sources in {:d} leaves and {:d} levels".format(
+            names.size, self.levels[0]['keys'].shape[0], len(self.levels)
+        ))
+
+    @staticmethod
+    def __unit_moments(name, g):
+        """
+        charge, dipole and quadrupole of each function of a group (with coefficient 1), referred to its center
+        """
+        n = g['owner'].size
+        p = np.zeros((n, 3), dtype='float64')
+        Q = np.zeros((n, 3, 3), dtype='float64')
+        if name == 'radial':
+            return radial_moments(g['A'], g['B'], g['P'], 0) * 4 * np.pi, p, Q
+
+        # axis of the angular part, as in polar_rep
+        w = g['frames'][:, 2, :]
+        ww = 3 * w[:, :, np.newaxis] * w[:, np.newaxis, :] - np.identity(3)[np.newaxis, :, :]
+        if name == 'angular':
+            q = radial_moments(g['A'], g['B'], g['P'], 0) * angular_moments(g['alpha'], 0)
+            m1 = radial_moments(g['A'], g['B'], g['P'], 1) * angular_moments(g['alpha'], 1)
+            m2 = radial_moments(g['A'], g['B'], g['P'], 2) * angular_moments(g['alpha'], 2)
+        elif name == 'harmonic':
+            l = g['l']
+            q = np.where(l == 0, radial_moments(g['A'], g['B'], g['P'], 0) * 4 * np.pi, 0.0)
+            m1 = np.where(l == 1, radial_moments(g['A'], g['B'], g['P'], 1) * 4 * np.pi / 3, 0.0)
+            m2 = np.where(l == 2, radial_moments(g['A'], g['B'], g['P'], 2) * 4 * np.pi / 5, 0.0)
+        else:
+            raise NotImplementedError("only radial, angular or harmonic support functions")
+        p = m1[:, np.newaxis] * w
+        Q = m2[:, np.newaxis, np.newaxis] * ww
+        return q, p, Q
+
+    def __moments(self, coefficients):
+        """
+        multipoles of every cell of every level for the given coefficients
+        """
+        weights = np.concatenate([
+            -coefficients[self.plan_owners()], self.charges
+        ])[self.source_order]
+        n_leaves = self.levels[0]['keys'].shape[0]
+        q = np.zeros(n_leaves, dtype='float64')
+        p = np.zeros((n_leaves, 3), dtype='float64')
+        Q = np.zeros((n_leaves, 3, 3), dtype='float64')
+        np.add.at(q, self.source_cell, weights * self.q_unit)
+        np.add.at(p, self.source_cell, weights[:, np.newaxis] * self.p_unit)
+        np.add.at(Q, self.source_cell, weights[:, np.newaxis, np.newaxis] * self.Q_unit)
+        moments = [(q, p, Q)]
+        for k in range(1, len(self.levels)):
+            parent = self.levels[k - 1]['parent']
+            a = self.levels[k - 1]['centers'] - self.levels[k]['centers'][parent, :]
+            sq, sp, sQ = shift_moments(q, p, Q, a)
+            n_cells = self.levels[k]['keys'].shape[0]
+            q = np.zeros(n_cells, dtype='float64')
+            p = np.zeros((n_cells, 3), dtype='float64')
+            Q = np.zeros((n_cells, 3, 3), dtype='float64')
+            np.add.at(q, parent, sq)
+            np.add.at(p, parent, sp)
+            np.add.at(Q, parent, sQ)
+            moments.append((q, p, Q))
+        return moments
+
+    def plan_owners(self):
+        """
+        model function owning each packed function of the plan, in the order of the sources
+        """
+        return np.concatenate([g['owner'] for _, g in self.plan.get_groups()] + [np.zeros(0, dtype='int64')])
+
+    def interactions(self, center, half_diagonal):
+        """
+        walks the tree for a cell of points
+
+        :param center: center of the cell of points
+        :param half_diagonal: half diagonal of the cell of points
+        :return: list of (level, far cells), near leaves
+        """
+        top = len(self.levels) - 1
+        frontier = np.arange(self.levels[top]['keys'].shape[0])
+        far = []
+        near = np.zeros(0, dtype='int64')
+        for k in range(top, -1, -1):
+            level = self.levels[k]
+            distance = np.linalg.norm(level['centers'][frontier, :] - center, axis=1) - half_diagonal
+            is_far = (level['radius'][frontier] < self.theta * distance) & (level['extent'][frontier] < distance)
+            if np.any(is_far):
+                far.append((k, frontier[is_far]))
+            opened = frontier[~is_far]
+            if k == 0:
+                near = opened
+            elif opened.size > 0:
+                frontier = np.concatenate([self.levels[k]['children'][i] for i in opened])
+            else:
+                break
+        return far, near
+
+    @staticmethod
+    def eval_multipoles(x, centers, q, p, Q):
+        """
+        potential of point multipoles
+
+        :param x: (n, 3) coordinates
+        :param centers: (m, 3) multipole centers
+        :param q: (m,) charges
+        :param p: (m, 3) dipoles
+        :param Q: (m, 3, 3) quadrupoles
+        :return: (n,) potential
+        """
+        rx = x[:, 0, np.newaxis] - centers[:, 0]
+        ry = x[:, 1, np.newaxis] - centers[:, 1]
+        rz = x[:, 2, np.newaxis] - centers[:, 2]
+        inv_r = 1.0 / np.sqrt(rx * rx + ry * ry + rz * rz)
+        inv_r2 = inv_r * inv_r
+        v = (p[:, 0] * rx + p[:, 1] * ry + p[:, 2] * rz) * inv_r2
+        quadrupole = Q[:, 0, 0] * rx * rx + Q[:, 1, 1] * ry * ry + Q[:, 2, 2] * rz * rz + \
+            2 * (Q[:, 0, 1] * rx * ry + Q[:, 0, 2] * rx * rz + Q[:, 1, 2] * ry * rz)
+        v += 0.5 * quadrupole * inv_r2 * inv_r2
+        v += q
+        return (v * inv_r).sum(axis=1)
+
+    def eval(self, x, coefficients):
+        """
+        electrostatic potential (nuclei minus electrons)
+
+        :param x: cartesian coordinates (Bohr)
+        :param coefficients: one coefficient per model function (Molecule.opt_params)
+        :return: potential (Ha)
+        """
+        coefficients = np.asarray(coefficients, dtype='float64')
+        moments = self.__moments(coefficients)
+        y = np.zeros(x.shape[0], dtype='float64')
+        for idx, center, half_diagonal in cell_partition(x, self.leaf_size):
+            far, near = self.interactions(center, half_diagonal)
+
+            if len(far) > 0:
+                centers = np.concatenate([self.levels[k]['centers'][cells, :] for k, cells in far])
+                q = np.concatenate([moments[k][0][cells] for k, cells in far])
+                p = np.concatenate([moments[k][1][cells, :] for k, cells in far])
+                Q = np.concatenate([moments[k][2][cells, :, :] for k, cells in far])
+                chunk = max(1, self.block_size // centers.shape[0])
+                for start in range(0, idx.size, chunk):
+                    sel = idx[start:start + chunk]
+                    y[sel] += self.eval_multipoles(x[sel, :], centers, q, p, Q)
+
+            if near.size > 0:
+                active = dict()
+                for i in near:
+                    for name, sel in self.leaf_active[i].items():
+                        active.setdefault(name, []).append(sel)
+                active = dict((name, np.concatenate(sel)) for name, sel in active.items())
+                nuclei = active.pop('nuclei', np.zeros(0, dtype='int64'))
+                active = list(active.items())
+                n_active = max(1, sum(sel.size for _, sel in active) + nuclei.size)
+                chunk = max(1, self.block_size // n_active)
+                for start in range(0, idx.size, chunk):
+                    sel = idx[start:start + chunk]
+                    xb = x[sel, :]
+                    y[sel] -= self.plan.eval_selection(xb, coefficients, active, kind='ep')
+                    if nuclei.size > 0:
+                        r = self.nuclei_coordinates[nuclei, :]
+                        d = np.sqrt(((xb[:, np.newaxis, :] - r[np.newaxis, :, :]) ** 2).sum(axis=2)) + 1e-18
+                        y[sel] += (self.charges[nuclei] / d).sum(axis=1)
+
+        for owner, fun in self.plan.others:
+            y -= coefficients[owner] * fun.eval_ep(x)
+        return y
@@ -3,7 +3,7 @@ import numpy as np
 from a2md.mathfunctions import get_polar_rep
 from a2md.mathfunctions import generalized_exponential, generalized_exponential_integral
 from a2md.mathfunctions import gaussian, angular_gaussian_integral
-from a2md.mathfunctions import electrostatic_potential_xexp_gaussian
+from a2md.mathfunctions import electrostatic_potential_xexp_gaussian_factorized, ep_xg_angular_constants
 from a2md.mathfunctions import spherical_harmonic, pe_harmonic
 
 
@@ -198,6 +198,7 @@ class SupportAngular(Support):
         self.eval_method = self.__eval_trigo
         self.integral_method = self.__integral_trigo
         self.eval_ep_method = self.__eval_ep_ag
+        self.__ep_constants = None
         self.params_kw = ['alpha', 'B', 'A']
         if 'P' in kwargs.keys():
             self.params_kw.append('P')
@@ -224,8 +225,10 @@ class SupportAngular(Support):
         if self.coordinate_system is None:
             raise RuntimeError("reference frame was not created. can not calculate angular function")
         else:
+            if self.__ep_constants is None:
+                self.__ep_constants = ep_xg_angular_constants(self.__alpha)
             z, d = get_polar_rep(x, center=self.coordinates, ref_frame=self.coordinate_system)
-            u = electrostatic_potential_xexp_gaussian(self.__B, self.__alpha, d, z)
+            u = electrostatic_potential_xexp_gaussian_factorized(self.__B, self.__ep_constants, d, z)
             return u * self.__A
 
 
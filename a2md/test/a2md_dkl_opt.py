@@ -0,0 +1,45 @@
+from a2md.models import a2md_from_mol, dkl_terms
+from a2md.integrate import BeckeGrid
+from a2mdio.molecules import Mol2
+from a2mdtest.a2mdtests import benzene
+import numpy as np
+import time
+
+if __name__ == "__main__":
+
+    print("a2md/dkl optimization")
+    print("---")
+    m = Mol2(file=benzene.mol2)
+    reference = a2md_from_mol(m)
+    reference.parametrize(reference.parametrization_extended)
+    reference.opt_params = np.random.rand(reference.nfunctions) * 0.5 + 0.5
+
+    mg = BeckeGrid(m.get_coordinates(units='au'), m.get_atomic_numbers(), tolerance=1e-4)
+    r = reference.eval(mg.points)
+    positive = r > 0
+    # the divergence only bounds from below when both densities hold the same charge on the grid
+    charge = m.get_absolute_charges().sum()
+    r *= charge / (mg.weights[positive] * r[positive]).sum()
+
+    dm = a2md_from_mol(m)
+    dm.parametrize()
+    start = time.time()
+    dm.optimize(mg.points, r, weights=mg.weights, optimization_mode='restricted')
+    time_mse = time.time() - start
+    rho = dm.eval(mg.points)
+    dkl_mse = (mg.weights[positive] * dkl_terms(rho[positive], r[positive])[0]).sum()
+
+    start = time.time()
+    dkl, c = dm.optimize(mg.points, r, weights=mg.weights, optimization_mode='restricted', loss='dkl')
+    time_dkl = time.time() - start
+    rho = dm.eval(mg.points)
+    print("mse fit dkl {:12.6e} TE {:8.4f} | dkl fit dkl {:12.6e} TE {:8.4f}".format(
+        dkl_mse, time_mse, dkl, time_dkl
+    ))
+    grid_charge = (mg.weights[positive] * rho[positive]).sum()
+    print("charge {:12.6f} grid charge {:12.6f}".format(dm.integrate(), grid_charge))
+    assert 0.0 <= dkl < dkl_mse
+    assert np.isclose(grid_charge, charge, rtol=1e-10)
+    assert np.isclose(dm.integrate(), charge, rtol=1e-3)
+    assert np.isclose(dkl, (mg.weights[positive] * dkl_terms(rho[positive], r[positive])[0]).sum())
+    print("DONE")
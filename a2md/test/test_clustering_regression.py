@@ -0,0 +1,52 @@
+from a2md.utils import RBFSymmetryCluster
+from a2md.models import a2md_from_mol
+from a2mdio.molecules import Mol2
+from a2mdtest.a2mdtests import benzene
+import numpy as np
+
+# clusters and ensembles of benzene, as produced by the implementation before indexing the bookkeeping
+ATOM_CLUSTERS = [[0, 1, 2, 3, 4, 5], [6, 7, 8, 9, 10, 11]]
+BOND_CLUSTERS = [[0, 0], [0, 1], [1, 0]]
+FUNCTION_NAMES = [
+    [0, 'ENS_CR'], [0, 'ENS_CVR'], [0, 'ENS_VR'], [1, 'ENS_hVR'],
+    [0, 'ENS_B01', 0], [0, 'ENS_B02', 0], [0, 'ENS_B01', 1], [0, 'ENS_B02', 1], [1, 'ENS_B01', 0], [1, 'ENS_B02', 0]
+]
+MAP_FUNCTION2CENTER = [0, 0, 0, 1, 0, 0, 0, 0, 1, 1]
+CARBONS = [0, 1, 2, 3, 4, 5]
+HYDROGENS = [6, 7, 8, 9, 10, 11]
+ENSEMBLE_MEMBERS = [
+    (CARBONS, [None] * 6), (CARBONS, [None] * 6), (CARBONS, [None] * 6), (HYDROGENS, [None] * 6),
+    ([0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5], [1, 5, 0, 2, 1, 3, 2, 4, 3, 5, 0, 4]),
+    ([0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5], [1, 5, 0, 2, 1, 3, 2, 4, 3, 5, 0, 4]),
+    (CARBONS, HYDROGENS), (CARBONS, HYDROGENS), (HYDROGENS, CARBONS), (HYDROGENS, CARBONS)
+]
+
+if __name__ == "__main__":
+
+    print("a2md/clustering regression")
+    print("---")
+    m = Mol2(file=benzene.mol2)
+    dm = a2md_from_mol(m)
+    dm.parametrize()
+    atom_charges = np.array(dm.atom_charges, dtype='float64')
+
+    rbf = RBFSymmetryCluster()
+    clusters = []
+
+    def clusterizer(labels, topology, coordinates):
+        sa, sb = rbf.cluster(labels, topology, coordinates)
+        clusters.append((sa, sb))
+        return sa, sb
+
+    dm.clustering(clusterizer)
+    sa, sb = clusters[0]
+    print("atom clusters {:d} bond clusters {:d} ensembles {:d}".format(len(sa), len(sb), dm.nfunctions))
+    assert [[int(i) for i in cluster] for cluster in sa] == ATOM_CLUSTERS
+    assert [[int(i) for i in cluster] for cluster in sb] == BOND_CLUSTERS
+    assert [list(name) for name in dm.function_names] == FUNCTION_NAMES
+    assert [int(i) for i in dm.map_function2center] == MAP_FUNCTION2CENTER
+    for fun, (atoms, bonds) in zip(dm.functions, ENSEMBLE_MEMBERS):
+        assert [int(i) for i in fun.map2atoms] == atoms
+        assert [None if i is None else int(i) for i in fun.map2bonds] == bonds
+    assert np.allclose(dm.atom_charges, [atom_charges[cluster].sum() for cluster in ATOM_CLUSTERS])
+    print("DONE")
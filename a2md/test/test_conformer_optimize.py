@@ -0,0 +1,42 @@
+from a2md.models import a2md_from_mol, ConformerCollection
+from a2mdio.molecules import Mol2
+from a2mdtest.a2mdtests import benzene
+import numpy as np
+
+if __name__ == "__main__":
+
+    print("a2md/conformer optimization")
+    print("---")
+    np.random.seed(42)
+    m = Mol2(file=benzene.mol2)
+    dm = a2md_from_mol(m)
+    dm.parametrize()
+
+    training_coords = np.random.randn(5000, 3) * 2.5
+    training_density = np.zeros(training_coords.shape[0])
+    for fun in dm.functions:
+        training_density += np.random.rand() * fun.eval(training_coords)
+    _, c_molecule = dm.optimize(
+        training_coordinates=training_coords, training_density=training_density,
+        optimization_mode='restricted'
+    )
+
+    # the second conformer is the first one translated, sampled at the translated points
+    shift = np.array([1.5, -0.5, 2.0])
+    conformers = ConformerCollection(
+        coordinates=[dm.coordinates, dm.coordinates + shift], atomic_numbers=dm.atomic_numbers,
+        charge=dm.atom_charges, topology=dm.topology, segments=dm.segments
+    )
+    conformers.parametrize()
+    c_conformers = conformers.conformer_optimize(
+        training_coordinates=[training_coords, training_coords + shift],
+        training_densities=[training_density, training_density],
+        optimization_mode='restricted', memory_budget=2 ** 18
+    )
+    print("max coefficient difference : {:12.6e}".format(np.abs(c_molecule - c_conformers).max()))
+    assert np.allclose(c_molecule, c_conformers, rtol=1e-8, atol=1e-10)
+    assert np.isclose(conformers.integrate(), dm.integrate(), rtol=1e-10)
+
+    predictions = conformers.eval_conformers([training_coords, training_coords + shift])
+    assert np.allclose(predictions[0], predictions[1], rtol=1e-8, atol=1e-12)
+    print("DONE")
@@ -0,0 +1,51 @@
+from a2md.models import a2md_from_mol
+from a2md.mathfunctions import electrostatic_potential_xexp_gaussian
+from a2md.mathfunctions import electrostatic_potential_xexp_gaussian_factorized, ep_xg_angular_constants
+from a2mdio.molecules import Mol2
+from a2mdtest.a2mdtests import benzene
+import numpy as np
+import time
+
+if __name__ == "__main__":
+
+    print("a2md/ep kernels")
+    print("---")
+    d = np.linspace(0.0, 12.0, 1000)
+    z = np.linspace(0.0, np.pi, 1000)
+    for alpha in [0.5, 1.5, 4.0]:
+        reference = electrostatic_potential_xexp_gaussian(2.1, alpha, d, z)
+        factorized = electrostatic_potential_xexp_gaussian_factorized(2.1, ep_xg_angular_constants(alpha), d, z)
+        print("alpha {:4.2f} factorized max abs error {:12.4e}".format(alpha, np.abs(reference - factorized).max()))
+        assert np.allclose(reference, factorized, rtol=1e-12, atol=1e-14)
+
+    np.random.seed(42)
+    m = Mol2(file=benzene.mol2)
+    x = np.random.randn(20000, 3) * 3.0
+    for scheme in ['parametrization_default', 'parametrization_harmonic', 'parametrization_extended']:
+        dm = a2md_from_mol(m)
+        dm.parametrize(getattr(dm, scheme))
+        dm.opt_params = np.random.rand(dm.nfunctions)
+        start = time.time()
+        dm.eval(x, kind='density')
+        time_density = time.time() - start
+        start = time.time()
+        reference = dm.eval(x, kind='ep')
+        time_exact = time.time() - start
+        # each tabulated term carries at most the tolerance as relative error, so the error of the
+        # potential is bounded by the tolerance times the sum of the magnitudes of its terms
+        scale = np.abs(dm.eval_nuclear_potential(x))
+        for c, fun in zip(dm.opt_params, dm.functions):
+            scale += np.abs(c * fun.eval_ep(x))
+        for tolerance in [1e-6, 1e-10]:
+            dm.set_ep_tolerance(tolerance)
+            dm.eval(x[:10], kind='ep')
+            start = time.time()
+            tabulated = dm.eval(x, kind='ep')
+            time_table = time.time() - start
+            error = (np.abs(tabulated - reference) / scale).max()
+            print("{:26s} tolerance {:8.1e} max rel error {:12.4e} TE density {:8.4f} ep {:8.4f} tabulated {:8.4f}".format(
+                scheme, tolerance, error, time_density, time_exact, time_table
+            ))
+            assert error < tolerance
+        dm.set_ep_tolerance(None)
+    print("DONE")
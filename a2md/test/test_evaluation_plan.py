@@ -0,0 +1,45 @@
+from a2md.models import a2md_from_mol
+from a2md.utils import RBFSymmetryCluster
+from a2mdio.molecules import Mol2
+from a2mdtest.a2mdtests import benzene
+import numpy as np
+
+if __name__ == "__main__":
+
+    print("a2md/evaluation plan")
+    print("---")
+    m = Mol2(file=benzene.mol2)
+    x = np.random.randn(1000, 3) * 3.0
+
+    for scheme in ['parametrization_default', 'parametrization_harmonic', 'parametrization_extended']:
+        for use_cluster in [False, True]:
+            dm = a2md_from_mol(m)
+            dm.parametrize(getattr(dm, scheme))
+            if use_cluster:
+                dm.clustering(RBFSymmetryCluster(verbose=False).cluster)
+            dm.opt_params = np.random.rand(dm.nfunctions)
+
+            for kind in ['density', 'ep']:
+                reference = np.zeros(x.shape[0])
+                for sup, c in zip(dm.functions, dm.opt_params):
+                    if kind == 'density':
+                        reference += c * sup.eval(x)
+                    else:
+                        reference -= c * sup.eval_ep(x)
+                if kind == 'ep':
+                    reference += dm.eval_nuclear_potential(x)
+
+                prediction = dm.eval(x, kind=kind)
+                error = np.abs(prediction - reference).max()
+                print("{:26s} cluster:{:d} {:8s} max abs error {:12.4e}".format(scheme, use_cluster, kind, error))
+                assert np.allclose(prediction, reference, rtol=1e-10, atol=1e-12)
+
+            reference = dm.eval(x, kind='density')
+            dm.set_screening_tolerance(1e-12)
+            screened = dm.eval(x, kind='density')
+            error = np.abs(screened - reference).max()
+            print("{:26s} cluster:{:d} screened max abs error {:12.4e}".format(scheme, use_cluster, error))
+            assert error < 1e-12 * dm.nfunctions * np.abs(dm.opt_params).max()
+            dm.set_screening_tolerance(None)
+
+    print("DONE")
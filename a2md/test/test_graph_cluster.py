@@ -0,0 +1,30 @@
+from a2md.models import a2md_from_mol
+from a2md.utils import RBFSymmetryCluster, GraphHashCluster
+from a2md.utils import convert_connectivity_tree_to_pairs
+from a2mdio.molecules import Mol2
+from a2mdtest.a2mdtests import benzene
+import numpy as np
+
+if __name__ == "__main__":
+
+    print("a2md/graph hash cluster")
+    print("---")
+    m = Mol2(file=benzene.mol2)
+    dm = a2md_from_mol(m)
+    dm.parametrize()
+    args = (dm.get_symbols(), convert_connectivity_tree_to_pairs(dm.get_topology()), dm.get_coordinates())
+    sa_rbf, sb_rbf = RBFSymmetryCluster(verbose=False).cluster(*args)
+    for tool in [GraphHashCluster(verbose=False), GraphHashCluster(distance_bin=0.1, verbose=False)]:
+        sa, sb = tool.cluster(*args)
+        print("atom clusters : ", sa)
+        print("bond clusters : ", sb)
+        assert sa == sa_rbf
+        assert sb == sb_rbf
+
+    dm.clustering(GraphHashCluster(verbose=False).cluster)
+    x = np.random.randn(1000, 3) * 2.5
+    dm.opt_params = np.random.rand(dm.nfunctions)
+    y = dm.eval(x)
+    dm.optimize(x, y)
+    print("fitted {:d} clustered functions".format(dm.nfunctions))
+    print("DONE")
@@ -0,0 +1,102 @@
+from a2md.integrate import pi_lebedev, pi_lebedev_m, split_space, voronoi
+from a2md.integrate import MolecularGrid, get_molecular_grid, integrate_density_functional
+from a2md.integrate import integrate_density_functional_gradient, BeckeGrid
+from a2md.integrate import density_report, mse_functional, kinetic_energy_functional
+from a2md.models import a2md_from_mol
+from a2mdio.molecules import Mol2
+from a2mdtest.a2mdtests import benzene
+import numpy as np
+import tempfile
+import time
+import os
+
+if __name__ == "__main__":
+
+    print("a2md/molecular grid")
+    print("---")
+    m = Mol2(file=benzene.mol2)
+    dm = a2md_from_mol(m)
+    dm.parametrize()
+    dm.opt_params = np.random.rand(dm.nfunctions)
+
+    start = time.time()
+    reference = 0.0
+    for fx in split_space(m, dm.eval):
+        reference += pi_lebedev(fx, radial_res=100, grid='coarse')
+    time_shells = time.time() - start
+
+    start = time.time()
+    integral = integrate_density_functional(dm.eval, m, grid='coarse', res=100)
+    time_grid = time.time() - start
+    print("shells {:16.10f} grid {:16.10f} TE shells {:8.4f} grid {:8.4f}".format(
+        reference, integral, time_shells, time_grid
+    ))
+    assert np.isclose(reference, integral, rtol=1e-10)
+
+    # several outputs at once, as in the gradients
+    r = m.get_coordinates(units='au')
+    fun = lambda x: np.stack([dm.functions[i].eval(x) for i in range(3)], axis=1)
+    reference = np.zeros(3)
+    for i in range(r.shape[0]):
+        fx = lambda x: fun(x + r[i, :]) * (voronoi(x + r[i, :], r) == i).reshape(-1, 1)
+        reference += pi_lebedev_m(fx, 3, radial_res=50, grid='coarse')
+    integral = integrate_density_functional_gradient(fun, m, nfuns=3, grid='coarse', res=50)
+    print("gradient max abs error {:12.4e}".format(np.abs(reference - integral).max()))
+    assert np.allclose(reference, integral, rtol=1e-10)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        mg = get_molecular_grid(m, grid='medium', res=50, cache=tmp)
+        assert len(os.listdir(tmp)) == 1
+        cached = get_molecular_grid(m, grid='medium', res=50, cache=tmp)
+        assert isinstance(cached, MolecularGrid)
+        assert np.array_equal(mg.points, cached.points) and np.array_equal(mg.weights, cached.weights)
+        print("cached grid, {:d} points".format(cached.get_number_points()))
+
+        # becke grids come back from the cache as becke grids, with their level and tolerance
+        mg = get_molecular_grid(m, grid='becke', cache=tmp, tolerance=1e-4)
+        cached = get_molecular_grid(m, grid='becke', cache=tmp, tolerance=1e-4)
+        assert isinstance(cached, BeckeGrid)
+        assert cached.level == mg.level and cached.tolerance == mg.tolerance
+        assert np.array_equal(mg.points, cached.points) and np.array_equal(mg.weights, cached.weights)
+        assert np.isclose(cached.integrate(cached.probe), mg.integrate(mg.probe), rtol=1e-12)
+        cached.build(m.get_coordinates(units='au'), m.get_atomic_numbers())
+        assert np.array_equal(mg.points, cached.points)
+
+    # fuzzy cells, against the analytic charge of the model
+    charge = dm.integrate()
+    voronoi_grid = get_molecular_grid(m, grid='coarse', res=100)
+    becke_grid = BeckeGrid(m.get_coordinates(units='au'), m.get_atomic_numbers(), tolerance=1e-4)
+    for label, mg in [('voronoi', voronoi_grid), ('becke', becke_grid)]:
+        error = abs(mg.integrate(dm.eval) - charge)
+        print("{:8s} {:8d} points charge error {:12.4e}".format(label, mg.get_number_points(), error))
+    assert abs(becke_grid.integrate(becke_grid.probe) - m.get_atomic_numbers().sum()) < 1e-4
+    assert abs(becke_grid.integrate(dm.eval) - charge) < 1e-3
+    assert becke_grid.get_number_points() < voronoi_grid.get_number_points()
+
+    # single pass report, against the functionals integrated one by one
+    candidate = a2md_from_mol(m)
+    candidate.parametrize()
+    # only the isotropic functions, so that the density is non negative everywhere
+    isotropic = np.array([not f.is_anisotropic() for f in candidate.functions])
+    candidate.opt_params = dm.opt_params * 1.05 * isotropic
+    report = density_report(becke_grid, dm.eval, candidate.eval)
+    mse = becke_grid.integrate(mse_functional(dm.eval, candidate.eval))
+    kinetic = becke_grid.integrate(kinetic_energy_functional(candidate.eval))
+    print("report mse {:12.6e} kinetic {:12.6e}".format(report['mse'], report['candidate_kinetic']))
+    assert np.isclose(report['mse'], mse, rtol=1e-10)
+    assert kinetic > 0.0
+    assert np.isclose(report['candidate_kinetic'], kinetic, rtol=1e-10)
+    assert np.isclose(sum(report['atoms']['reference_charge']), report['reference_charge'], rtol=1e-10)
+
+    # with the anisotropic functions, the candidate goes negative: mlse and dkl leave those points out
+    candidate.opt_params = dm.opt_params * 1.05
+    candidate.opt_params[~isotropic] *= 10.0
+    report = density_report(becke_grid, dm.eval, candidate.eval)
+    negative = (candidate.eval(becke_grid.points) <= 0) | (dm.eval(becke_grid.points) <= 0)
+    print("report dkl {:12.6e} excluded points {:d}".format(report['dkl'], report['dkl_excluded']))
+    assert report['dkl_excluded'] == negative.sum() > 0
+    assert sum(report['atoms']['dkl_excluded']) == report['dkl_excluded']
+    for name, value in report.items():
+        if name != 'atoms':
+            assert np.isfinite(value) and np.all(np.isfinite(report['atoms'][name])), name
+    print("DONE")
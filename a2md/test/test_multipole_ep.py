@@ -0,0 +1,47 @@
+from a2md.models import a2md_from_mol, Molecule
+from a2mdio.molecules import Mol2
+from a2mdtest.a2mdtests import benzene
+import numpy as np
+import time
+
+if __name__ == "__main__":
+
+    print("a2md/multipole ep")
+    print("---")
+    m = Mol2(file=benzene.mol2)
+    b = a2md_from_mol(m)
+    coordinates = m.get_coordinates(units='au')
+    n_atoms = coordinates.shape[0]
+
+    # 8 benzene molecules on a 2x2x2 lattice, 12 Bohr apart
+    shifts = [np.array([12.0 * (i % 2), 12.0 * ((i // 2) % 2), 12.0 * (i // 4)]) for i in range(8)]
+    dm = Molecule(
+        coordinates=np.concatenate([coordinates + s for s in shifts]),
+        atomic_numbers=np.tile(b.atomic_numbers, 8),
+        charge=np.tile(b.atom_charges, 8),
+        topology=[[j + i * n_atoms for j in t] for i in range(8) for t in b.topology],
+        atom_labels=m.get_symbols() * 8
+    )
+    dm.parametrize(dm.parametrization_extended)
+    dm.opt_params = np.random.rand(dm.nfunctions)
+
+    low = dm.coordinates.min(axis=0) - 4.0
+    high = dm.coordinates.max(axis=0) + 4.0
+    x = np.random.rand(20000, 3) * (high - low) + low
+
+    start = time.time()
+    reference = dm.eval(x, kind='ep')
+    time_exact = time.time() - start
+    for theta, tolerance in [(0.0, 1e-12), (0.3, 1e-3), (0.5, 5e-3)]:
+        dm.set_multipole_theta(theta)
+        dm.get_multipole_plan()
+        start = time.time()
+        prediction = dm.eval(x, kind='ep')
+        time_multipole = time.time() - start
+        error = np.abs(prediction - reference).max() / np.abs(reference).max()
+        print("theta {:4.2f} max rel error {:12.4e} TE exact {:8.4f} multipole {:8.4f}".format(
+            theta, error, time_exact, time_multipole
+        ))
+        assert error < tolerance
+    dm.set_multipole_theta(None)
+    print("DONE")
@@ -0,0 +1,50 @@
+from a2md.models import a2md_from_mol
+from a2mdio.molecules import Mol2
+from a2mdtest.a2mdtests import benzene
+import numpy as np
+import tempfile
+import os
+
+if __name__ == "__main__":
+
+    print("a2md/streaming optimization")
+    print("---")
+    m = Mol2(file=benzene.mol2)
+    dm = a2md_from_mol(m)
+    dm.parametrize(dm.parametrization_extended)
+
+    training_coords = np.random.randn(5000, 3) * 2.5
+    training_density = np.zeros(training_coords.shape[0])
+    for fun in dm.functions:
+        training_density += np.random.rand() * fun.eval(training_coords)
+
+    loss_full, c_full = dm.optimize(
+        training_coordinates=training_coords, training_density=training_density,
+        optimization_mode='restricted'
+    )
+    # 256 KB budget, the design matrix is accumulated over tens of chunks
+    loss_chunk, c_chunk = dm.optimize(
+        training_coordinates=training_coords, training_density=training_density,
+        optimization_mode='restricted', memory_budget=2 ** 18
+    )
+    print("loss full : {:12.6e} chunked : {:12.6e}".format(loss_full, loss_chunk))
+    print("max coefficient difference : {:12.6e}".format(np.abs(c_full - c_chunk).max()))
+    assert np.allclose(c_full, c_chunk, rtol=1e-8, atol=1e-10)
+
+    # the same sample, stored as two memory-mapped npy shards
+    with tempfile.TemporaryDirectory() as tmp:
+        shards = []
+        for i, idx in enumerate(np.array_split(np.arange(training_coords.shape[0]), 2)):
+            shard_file = os.path.join(tmp, "shard_{:d}.npy".format(i))
+            np.save(shard_file, np.concatenate([training_coords[idx], training_density[idx, np.newaxis]], axis=1))
+            shards.append(np.load(shard_file, mmap_mode='r'))
+        loss_shard, c_shard = dm.optimize(
+            training_coordinates=[s[:, :3] for s in shards], training_density=[s[:, 3] for s in shards],
+            optimization_mode='restricted', memory_budget=2 ** 18
+        )
+        del shards
+    print("loss sharded : {:12.6e}".format(loss_shard))
+    print("max coefficient difference : {:12.6e}".format(np.abs(c_full - c_shard).max()))
+    assert np.allclose(c_full, c_shard, rtol=1e-8, atol=1e-10)
+    assert np.isclose(loss_full, loss_shard, rtol=1e-8)
+    print("DONE")
@@ -19,10 +19,13 @@ def set_nearest_atom(points, coordinates):
 
 def convert_connectivity_tree_to_pairs(connectivity_tree):
     pairs = []
+    seen = set()
     for i, item1 in enumerate(connectivity_tree):
         for j, item2 in enumerate(item1):
-            if sorted([i, item2]) not in pairs:
-                pairs.append(sorted([i, item2]))
+            pair = (min(i, item2), max(i, item2))
+            if pair not in seen:
+                seen.add(pair)
+                pairs.append(list(pair))
     return pairs
 
 
@@ -100,6 +103,31 @@ def integrate_from_old_dict(fun):
         return v
 
 
+def bond_clusters(sa, topology):
+    """
+    pairs of atom clusters joined by at least one bond, in both directions,
+    sorted by the index of the first and second cluster
+
+    :param sa: list of atom clusters
+    :param topology: list of bonds (pairs of atoms)
+    :return: list of pairs of cluster indices
+    """
+    atom2cluster = dict()
+    for cidx, cluster in enumerate(sa):
+        for atom_idx in cluster:
+            atom2cluster[atom_idx] = cidx
+    sb = set()
+    for b in topology:
+        try:
+            c0 = atom2cluster[b[0]]
+            c1 = atom2cluster[b[1]]
+        except KeyError:
+            continue
+        sb.add((c0, c1))
+        sb.add((c1, c0))
+    return [[c0, c1] for c0, c1 in sorted(sb)]
+
+
 class ClusterTool(A2MDBaseClass):
     def __init__(self, name, verbose=False):
         A2MDBaseClass.__init__(self, name="cluter tool / {:s}".format(name), verbose=verbose)
@@ -148,25 +176,18 @@ class RBFSymmetryCluster(ClusterTool):
         """
         from sklearn.cluster import AgglomerativeClustering
         # order by elements
-        natoms = len(labels)
+        labels = np.array(labels)
         present_elements = np.unique(labels)
         sa = []
-        sb = []
         for i, element in enumerate(present_elements):
 
-            index = []
-            current_coordinates = []
+            index = np.where(labels == element)[0].tolist()
 
-            for j in range(natoms):
-                if labels[j] == element:
-                    current_coordinates.append(coordinates[j, :])
-                    index.append(j)
-
-            if len(current_coordinates) == 1:
+            if len(index) == 1:
                 sa.append([index[0]])
                 continue
 
-            current_coordinates = np.array(current_coordinates, dtype="float64")
+            current_coordinates = np.array(coordinates[index, :], dtype="float64")
             rbf_values = self.rbf(current_coordinates, coordinates)
 
             atom_cluster = AgglomerativeClustering(
@@ -176,28 +197,80 @@ class RBFSymmetryCluster(ClusterTool):
             cluster_labels = atom_cluster.labels_
             all_clusters = np.unique(cluster_labels)
             for lab in all_clusters:
+                sa.append([index[j] for j in np.where(cluster_labels == lab)[0]])
+
+        sb = bond_clusters(sa, topology)
+        return sa, sb
+
+
+class GraphHashCluster(ClusterTool):
+
+    def __init__(self, iterations=None, distance_bin=None, verbose=False):
+        """
+        GraphHashCluster
+        ---
+        finds equivalent atoms by iterative refinement of atom colors (Weisfeiler-Lehman hashing).
+        Atoms start colored by their element. At each iteration, the new color of an atom is
+        given by its color and the multiset of colors of its bonded neighbours. Refinement stops
+        when the partition does not change, so the cost is linear in the number of bonds per iteration.
+
+        :param iterations: maximum number of refinement iterations. None to refine until convergence
+        :param distance_bin: when given (bohr), bond distances are binned and used as part of the
+        neighbour colors
+        """
+        ClusterTool.__init__(self, name="Graph hash cluster", verbose=verbose)
+        self.iterations = iterations
+        self.distance_bin = distance_bin
+        self.cluster_method = self.graph_clustering
+
+    def graph_clustering(self, labels, topology, coordinates):
+        """
+
+        :param labels: element of each atom
+        :param topology: list of bonds (pairs of atoms)
+        :param coordinates: atom coordinates
+        :return: atom clusters, bond clusters
+        """
+        natoms = len(labels)
+        neighbours = [[] for _ in range(natoms)]
+        for b0, b1 in topology:
+            if self.distance_bin is None:
+                edge_label = 0
+            else:
+                d = np.linalg.norm(coordinates[b0, :] - coordinates[b1, :])
+                edge_label = int(np.round(d / self.distance_bin))
+            neighbours[b0].append((b1, edge_label))
+            neighbours[b1].append((b0, edge_label))
+
+        elements = {element: k for k, element in enumerate(sorted(set(labels)))}
+        colors = [elements[label] for label in labels]
+        n_colors = len(elements)
+        iteration = 0
+        while self.iterations is None or iteration < self.iterations:
+            palette = dict()
+            new_colors = []
+            for i in range(natoms):
+                signature = (colors[i], tuple(sorted((colors[j], e) for j, e in neighbours[i])))
+                new_colors.append(palette.setdefault(signature, len(palette)))
+            iteration += 1
+            # refinement only splits classes, so the same number of colors means convergence
+            if len(palette) == n_colors:
+                break
+            colors = new_colors
+            n_colors = len(palette)
+        self.log("{:d} classes after {:d} iterations".format(n_colors, iteration))
+
+        # clusters are sorted by element, then by first atom
+        sa = []
+        color2cluster = dict()
+        order = sorted(range(natoms), key=lambda k: (elements[labels[k]], k))
+        for i in order:
+            if colors[i] not in color2cluster:
+                color2cluster[colors[i]] = len(sa)
                 sa.append([])
-                filtered_labels = cluster_labels == lab
-                for j, f in enumerate(filtered_labels):
-                    if f:
-                        sa[-1].append(index[j])
-
-        for cidx1, cluster_1 in enumerate(sa):
-            for cidx2, cluster_2 in enumerate(sa):
-
-                for i, b in enumerate(topology):
-                    b0 = b[0]
-                    b1 = b[1]
-                    if b0 in cluster_1 and b1 in cluster_2:
-                        joint_id = "|".join([str(cidx1), str(cidx2)])
-                        if joint_id not in sb:
-                            sb.append(joint_id)
-                    if b0 in cluster_2 and b1 in cluster_1:
-                        joint_id = "|".join([str(cidx1), str(cidx2)])
-                        if joint_id not in sb:
-                            sb.append(joint_id)
-        sb = [i.split("|") for i in sb]
-        sb = [[int(i[0]), int(i[1])] for i in sb]
+            sa[color2cluster[colors[i]]].append(i)
+
+        sb = bond_clusters(sa, topology)
         return sa, sb
 
 
@@ -0,0 +1,150 @@
+import numpy as np
+import hashlib
+import os
+from a2mdio import A2MDlib
+
+DENSITY_CACHE_SIZE = 2 ** 32  # bytes on disk before the least recently used arrays are evicted
+
+
+def wavefunction_key(wfn):
+    """
+    content hash of a wave function: geometry, basis and orbitals (or density matrix, if the
+    orbitals are not available), and the screening tolerance when screening is on. Wave
+    functions read from wfn or hdf5 files with the same content share the key
+
+    :param wfn: a2mdio.qm.WaveFunction
+    :return: hex digest
+    """
+    h = hashlib.sha256()
+    for array in [wfn.coords, wfn.exp, wfn.sym, wfn.cent]:
+        h.update(np.ascontiguousarray(array).tobytes())
+    if wfn.coeff is not None:
+        h.update(np.ascontiguousarray(wfn.coeff, dtype='float64').tobytes())
+        h.update(np.ascontiguousarray(wfn.occ, dtype='float64').tobytes())
+    else:
+        h.update(np.ascontiguousarray(wfn.density_matrix, dtype='float64').tobytes())
+    if wfn.tolerance is not None:
+        h.update(np.array([wfn.tolerance], dtype='float64').tobytes())
+    return h.hexdigest()
+
+
+def points_key(x):
+    """
+    content hash of a set of points (integration grid, sample, volume)
+    """
+    x = np.ascontiguousarray(x, dtype='float64')
+    h = hashlib.sha256(np.array(x.shape, dtype='int64').tobytes())
+    h.update(x.tobytes())
+    return h.hexdigest()
+
+
+class DensityCache(A2MDlib):
+    def __init__(self, path, max_size=DENSITY_CACHE_SIZE, verbose=False):
+        """
+        Density Cache
+        ---
+        stores the electron density of wave functions on sets of points, as npy files named after
+        the hash of the wave function and the hash of the points. Arrays are returned memory-mapped.
+        Each read refreshes the modification time of the file, and once the folder grows beyond
+        max_size the least recently used arrays are removed
+
+        :param path: folder of the cache
+        :param max_size: size in bytes
+        :param verbose:
+        """
+        A2MDlib.__init__(self, name='density cache', verbose=verbose)
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def filename(self, wfn_key, x_key):
+        return os.path.join(self.path, "{:s}_{:s}.npy".format(wfn_key[:32], x_key[:32]))
+
+    def get(self, wfn_key, x_key):
+        """
+        returns the cached values, or None
+        """
+        filename = self.filename(wfn_key, x_key)
+        try:
+            values = np.load(filename, mmap_mode='r')
+        except (IOError, ValueError):
+            return None
+        os.utime(filename)
+        return values
+
+    def put(self, wfn_key, x_key, values):
+        """
+        stores values. Files are written under a temporary name and then renamed, so concurrent
+        readers never see a partial array
+        """
+        filename = self.filename(wfn_key, x_key)
+        temporary = "{:s}.{:d}.tmp".format(filename, os.getpid())
+        with open(temporary, 'wb') as f:
+            np.save(f, np.asarray(values, dtype='float64'))
+        os.replace(temporary, filename)
+        self.evict()
+        return np.load(filename, mmap_mode='r')
+
+    def evict(self):
+        """
+        removes the least recently used arrays until the cache fits in max_size
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.log("evicted {:s}".format(name))
+
+    def eval(self, wfn, x, wfn_key=None):
+        """
+        density of wfn at x, read from the cache or calculated and stored
+
+        :param wfn: a2mdio.qm.WaveFunction
+        :param x: (n, 3) coordinates
+        :param wfn_key: hash of the wave function, if already known
+        :return: (n,) memory-mapped density
+        """
+        if wfn_key is None:
+            wfn_key = wavefunction_key(wfn)
+        x_key = points_key(x)
+        values = self.get(wfn_key, x_key)
+        if values is not None:
+            self.hits += 1
+            return values
+        self.misses += 1
+        return self.put(wfn_key, x_key, wfn.eval(x))
+
+    def bind(self, wfn):
+        """
+        returns a density function of wfn reading from the cache, with the same interface as wfn
+        """
+        return CachedDensity(self, wfn)
+
+
+class CachedDensity:
+    def __init__(self, cache: DensityCache, wfn):
+        self.cache = cache
+        self.wfn = wfn
+        self.key = wavefunction_key(wfn)
+
+    def __call__(self, x):
+        return self.eval(x)
+
+    def eval(self, x):
+        return self.cache.eval(self.wfn, x, wfn_key=self.key)
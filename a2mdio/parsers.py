@@ -1,180 +1,298 @@
 import re
 
-def std_coordinates(lines):
-    coordinates_flag = False
-    coordinates_barrier = 0
-    coordinates = []
-    atom_numbers = []
+LOG_SCAN_BUFFER = 2 ** 20  # bytes read at once when scanning gaussian logs
+
+
+class LogSection:
+    def __init__(self, token, skip=0, message=None):
+        """
+        Log Section
+        ---
+        section of a gaussian log, parsed while the log is streamed. Each line containing token is offered
+        to header until it opens the section; the following lines (after skipping the first skip lines) are
+        passed to feed until it returns False. Only the first occurrence of a section is parsed
+
+        :param token: text of the header, checked before matching the whole header
+        :param skip: lines between the header and the contents
+        :param message: error raised if the section is missing
+        """
+        self.token = token
+        self.skip = skip
+        self.message = message
+        self.value = None
+        self.is_open = False
+        self.is_done = False
+        self.__skipped = 0
+
+    def header(self, line):
+        """
+        whether line opens the section. Single line sections store their value here and close
+        """
+        raise NotImplementedError
+
+    def feed(self, line):
+        """
+        parses a line of the section. Returns False once the section is over
+        """
+        return False
+
+    def missing(self):
+        raise RuntimeError(self.message)
+
+    def push(self, line):
+        """
+        dispatches a (stripped) line
+        """
+        if self.is_done:
+            return
+        if not self.is_open:
+            if self.token in line and self.header(line):
+                self.is_open = not self.is_done
+            return
+        if self.__skipped < self.skip:
+            self.__skipped += 1
+            return
+        if not self.feed(line):
+            self.is_open = False
+            self.is_done = True
+
+    def result(self):
+        if not self.is_done:
+            return self.missing()
+        return self.value
+
+
+class SingleLineSection(LogSection):
+    def __init__(self, token, pattern, convert, message):
+        """
+        section made of a single line matching pattern, converted by convert(match)
+        """
+        LogSection.__init__(self, token, message=message)
+        self.pattern = re.compile(pattern)
+        self.convert = convert
+
+    def header(self, line):
+        m = self.pattern.match(line)
+        if m is None:
+            return False
+        self.value = self.convert(m)
+        self.is_done = True
+        return True
+
+
+class StdCoordinatesSection(LogSection):
+    def __init__(self):
+        LogSection.__init__(self, 'Standard orientation')
+        self.barrier = 0
+        self.value = ([], [])
+
+    def header(self, line):
+        return re.match(r'Standard\sorientation', line) is not None
+
+    def feed(self, line):
+        atom_numbers, coordinates = self.value
+        if re.match('-{5}', line):
+            if self.barrier == 2:
+                return False
+            self.barrier += 1
+        elif re.match(r'Center\s*Atomic\s*Atomic\s*Coordinates\s\(Angstroms\)', line):
+            pass
+        elif re.match(r'Number\s*Number\s*Type\s*X\s*Y\s*Z', line):
+            pass
+        else:
+            cnter, atmnmbr, atmtype, x, y, z = line.split()
+            coordinates.append([float(x), float(y), float(z)])
+            atom_numbers.append(int(atmnmbr))
+        return True
+
+    def missing(self):
+        return None
+
+
+class MKChargesSection(LogSection):
+    def __init__(self):
+        LogSection.__init__(self, 'Fitting', skip=3, message="MK charges not found")
+        self.value = []
+
+    def header(self, line):
+        return re.search(r"Fitting", line) is not None
+
+    def feed(self, line):
+        if line == '' or line[0] == "-":
+            return False
+        self.value.append(float(line.split()[2]))
+        return True
+
+
+class NPAChargesSection(LogSection):
+    def __init__(self):
+        LogSection.__init__(self, 'Rydberg', message="could not find npa charges")
+        self.value = []
+
+    def header(self, line):
+        return re.match(r'\s*Atom\s*No\s*Charge\s*Core\s*Valence\s*Rydberg\s*Total', line) is not None
+
+    def feed(self, line):
+        if re.match('-{5}', line):
+            return True
+        if re.match('={5}', line):
+            return False
+        atmsymbl, no, charge, core, valence, rydberg, total = line.split()
+        self.value.append(float(charge))
+        return True
+
+
+class ElectrostaticPotentialSection(LogSection):
+    def __init__(self):
+        LogSection.__init__(self, 'Electrostatic Properties', skip=5, message="could not find ep")
+        self.value = []
+
+    def header(self, line):
+        return re.match(r'Electrostatic Properties \(Atomic Units\)', line) is not None
+
+    def feed(self, line):
+        if re.search(r'Atom', line):
+            return True
+        if re.search(r'------', line):
+            return False
+        self.value.append(float(line.split()[1]))
+        return True
+
+
+class ForcesSection(LogSection):
+    def __init__(self, symmetry=True):
+        LogSection.__init__(self, 'Calling FoFJK', skip=5 if symmetry else 4)
+        self.value = ([], [])
+
+    def header(self, line):
+        return re.match('Calling FoFJK', line) is not None
+
+    def feed(self, line):
+        if re.search(r'---', line):
+            return False
+        cnt, _, x, y, z = line.split()
+        self.value[0].append(int(cnt))
+        self.value[1].append([float(x), float(y), float(z)])
+        return True
+
+    def missing(self):
+        return [], []
+
+
+def fortran_float(m, group=1):
+    return float(m.group(group).replace('D', 'E'))
+
+
+def hf_energy_section():
+    return SingleLineSection(
+        'SCF Done', r'SCF\sDone:\s*E\(RHF\)\s=(.*)\s*A\.U\.\safter\s*\d*\scycles', fortran_float, "could not find HF energy"
+    )
+
+
+def dft_energy_section(functional):
+    return SingleLineSection(
+        'SCF Done', r'SCF\sDone:\s*E\(R{:s}\)\s=(.*)\s*A\.U\.\safter\s*\d*\scycles'.format(functional), fortran_float,
+        "could not find DFT energy"
+    )
+
+
+def mp2_energy_section():
+    return SingleLineSection(
+        'EUMP2', r'E2\s=\s*(.*)\sEUMP2\s=\s*(.*)', lambda m: fortran_float(m, 2), "could not find MP2 energy"
+    )
+
+
+def energy_decomposition_section():
+    return SingleLineSection(
+        'N-N=', r'N-N=\s*(-?\d*.\d*D[+,-]\d{2})\s*E-N=\s*(-?\d*.\d*D[+,-]\d{2})\s*KE=\s*(-?\d*.\d*D[+,-]\d{2})\s*',
+        lambda m: dict(
+            nuclei_nuclei_potential=fortran_float(m, 1),
+            nuclei_electron_potential=fortran_float(m, 2),
+            kinetic=fortran_float(m, 3)
+        ),
+        "could not find the decomposition of energy"
+    )
+
+
+def dipole_section():
+    return SingleLineSection(
+        'X=', r'^\s*X=\s*(-?\d*.\d*)\s*Y=\s*(-?\d*.\d*)\s*Z=\s*(-?\d*.\d*)',
+        lambda m: [float(m.group(1)), float(m.group(2)), float(m.group(3))],
+        "could not find dipole"
+    )
+
+
+def scan_lines(lines, sections):
+    """
+    streams lines once, dispatching each of them to the sections that are still open or waiting for
+    their header. Stops as soon as all the sections are done
+
+    :param lines: iterable of lines
+    :param sections: dictionary of LogSection
+    :return: sections
+    """
+    pending = list(sections.values())
     for line in lines:
         line = line.strip()
-        if re.match('Standard\sorientation', line):
-
-            coordinates_flag = True
-            continue
-        if coordinates_flag:
-            if re.match('-{5}', line):
-                if coordinates_barrier == 2:
-                    return atom_numbers, coordinates
-                else:
-                    coordinates_barrier += 1
-            elif re.match('Center\s*Atomic\s*Atomic\s*Coordinates\s\(Angstroms\)', line):
-                pass
-            elif re.match('Number\s*Number\s*Type\s*X\s*Y\s*Z', line):
-                pass
-            else:
-                cnter, atmnmbr, atmtype, x, y, z = line.split()
-                atmnmbr = int(atmnmbr)
-                coordinates.append([
-                    float(x),
-                    float(y),
-                    float(z)
-                ])
-                atom_numbers.append(atmnmbr)
+        for section in pending:
+            section.push(line)
+        if any(section.is_done for section in pending):
+            pending = [section for section in pending if not section.is_done]
+            if not pending:
+                break
+    return sections
+
+
+def scan_log(filename, sections):
+    """
+    scans a gaussian log in a single pass, see scan_lines
+    """
+    with open(filename, buffering=LOG_SCAN_BUFFER) as f:
+        return scan_lines(f, sections)
+
+
+def scan_section(lines, section):
+    """
+    parses a single section from a list of lines
+    """
+    return scan_lines(lines, dict(section=section))['section'].result()
+
+
+def std_coordinates(lines):
+    return scan_section(lines, StdCoordinatesSection())
+
 
 def mk_charges(lines):
-    flagged_line = None
-    charge = []
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if re.search(r"Fitting", line):
-            flagged_line = i
-            break
-    if flagged_line is None:
-        raise RuntimeError("MK charges not found")
-    flagged_line += 4
-
-    for line in lines[flagged_line:]:
-        line = line.strip()
-        if line[0] == "-":
-            break
-        charge.append(float(line.split()[2]))
-    return charge
+    return scan_section(lines, MKChargesSection())
+
 
 def npa_charges(lines):
+    return scan_section(lines, NPAChargesSection())
 
-    ncharges = []
-    flag = False
-    for line in lines:
-        line = line.strip()
-        if re.match('\s*Atom\s*No\s*Charge\s*Core\s*Valence\s*Rydberg\s*Total', line):
-            flag=True
-        elif re.match('-{5}', line) and flag:
-            pass
-        elif re.match('={5}', line) and flag:
-            return ncharges
-        elif flag:
-            atmsymbl, no, charge, core, valence, rydberg, total = line.split()
-            ncharges.append(float(charge))
-    raise RuntimeError("could not find npa charges")
 
 def hf_energy(lines):
-    for line in lines:
-        if re.match('SCF\sDone:\s*E\(RHF\)\s=(.*)\s*A\.U\.\safter\s*\d*\scycles', line):
-            m = re.match('SCF\sDone:\s*E\(RHF\)\s=(.*)\s*A\.U\.\safter\s*\d*\scycles', line)
-            return float(m.group(1).replace('D', 'E'))
-    raise RuntimeError("could not find HF energy")
+    return scan_section(lines, hf_energy_section())
+
 
 def dft_energy(lines, functional):
-    x = 'SCF\sDone:\s*E\(R{:s}\)\s=(.*)\s*A\.U\.\safter\s*\d*\scycles'.format(functional)
-    print(x)
-    for line in lines:
-        line = line.strip()
-        if re.match(x, line):
-            m = re.match(x, line)
-            return float(m.group(1).replace('D', 'E'))
-    raise RuntimeError("could not find DFT energy")
+    return scan_section(lines, dft_energy_section(functional))
 
-def mp2_energy(lines):
-    for line in lines:
-        line = line.strip()
-        if re.match('E2\s=\s*(.*)\sEUMP2\s=\s*(.*)', line):
-            m = re.match('E2\s=\s*(.*)\sEUMP2\s=\s*(.*)', line)
-            return  float(m.group(2).replace('D', 'E'))
-    raise RuntimeError("could not find MP2 energy")
 
-def energy_decomposition(lines):
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if re.match(r'N-N=\s*(-?\d*.\d*D[+,-]\d{2})\s*E-N=\s*(-?\d*.\d*D[+,-]\d{2})\s*KE=\s*(-?\d*.\d*D[+,-]\d{2})\s*',
-                    line):
-            m = re.match(r'N-N=\s*(-?\d*.\d*D[+,-]\d{2})\s*E-N=\s*(-?\d*.\d*D[+,-]\d{2})\s*KE=\s*(-?\d*.\d*D[+,-]\d{2})\s*',
-                         line)
-
-            nn = float(m.group(1).replace('D', 'E'))
-            ne = float(m.group(2).replace('D', 'E'))
-            kin = float(m.group(3).replace('D', 'E'))
+def mp2_energy(lines):
+    return scan_section(lines, mp2_energy_section())
 
-            energy_terms = dict(
-                nuclei_nuclei_potential=nn,
-                nuclei_electron_potential=ne,
-                kinetic=kin
-            )
 
-            return energy_terms
+def energy_decomposition(lines):
+    return scan_section(lines, energy_decomposition_section())
 
-    raise RuntimeError("could not find the decomposition of energy")
 
 def dipole(lines):
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if re.match(r'^\s*X=\s*(-?\d*.\d*)\s*Y=\s*(-?\d*.\d*)\s*Z=\s*(-?\d*.\d*)', line):
-            m = re.match(r'^\s*X=\s*(-?\d*.\d*)\s*Y=\s*(-?\d*.\d*)\s*Z=\s*(-?\d*.\d*)', line)
-            dx = float(m.group(1))
-            dy = float(m.group(2))
-            dz = float(m.group(3))
-            dipole = [dx, dy, dz]
-            return dipole
-    raise RuntimeError("could not find dipole")
+    return scan_section(lines, dipole_section())
+
 
 def electrostatic_potential(lines):
-    flag = False
-    ep = []
-    start = None
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if re.match('Electrostatic Properties \(Atomic Units\)', line):
-            start = i
-            flag = True
-            break
-    if start is None:
-        raise RuntimeError("could not find ep")
-
-    if flag:
-        for line in lines[start + 6:]:
-            line = line.strip()
-            if re.search(r'Atom', line):
-                continue
-            elif re.search(r'------', line):
-                break
-            else:
-                ep.append(float(line.split()[1]))
+    return scan_section(lines, ElectrostaticPotentialSection())
 
-    return ep
 
 def forces(lines, symmetry=True):
-    flag = False
-    force_ = []
-    center_ = []
-    start = None
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if re.match('Calling FoFJK', line):
-            if symmetry:
-                start = i + 6
-            else:
-                start = i + 5
-            flag = True
-            break
-    if flag:
-        for line in lines[start:]:
-            if re.search(r'---', line):
-                break
-            else:
-                cnt, _, x, y, z = line.split()
-                x = float(x)
-                y = float(y)
-                z = float(z)
-                force_.append([x, y, z])
-                center_.append(int(cnt))
-
-    return center_, force_
\ No newline at end of file
+    return scan_section(lines, ForcesSection(symmetry=symmetry))
@@ -1,4 +1,5 @@
 import numpy as np
+import mmap
 import re
 from a2mdio.volumes import Volume
 import h5py
@@ -20,6 +21,13 @@ class A2MDlibQM:
 
 symmetry_index = np.array(WFN_SYMMETRY_INDEX)
 
+WFN_BLOCK_SIZE = 2 ** 9  # points evaluated at once
+WFN_CELL_SIZE = 4.0  # edge (Bohr) of the cells used to gather nearby points in the same blocks
+WFN_SCREENING_TOLERANCE = 1e-12  # with screening on, primitives are skipped where max|D_p:| x_p is below this value
+WFN_VOLUME_BLOCK_SIZE = 2 ** 12  # grid points of each tile in eval_volume
+WFN_HDF5_CHUNK_SIZE = 2 ** 16  # elements of each chunk of the datasets in WaveFunctionHDF5
+WFN_HDF5_COMPRESSION = 'lzf'  # fast to decompress, for random access during training
+
 atom_names = list(
     ['H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Na', 'Mg', 'Al', 'Si', 'P', 'S', 'Cl', 'Ar']
 )
@@ -39,11 +47,88 @@ def parse_fortran_scientific(fortran_number):
     return float(c_number)
 
 
+WFN_HEAD = re.compile(rb'(\d+)\s+MOL\s+ORBITALS\s+(\d+)\s+PRIMITIVES\s+(\d+)\s+NUCLEI')
+WFN_NUCLEUS = re.compile(
+    rb'^\s*(\S+)\s+\d+\s+\(CENTRE\s*\d+\)\s+(\S+)\s+(\S+)\s+(\S+)\s+CHARGE\s*=\s*(\S+)', re.MULTILINE
+)
+WFN_ORBITAL = re.compile(rb'^MO.*?OCC\s+NO\s*=\s*(\S+).*$', re.MULTILINE)
+FORTRAN_EXPONENT = bytes.maketrans(b'Dd', b'EE')
+
+
+def __parse_wfn_block(buffer, start, end, label, dtype):
+    """
+    converts the numbers of a section of a wfn file at once, after removing its labels and
+    translating fortran exponents
+    """
+    block = buffer[start:end].replace(label, b' ').translate(FORTRAN_EXPONENT)
+    return np.fromstring(block, dtype=dtype, sep=' ')
+
+
+def read_wfn(filename):
+    """
+    reads a wfn file (g09 or orca). The file is memory-mapped, the boundaries of its sections are
+    located, and each numeric section is converted in a single call
+
+    :param filename:
+    :return: dictionary with coefficients, occupation, exponents, symmetry, centers, coordinates,
+    types, charges and the number of primitives, orbitals and nuclei
+    """
+    with open(filename, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            head = WFN_HEAD.search(buffer)
+            if head is None:
+                raise IOError("{:s} is not a wfn file".format(filename))
+            orbitals, primitives, nuclei = [int(i) for i in head.groups()]
+            centers_start = buffer.find(b'CENTRE ASSIGNMENTS', head.end())
+            types_start = buffer.find(b'TYPE ASSIGNMENTS', centers_start)
+            exponents_start = buffer.find(b'EXPONENTS', types_start)
+            orbitals_start = buffer.find(b'\nMO', exponents_start) + 1
+            orbitals_end = buffer.find(b'END DATA', orbitals_start)
+            if min(centers_start, types_start, exponents_start, orbitals_start - 1, orbitals_end) < 0:
+                raise IOError("missing sections in {:s}".format(filename))
+
+            nuclei_lines = WFN_NUCLEUS.findall(buffer, head.end(), centers_start)
+            centers = __parse_wfn_block(buffer, centers_start, types_start, b'CENTRE ASSIGNMENTS', 'int64') - 1
+            syms = __parse_wfn_block(buffer, types_start, exponents_start, b'TYPE ASSIGNMENTS', 'int64') - 1
+            exponents = __parse_wfn_block(buffer, exponents_start, orbitals_start, b'EXPONENTS', 'float64')
+
+            # headers of the orbitals are blanked, so the coefficients are read at once
+            block = bytearray(buffer[orbitals_start:orbitals_end])
+            headers = list(WFN_ORBITAL.finditer(block))
+            occ = np.array([float(h.group(1).translate(FORTRAN_EXPONENT)) for h in headers])
+            for h in headers:
+                block[h.start():h.end()] = b' ' * (h.end() - h.start())
+            coeff = np.fromstring(bytes(block).translate(FORTRAN_EXPONENT), dtype='float64', sep=' ')
+        finally:
+            buffer.close()
+
+    if len(nuclei_lines) != nuclei or centers.size != primitives or syms.size != primitives:
+        raise IOError("wrong number of nuclei or primitives in {:s}".format(filename))
+    if exponents.size != primitives or len(headers) != orbitals or coeff.size != orbitals * primitives:
+        raise IOError("wrong number of orbitals or primitives in {:s}".format(filename))
+    nuclei_values = np.array([line[1:] for line in nuclei_lines], dtype='float64')
+    return dict(
+        coefficients=coeff.reshape(orbitals, primitives),
+        occupation=occ,
+        exponents=exponents,
+        symmetry=syms,
+        centers=centers,
+        coordinates=nuclei_values[:, :3],
+        types=[line[0].decode() for line in nuclei_lines],
+        charges=nuclei_values[:, 3],
+        number_primitives=primitives,
+        number_orbitals=orbitals,
+        number_centers=nuclei
+    )
+
+
 class WaveFunction(A2MDlibQM):
 
     def __init__(
         self, coeff, dm, occ, exponents, syms, centers, coords, types, charges, primitives,
-        molecular_orbitals, nuclei, verbose=False, program='g09', prefetch_dm=False
+        molecular_orbitals, nuclei, verbose=False, program='g09', prefetch_dm=False,
+        tolerance=None, block_size=WFN_BLOCK_SIZE
     ):
         A2MDlibQM.__init__(self, verbose=verbose, name='wavefunction handler')
         self.program = program
@@ -59,6 +144,9 @@ class WaveFunction(A2MDlibQM):
         self.norbs = molecular_orbitals
         self.ncenters = nuclei
         self.density_matrix = dm
+        self.tolerance = tolerance
+        self.block_size = block_size
+        self.primitive_radii = None
         if self.program not in ['orca', 'g09']:
             raise IOError("unknown program {:s}".format(self.program))
         if prefetch_dm:
@@ -92,208 +180,214 @@ class WaveFunction(A2MDlibQM):
         smx *= r[:, 2] ** s[2]
         return smx * np.exp(-r2 * exp)
 
-    @staticmethod
-    def __parse_centers(wfn, primitives):
-        """
-
-        In charge of parsing the distribution of centers for the basis set
-
-        :param wfn:
-        :param primitives:
-        :return:
-        """
-        centers = np.zeros(primitives, dtype='int64')
-        line = wfn[0]
-        i = 0
-        j = 0
-        while line[:6] == "CENTRE":
-            sp = line.split()
-            sp = sp[2:]
-            for centre in sp:
-                centers[i] = int(centre) - 1
-                i += 1
-            j += 1
-            line = wfn[j]
-        return centers, wfn[j:]
+    # PUBLIC METHODS
 
-    @staticmethod
-    def __parse_coordinates(wfn_instance, nuclei_number):
+    def eval(self, coordinates):
         """
 
-        In charge of parsing the geometry of the molecule
-
-        :param wfn_instance:
-        :param nuclei_number:
-        :return:
-        """
-        coordinates_lines = wfn_instance[:nuclei_number]
-        atom_types = [None] * nuclei_number
-        coordinates = np.zeros((nuclei_number, 3))
-        charge = np.zeros(nuclei_number)
-        i = 0
-        for line in coordinates_lines:
-            splitted_line = line.split()
-            atom_types[i] = splitted_line[0]
-            coordinates[i, 0] = float(splitted_line[4])
-            coordinates[i, 1] = float(splitted_line[5])
-            coordinates[i, 2] = float(splitted_line[6])
-            charge[i] = float(splitted_line[-1])
-            i += 1
-        return coordinates, atom_types, charge, wfn_instance[nuclei_number:]
+        Performs a calculation of electron density for the given coordinates by applying:
 
-    @staticmethod
-    def __parse_exponents(wfn, primitives):
-        """
+        rho = sum_i sum_j D_ij Xi_i Xi_j = Xi.T D Xi
 
-        In charge of parsing the exponents of the basisi set
+        where D is the value of the density matrix (obtained by multiplying the coefficents i and j
+        and the occupation numbers), and Xi_i and Xi_j are gaussian functions
 
-        :param wfn:
-        :param primitives:
-        :return:
-        """
-        exponents = np.zeros(primitives, dtype='float64')
-        line = wfn[0]
-        i = 0
-        j = 0
-        while line[:9] == "EXPONENTS":
-            sp = line.split()
-            sp = sp[1:]
-            for exp in sp:
-                exponents[i] = parse_fortran_scientific(exp)
-                i += 1
-            j += 1
-            line = wfn[j]
-        return exponents, wfn[j:]
+        or, when there are fewer occupied orbitals than primitives (see uses_orbitals),
 
-    @staticmethod
-    def __parse_head(wfn_instance):
-        """
+        rho = sum_i occ_i (C_i . Xi)^2
 
-        In charge of parsing the head
+        Points are evaluated in blocks of nearby points. For each block, only the primitives reaching
+        it (see get_primitive_radii) and their sub-block of the density matrix (or orbitals) are used
 
-        :param wfn_instance:
-        :return:
+        :param coordinates: coordinates upon which to provide the electron density value
+        :type coordinates: np.ndarray
+        :return: electron density
+        :rtype: np.ndarray
         """
-        head_line = wfn_instance[0]
-        head_terms = head_line.split()
-        head = dict(
-            molecular_orbitals=int(head_terms[1]),
-            primitives=int(head_terms[4]),
-            nuclei=int(head_terms[6])
-        )
-        return head, wfn_instance[1:]
+        if self.density_matrix is None and self.coeff is None:
+            raise IOError("neither the density matrix nor the orbitals have been set")
 
-    @staticmethod
-    def __parse_orbitals(wfn, primitives, orbitals, program):
+        coordinates = np.asarray(coordinates, dtype='float64')
+        n = coordinates.shape[0]
+        rho = np.zeros(n, dtype='float64')
+        if n == 0:
+            return rho
+        radii = self.get_primitive_radii()
+        powers = symmetry_index[self.sym, :]
+        orbitals = self.uses_orbitals()
+        if orbitals:
+            occupied = self.get_occupied_orbitals()
+            occupation = self.occ[occupied, np.newaxis]
+
+        # points are sorted by cell, so each block covers a compact region of space
+        keys = np.floor((coordinates - coordinates.min(axis=0)) / WFN_CELL_SIZE).astype('int64')
+        order = np.lexsort((keys[:, 2], keys[:, 1], keys[:, 0]))
+        for start in range(0, n, self.block_size):
+            idx = order[start:start + self.block_size]
+            xb = coordinates[idx, :]
+            center = 0.5 * (xb.min(axis=0) + xb.max(axis=0))
+            block_radius = np.sqrt(((xb - center) ** 2).sum(axis=1).max())
+            distance = np.linalg.norm(self.coords - center, axis=1)[self.cent]
+            active = np.flatnonzero(distance - block_radius < radii)
+            if active.size == 0:
+                continue
+            d = xb[np.newaxis, :, :] - self.coords[self.cent[active], np.newaxis, :]
+            g = np.exp(-self.exp[active, np.newaxis] * (d * d).sum(axis=2))
+            g *= np.prod(np.power(d, powers[active, np.newaxis, :]), axis=2)
+            if orbitals:
+                mo = self.coeff[np.ix_(occupied, active)] @ g
+                rho[idx] = (occupation * mo * mo).sum(0)
+            else:
+                dm = self.density_matrix[np.ix_(active, active)]
+                rho[idx] = (g * (dm @ g)).sum(0)
+        return rho
+
+    def eval_volume(self, spacing, resolution, block_size=WFN_VOLUME_BLOCK_SIZE):
+        """
+
+        Evaluation of electron density in a regular grid, to be saved as a .dx file.
+
+        Cartesian primitives factor into x, y and z parts, x^lx e^(-a x^2) y^ly e^(-a y^2) z^lz e^(-a z^2),
+        so on a regular grid they are tabulated once per axis. The grid is then split in tiles of
+        whole z-columns, and for each tile the primitives reaching it (see get_primitive_radii) are
+        rebuilt as outer products of their tables and contracted with the orbitals or the density matrix
+
+        :param spacing: amount of space around the min and max of the molecule (Bohr)
+        :param resolution: distance between grid points (Bohr)
+        :param block_size: maximum number of grid points evaluated at once
+        :return: ElectronDensity
+        """
+        if self.density_matrix is None and self.coeff is None:
+            raise IOError("neither the density matrix nor the orbitals have been set")
+
+        low = (self.coords - spacing).min(axis=0)
+        high = (self.coords + spacing).max(axis=0)
+        axes = [np.arange(low[i], high[i], resolution) for i in range(3)]
+        nx, ny, nz = [axis.size for axis in axes]
+
+        # 1-D tables, (primitives, points of the axis)
+        powers = symmetry_index[self.sym, :]
+        tables = []
+        for i in range(3):
+            d = axes[i][np.newaxis, :] - self.coords[self.cent, i, np.newaxis]
+            tables.append(np.power(d, powers[:, i, np.newaxis]) * np.exp(-self.exp[:, np.newaxis] * d * d))
+        x_table, y_table, z_table = tables
+
+        radii = self.get_primitive_radii()
+        orbitals = self.uses_orbitals()
+        if orbitals:
+            occupied = self.get_occupied_orbitals()
+            occupation = self.occ[occupied, np.newaxis]
+
+        dx = np.zeros((nx, ny, nz))
+        n_columns = max(1, block_size // max(1, nz))
+        n_rows = max(1, min(ny, n_columns))
+        n_planes = max(1, n_columns // n_rows)
+        for ix0 in range(0, nx, n_planes):
+            ix1 = min(ix0 + n_planes, nx)
+            for iy0 in range(0, ny, n_rows):
+                iy1 = min(iy0 + n_rows, ny)
+                box_low = np.array([axes[0][ix0], axes[1][iy0], axes[2][0]])
+                box_high = np.array([axes[0][ix1 - 1], axes[1][iy1 - 1], axes[2][-1]])
+                gap = np.maximum(0.0, np.maximum(box_low - self.coords, self.coords - box_high))
+                distance = np.linalg.norm(gap, axis=1)[self.cent]
+                active = np.flatnonzero(distance < radii)
+                if active.size == 0:
+                    continue
+                g = x_table[active, ix0:ix1, np.newaxis, np.newaxis] * y_table[active, np.newaxis, iy0:iy1, np.newaxis]
+                g = (g * z_table[active, np.newaxis, np.newaxis, :]).reshape(active.size, -1)
+                if orbitals:
+                    mo = self.coeff[np.ix_(occupied, active)] @ g
+                    rho = (occupation * mo * mo).sum(0)
+                else:
+                    dm = self.density_matrix[np.ix_(active, active)]
+                    rho = (g * (dm @ g)).sum(0)
+                dx[ix0:ix1, iy0:iy1, :] = rho.reshape(ix1 - ix0, iy1 - iy0, nz)
+
+        vol_density = ElectronDensity(verbose=False)
+        vol_density.set_r0(low * 0.5292)
+        vol_density.set_basis(np.identity(3) * resolution * 0.5292)
+        vol_density.set_volume(dx)
+        return vol_density
+
+    def get_primitive_radii(self):
+        """
+
+        distance to its center beyond which each primitive, scaled by the largest element of its row
+        of the density matrix (or a bound of it from the orbitals), is below the screening tolerance.
+        Without tolerance, radii are infinite
+
+        :return: radii (Bohr)
+        :rtype: np.ndarray
         """
-
-        In charge of parsing the coefficients of the wave function for each molecular orbital
-
-        :param wfn:
-        :param primitives:
-        :param orbitals:
+        if self.tolerance is None:
+            return np.full(self.nprims, np.inf)
+        if self.primitive_radii is None:
+            if self.density_matrix is not None:
+                scale = np.abs(self.density_matrix).max(axis=1)
+            else:
+                c = np.abs(self.coeff[self.get_occupied_orbitals(), :])
+                occupation = np.abs(self.occ[self.get_occupied_orbitals()])
+                scale = (c * (occupation * c.max(axis=1))[:, np.newaxis]).sum(axis=0)
+            scale = np.maximum(scale, 1e-300)
+            angular = symmetry_index[self.sym, :].sum(axis=1)
+            log_tolerance = np.log(self.tolerance / scale)
+            # r^l exp(-a r^2) = tolerance, by fixed point iteration from the pure gaussian radius
+            r = np.sqrt(np.maximum(-log_tolerance, 0.0) / self.exp)
+            for _ in range(8):
+                r = np.sqrt(np.maximum(angular * np.log(np.maximum(r, 1.0)) - log_tolerance, 0.0) / self.exp)
+            self.primitive_radii = r
+        return self.primitive_radii
+
+    def set_screening(self, tolerance=WFN_SCREENING_TOLERANCE, block_size=WFN_BLOCK_SIZE):
+        """
+
+        sets the screening tolerance of the primitives (None to evaluate all of them) and the
+        number of points evaluated at once. Screening is off by default, so that densities are
+        exact unless it is asked for
+
+        :param tolerance:
+        :param block_size:
         :return:
         """
-        orbital_text = ''.join(wfn)
-        orbital_text = re.split('END DATA', orbital_text)[0]
-        if program == 'g09':
-            orbital_text = re.split(r'MO\s*\d{1,3}\s*MO\s\d\.\d\s*OCC\s*', orbital_text)
-            orbital_text = orbital_text[1:]
-        elif program == 'orca':
-            orbital_text = re.split('MO', orbital_text)
-            orbital_text = orbital_text[1:]
-        coeff = np.zeros((orbitals, primitives))
-        occ = np.zeros(orbitals)
-        i = 0
-        j = 0
-        for orb in orbital_text:
-            orb = re.split('NO =', orb)[1]
-            orb_lines = orb.split('\n')
-            header = orb_lines[0].split()
-            occ[i] = float(header[0])
-            orb_lines = orb_lines[1:]
-            for line in orb_lines:
-                sp = line.split()
-                for item in sp:
-                    coeff[i, j] = parse_fortran_scientific(item)
-                    j += 1
-            j = 0
-            i += 1
-        return coeff, occ
+        self.tolerance = tolerance
+        self.block_size = block_size
+        self.primitive_radii = None
 
-    @staticmethod
-    def __parse_symmetry(wfn, primitives):
+    def calculate_density_matrix(self):
         """
 
-        In charge of parsing the symmetry coefficients of the basis set
+        Calculates the density matrix
 
-        :param wfn:
-        :param primitives:
         :return:
         """
-        symetry = np.zeros(primitives, dtype='int64')
-        line = wfn[0]
-        i = 0
-        j = 0
-        while line[:4] == "TYPE":
-            sp = line.split()
-            sp = sp[2:]
-            for sym in sp:
-                symetry[i] = int(sym) - 1
-                i += 1
-            j += 1
-            line = wfn[j]
-        return symetry, wfn[j:]
+        occupied = self.get_occupied_orbitals()
+        c = self.coeff[occupied, :]
+        return (c.T * self.occ[occupied]) @ c
 
-    # PUBLIC METHODS
-
-    def eval(self, coordinates):
+    def get_occupied_orbitals(self):
         """
 
-        Performs a calculation of electron density for the given coordinates by applying:
-
-        rho = sum_i sum_j D_ij Xi_i Xi_j = Xi.T D Xi
-
-        where D is the value of the density matrix (obtained by multiplying the coefficents i and j
-        and the occupation numbers), and Xi_i and Xi_j are gaussian functions
+        indices of the orbitals with non-zero occupation
 
-        :param coordinates: coordinates upon which to provide the electron density value
-        :type coordinates: np.ndarray
-        :return: electron density
-        :rtype: np.ndarray
+        :return:
         """
-        if self.density_matrix is None:
-            raise IOError("density matrix has not been set")
-
-        # rho = np.zeros(coordinates.shape[0])
-        n = coordinates.shape[0]
-        x = np.zeros((self.nprims, n))
-        for p in range(self.nprims):
-            cntr = self.coords[self.cent[p], :]
-            d = coordinates - cntr
-            x[p, :] = self.__gaussian(
-                d,
-                symmetry_index[self.sym[p], :],
-                self.exp[p]
-            )
-
-        rho = x * (self.density_matrix @ x)
-        return rho.sum(0)
+        return np.flatnonzero(~np.isclose(self.occ, 0.0))
 
-    def calculate_density_matrix(self):
+    def uses_orbitals(self):
         """
 
-        Calculates the density matrix
+        whether densities are evaluated from the occupied orbitals, rho = sum_i occ_i (C_i . Xi)^2,
+        instead of from the density matrix. Orbitals are used when they are available and there are
+        fewer occupied orbitals than primitives, or when there is no density matrix
 
         :return:
         """
-        dm = np.zeros((self.nprims, self.nprims))
-        for i in range(self.norbs):
-            if np.isclose(self.occ[i], 0.0):
-                continue
-            for p in range(self.nprims):
-                dm[p, :] += self.occ[i] * self.coeff[i, p] * self.coeff[i, :]
-        return dm
+        if self.coeff is None:
+            return False
+        if self.density_matrix is None:
+            return True
+        return self.get_occupied_orbitals().size < self.nprims
 
     def get_atom_labels(self):
         """
@@ -352,36 +446,26 @@ class WaveFunction(A2MDlibQM):
         reads the wave function
 
         """
-        with open(filename) as fh:
-            wfn = fh.readlines()
-        wfn = wfn[1:]
-        head, wfn = WaveFunction.__parse_head(wfn)
-        coords, types, charges, wfn = WaveFunction.__parse_coordinates(wfn, head['nuclei'])
-        centers, wfn = WaveFunction.__parse_centers(wfn, head['primitives'])
-        syms, wfn = WaveFunction.__parse_symmetry(wfn, head['primitives'])
-        exponents, wfn = WaveFunction.__parse_exponents(wfn, head['primitives'])
-        coeff, occ = WaveFunction.__parse_orbitals(
-            wfn, head['primitives'], head['molecular_orbitals'], program=program
-        )
-
+        wfn = read_wfn(filename)
         return WaveFunction(
-            coeff, None, occ, exponents, syms, centers, coords, types, charges, head['primitives'],
-            head['molecular_orbitals'], head['nuclei'], program, prefetch_dm=prefetch_dm
+            wfn['coefficients'], None, wfn['occupation'], wfn['exponents'], wfn['symmetry'], wfn['centers'],
+            wfn['coordinates'], wfn['types'], wfn['charges'], wfn['number_primitives'], wfn['number_orbitals'],
+            wfn['number_centers'], program=program, prefetch_dm=prefetch_dm
         )
 
     @staticmethod
     def from_hdf5(cwfn: h5py.Group):
-        prefetch = True
         if cwfn.attrs['contains_coefficients']:
             coeff = cwfn['coefficients'][:, :]
         else:
             coeff = None
         if cwfn.attrs['contains_density_matrix']:
             dm = cwfn['density_matrix'][:, :]
-            prefetch = False
         else:
             dm = None
         occ = cwfn['occupation'][:]
+        # the density matrix is only calculated if evaluating from the orbitals is not cheaper
+        prefetch = dm is None and np.count_nonzero(~np.isclose(occ, 0.0)) >= cwfn.attrs['number_primitives']
         exponents = cwfn['exponents'][:]
         syms = cwfn['symmetry'][:]
         centers = cwfn['centers'][:]
@@ -397,13 +481,21 @@ class WaveFunction(A2MDlibQM):
             molecular_orbitals, nuclei, None, prefetch_dm=prefetch
         )
 
-    def dump(self, save_dm=True, save_coeff=False):
+    def dump(self, save_dm=None, save_coeff=None):
         """
-        Prepares the WFN representation for saving into an HDF5 file
+        Prepares the WFN representation for saving into an HDF5 file. By default, only the
+        representation used by eval is kept: the orbitals or the density matrix
         :param save_dm
         :param save_coeff
         :return:
         """
+        if save_dm is None and save_coeff is None:
+            save_coeff = self.uses_orbitals()
+            save_dm = not save_coeff
+        save_dm = bool(save_dm)
+        save_coeff = bool(save_coeff)
+        if save_dm and self.density_matrix is None:
+            self.density_matrix = self.calculate_density_matrix()
         wfn_dict = {
             'number_centers': self.ncenters,
             'number_primitives': self.nprims,
@@ -422,7 +514,7 @@ class WaveFunction(A2MDlibQM):
         if save_dm:
             wfn_dict['density_matrix'] = self.density_matrix
         if save_coeff:
-            wfn_dict['coefficients'] = self.density_matrix
+            wfn_dict['coefficients'] = self.coeff
         return wfn_dict
 
 
@@ -454,56 +546,67 @@ class ElectronDensity(Volume):
 
 class GaussianLog(A2MDlibQM):
 
-    def __init__(self, file, method, charges, ep=False, verbose=True):
+    def __init__(self, file, method, charges, ep=False, forces=False, verbose=True):
         """
 
+        reads the results of a gaussian calculation in a single pass over the log. Each result is
+        parsed by a section of a2mdio.parsers, and sections missing from the log are read as None
+
         :param file:
+        :param method: MP2, HF or dft-FUNCTIONAL
+        :param charges: either NPA or MK
+        :param ep: read the electrostatic potential at the nuclei
+        :param forces: read the forces
         :param verbose:
         """
-        from a2mdio.parsers import std_coordinates
-        from a2mdio.parsers import npa_charges, mk_charges
-        from a2mdio.parsers import energy_decomposition, dipole
-        from a2mdio.parsers import hf_energy, mp2_energy, dft_energy
-        from a2mdio.parsers import electrostatic_potential
         A2MDlibQM.__init__(self, verbose=verbose, name='gaussianLog')
         self.fname = file
-        tokkens = [
-            std_coordinates, dipole, energy_decomposition
-        ]
-        tokkens_labels = ['coordinates', 'dipole', 'energy_decomposition']
-        if method == 'MP2':
-            tokkens.append(mp2_energy)
-            tokkens_labels.append('energy')
-        elif method == 'HF':
-            tokkens.append(hf_energy)
-            tokkens_labels.append('energy')
-        elif method[:3] == 'dft':
-            tokkens.append(lambda x: dft_energy(x, functional=method[4:]))
-            tokkens_labels.append('energy')
-
-        if charges == 'NPA':
-            tokkens.append(npa_charges)
-            tokkens_labels.append('charges')
-        elif charges == 'MK':
-            tokkens.append(mk_charges)
-            tokkens_labels.append('charges')
-
-        if ep:
-            tokkens.append(electrostatic_potential)
-            tokkens_labels.append('ep')
-
-        self.tokkens = tokkens
-        self.tokken_labels = tokkens_labels
+        self.method = method
+        self.charges = charges
+        self.ep = ep
+        self.forces = forces
+
+    def get_sections(self):
+        """
+        sections of the log to read, by label
+        """
+        from a2mdio.parsers import StdCoordinatesSection, NPAChargesSection, MKChargesSection
+        from a2mdio.parsers import ElectrostaticPotentialSection, ForcesSection
+        from a2mdio.parsers import dipole_section, energy_decomposition_section
+        from a2mdio.parsers import hf_energy_section, mp2_energy_section, dft_energy_section
+        sections = dict(
+            coordinates=StdCoordinatesSection(),
+            dipole=dipole_section(),
+            energy_decomposition=energy_decomposition_section()
+        )
+        if self.method == 'MP2':
+            sections['energy'] = mp2_energy_section()
+        elif self.method == 'HF':
+            sections['energy'] = hf_energy_section()
+        elif self.method[:3] == 'dft':
+            sections['energy'] = dft_energy_section(functional=self.method[4:])
+
+        if self.charges is not None and self.charges.upper() == 'NPA':
+            sections['charges'] = NPAChargesSection()
+        elif self.charges is not None and self.charges.upper() == 'MK':
+            sections['charges'] = MKChargesSection()
+
+        if self.ep:
+            sections['ep'] = ElectrostaticPotentialSection()
+        if self.forces:
+            sections['forces'] = ForcesSection()
+        return sections
 
     def read(self):
         """
 
         :return:
         """
+        from a2mdio.parsers import scan_log
         output_dict = dict()
-        for label, tk in zip(self.tokken_labels, self.tokkens):
+        for label, section in scan_log(self.fname, self.get_sections()).items():
             try:
-                output_dict[label] = self.seek(tk)
+                output_dict[label] = section.result()
             except RuntimeError:
                 self.log("missing tokken {:s}".format(label))
                 output_dict[label] = None
@@ -518,9 +621,32 @@ class GaussianLog(A2MDlibQM):
         with open(self.fname) as f:
             return fun(f.readlines())
 
+    @staticmethod
+    def read_many(files, method, charges, ep=False, forces=False, workers=1):
+        """
+
+        reads many logs, each in a single pass, spread over a pool of processes
+
+        :param files: list of logs
+        :param workers: number of processes
+        :return: iterator of dictionaries, in the order of files
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        logs = [
+            GaussianLog(file=f, method=method, charges=charges, ep=ep, forces=forces, verbose=False)
+            for f in files
+        ]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for output_dict in executor.map(GaussianLog.read, logs, chunksize=8):
+                    yield output_dict
+        else:
+            for glog in logs:
+                yield glog.read()
+
 
 class CubeFile(A2MDlibQM):
-    def __init__(self, file, verbose=False):
+    def __init__(self, file, verbose=False, memmap=None):
         """
 
         CubeFile allows to read the cube representation of electron density and store
@@ -528,9 +654,11 @@ class CubeFile(A2MDlibQM):
 
         :param file:
         :param verbose:
+        :param memmap: npy file to keep the tensor as a memory map (see a2mdio.volumes.read_values)
         """
         A2MDlibQM.__init__(self, name='CubeFile', verbose=verbose)
         self.file = file
+        self.memmap = memmap
         self.cube_tensor = None
         self.origin = None
         self.basis = None
@@ -538,77 +666,34 @@ class CubeFile(A2MDlibQM):
 
     def read(self):
         """
-        Reads a cube file
+        Reads a cube file. The header is read line by line, and the values at once
         :return:
         """
-
-        x_ori = None
-        y_ori = None
-        z_ori = None
-        n_atoms = 1000
-        x_n_values = None
-        y_n_values = None
-        z_n_values = None
-
+        from a2mdio.volumes import read_values
         unit_cell = np.zeros((3, 3), dtype='float64')
-        row_counter = 0
-        row_buffer = None
-
-        cube_tensor = None
-        i = 0
-        j = 0
-
-        with open(self.file) as f:
-            line = f.readline()
-            cnt = 1
-            while line:
-                line = f.readline()
-                cnt += 1
-
-                if cnt == 3:
-                    n_atoms, x_ori, y_ori, z_ori = line.split()
-                    n_atoms = int(n_atoms)
-                    x_ori = float(x_ori)
-                    y_ori = float(y_ori)
-                    z_ori = float(z_ori)
-
-                    self.log(
-                        "origin at : {:12.6f} {:12.6f} {:12.6f} (Angstroms)".format(
-                            x_ori, y_ori, z_ori
-                        )
-                    )
-
-                if cnt == 4:
-                    x_n_values, xi, yi, zi = line.split()
-                    x_n_values = int(x_n_values)
-                    unit_cell[0, :] = float(xi), float(yi), float(zi)
-                if cnt == 5:
-                    y_n_values, xj, yj, zj = line.split()
-                    y_n_values = int(y_n_values)
-                    unit_cell[1, :] = float(xj), float(yj), float(zj)
-                if cnt == 6:
-                    z_n_values, xk, yk, zk = line.split()
-                    z_n_values = int(z_n_values)
-                    unit_cell[2, :] = float(xk), float(yk), float(zk)
-                    n_values = z_n_values * x_n_values * y_n_values
-                    row_buffer = np.zeros(z_n_values, dtype='float64')
-                    cube_tensor = np.zeros((x_n_values, y_n_values, z_n_values), dtype='float32')
-                    self.log("total points : {:12d}".format(n_values))
-                if cnt > (6 + n_atoms):
-                    row_length = len(line.split())
-                    row_buffer[row_counter:row_counter + row_length] = list(map(float, line.split()))
-                    row_counter += row_length
-                    if row_counter == z_n_values:
-                        cube_tensor[i, j, :] = row_buffer
-                        row_counter -= row_counter
-                        row_buffer -= row_buffer
-                        j += 1
-                        if j == y_n_values:
-                            i += 1
-                            j -= j
-
-        self.cube_tensor = cube_tensor
-        self.origin = np.array((x_ori, y_ori, z_ori), dtype='float64')
+        shape = [0, 0, 0]
+        with open(self.file, 'rb') as f:
+            f.readline()
+            f.readline()
+            terms = f.readline().split()
+            n_atoms = int(terms[0])
+            origin = np.array([float(t) for t in terms[1:4]], dtype='float64')
+            self.log("origin at : {:12.6f} {:12.6f} {:12.6f} (Angstroms)".format(*origin))
+            for i in range(3):
+                terms = f.readline().split()
+                shape[i] = int(terms[0])
+                unit_cell[i, :] = [float(t) for t in terms[1:4]]
+            self.log("total points : {:12d}".format(shape[0] * shape[1] * shape[2]))
+            for i in range(abs(n_atoms)):
+                f.readline()
+            if n_atoms < 0:
+                # orbital cubes list the number of orbitals and their indices before the values
+                ids = f.readline().split()
+                while len(ids) < int(ids[0]) + 1:
+                    ids += f.readline().split()
+            start = f.tell()
+        self.cube_tensor = read_values(self.file, start, tuple(shape), dtype='float32', memmap=self.memmap)
+        self.origin = origin
         self.basis = unit_cell
 
     def get_plane(self, value, axis='z'):
@@ -642,39 +727,67 @@ class WaveFunctionHDF5:
         self.data = h5py.File(filename, mode)
         self.wfn_init = wfn_init
 
-    def add(self, key: str, wfn: WaveFunction, save_dm=True, save_coeff=False):
+    def add(self, key: str, wfn: WaveFunction, save_dm=None, save_coeff=None):
         """
 
         :param key:
         :param wfn:
-        :param save_dm:
-        :param save_coeff:
+        :param save_dm: None to keep the representation used by wfn.eval
+        :param save_coeff: None to keep the representation used by wfn.eval
         :return:
         """
 
         wfn_dict = wfn.dump(save_dm=save_dm, save_coeff=save_coeff)
         cwfn = self.data.create_group(key)
-        cwfn.create_dataset('coordinates', data=wfn_dict['coordinates'], compression='gzip')
-        cwfn.create_dataset('symmetry', data=wfn_dict['symmetry'], compression='gzip')
-        cwfn.create_dataset('centers', data=wfn_dict['centers'], compression='gzip')
-        cwfn.create_dataset('exponents', data=wfn_dict['exponents'], compression='gzip')
-        cwfn.create_dataset('occupation', data=wfn_dict['occupation'], compression='gzip')
+        for name in ['coordinates', 'symmetry', 'centers', 'exponents', 'occupation']:
+            self.create_dataset(cwfn, name, wfn_dict[name])
 
         cwfn.attrs.create('number_centers', data=wfn_dict['number_centers'])
         cwfn.attrs.create('number_primitives', data=wfn_dict['number_primitives'])
         cwfn.attrs.create('number_orbitals', data=wfn_dict['number_orbitals'])
         if wfn_dict['contains_dm']:
             cwfn.attrs.create('contains_density_matrix', data=True)
-            cwfn.create_dataset('density_matrix', data=wfn_dict['density_matrix'], compression='gzip')
+            self.create_dataset(cwfn, 'density_matrix', wfn_dict['density_matrix'])
         else:
             cwfn.attrs.create('contains_density_matrix', data=False)
 
         if wfn_dict['contains_coefficients']:
             cwfn.attrs.create('contains_coefficients', data=True)
-            cwfn.create_dataset('coefficients', data=wfn_dict['coefficients'], compression='gzip')
+            self.create_dataset(cwfn, 'coefficients', wfn_dict['coefficients'])
         else:
             cwfn.attrs['contains_coefficients'] = False
 
+    @staticmethod
+    def create_dataset(group: h5py.Group, name: str, data):
+        """
+
+        compressed dataset, chunked by blocks of whole rows of at most WFN_HDF5_CHUNK_SIZE elements
+
+        """
+        data = np.asarray(data)
+        if data.size == 0:
+            return group.create_dataset(name, data=data)
+        row = int(np.prod(data.shape[1:]))
+        chunks = (max(1, min(data.shape[0], WFN_HDF5_CHUNK_SIZE // max(1, row))),) + data.shape[1:]
+        return group.create_dataset(
+            name, data=data, chunks=chunks, compression=WFN_HDF5_COMPRESSION, shuffle=True
+        )
+
+    def add_file(self, key: str, filename: str, program='g09', save_dm=None, save_coeff=None):
+        """
+
+        reads a wfn file and stores it under key
+
+        :param key:
+        :param filename:
+        :param program: either g09 or orca
+        :param save_dm: None to keep the representation used by eval
+        :param save_coeff: None to keep the representation used by eval
+        :return:
+        """
+        wfn = WaveFunction.from_file(filename, program=program, prefetch_dm=False)
+        self.add(key, wfn, save_dm=save_dm, save_coeff=save_coeff)
+
     def iterall(self):
         for key, item in self.data.items():
             yield key, self.wfn_init(cwfn=item)
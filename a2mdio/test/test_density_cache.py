@@ -0,0 +1,60 @@
+from a2mdio.qm import WaveFunction, WaveFunctionHDF5
+from a2mdio.cache import DensityCache, wavefunction_key, points_key
+import numpy as np
+import tempfile
+import os
+
+if __name__ == '__main__':
+
+    print("a2mdio/density cache")
+    print("---")
+    # two centers with s and p primitives, two occupied orbitals
+    coords = np.array([[0.0, 0.0, 0.0], [0.0, 0.0, 1.4]])
+    centers = np.array([0, 0, 0, 1, 1])
+    syms = np.array([0, 0, 3, 0, 3])
+    exponents = np.array([3.0, 0.8, 1.1, 2.0, 0.9])
+    coeff = np.random.rand(2, 5)
+    occ = np.array([2.0, 2.0])
+    wfn = WaveFunction(
+        coeff, None, occ, exponents, syms, centers, coords, None, np.array([6.0, 1.0]), 5, 2, 2,
+        prefetch_dm=True
+    )
+    x = np.random.randn(5000, 3)
+    y = np.random.randn(5000, 3)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        wfnh5 = WaveFunctionHDF5(os.path.join(tmp, 'wfn.h5'), mode='w')
+        wfnh5.add(key='dimer', wfn=wfn)
+        wfnh5.close()
+        wfnh5 = WaveFunctionHDF5(os.path.join(tmp, 'wfn.h5'), mode='r')
+        _, wfn_h5 = wfnh5['dimer']
+        wfnh5.close()
+        # the key depends on the content, not on the source
+        assert wavefunction_key(wfn) == wavefunction_key(wfn_h5)
+        # densities are exact unless screening is asked for, and screened densities get their own key
+        assert wfn.tolerance is None
+        wfn_h5.set_screening()
+        assert wavefunction_key(wfn) != wavefunction_key(wfn_h5)
+        wfn_h5.set_screening(None)
+
+        cache = DensityCache(os.path.join(tmp, 'cache'))
+        reference = wfn.eval(x)
+        first = cache.eval(wfn, x)
+        second = cache.eval(wfn_h5, x)
+        print("hits {:d} misses {:d}".format(cache.hits, cache.misses))
+        assert cache.hits == 1 and cache.misses == 1
+        assert isinstance(second, np.memmap)
+        assert np.allclose(first, reference) and np.allclose(second, reference)
+
+        density = cache.bind(wfn)
+        assert np.allclose(density(y), wfn.eval(y))
+        assert cache.misses == 2
+
+        # room for a single array: the least recently used one is evicted
+        cache.max_size = int(1.5 * reference.nbytes)
+        os.utime(cache.filename(density.key, points_key(x)), (0, 0))
+        cache.evict()
+        assert cache.get(density.key, points_key(x)) is None
+        assert np.allclose(density(y), wfn.eval(y))
+        assert cache.hits == 2
+    print("DONE")
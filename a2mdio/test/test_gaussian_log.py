@@ -0,0 +1,98 @@
+from a2mdio.qm import GaussianLog
+from a2mdio.parsers import npa_charges, mk_charges, forces, std_coordinates, electrostatic_potential
+import numpy as np
+import tempfile
+import os
+
+LOG = """ Entering Gaussian System, Link 0=g09
+                         Standard orientation:
+ ---------------------------------------------------------------------
+ Center     Atomic      Atomic             Coordinates (Angstroms)
+ Number     Number       Type             X           Y           Z
+ ---------------------------------------------------------------------
+      1          8           0        0.000000    0.000000    0.117790
+      2          1           0        0.000000    0.755453   -0.471161
+      3          1           0        0.000000   -0.755453   -0.471161
+ ---------------------------------------------------------------------
+ SCF Done:  E(RB3LYP) =  -76.4089533829     A.U. after   10 cycles
+ N-N= 9.157115424170D+00 E-N=-1.989571853128D+02  KE= 7.595185212930D+01
+ Dipole moment (field-independent basis, Debye):
+    X=              0.0000    Y=              0.0000    Z=             -2.1270  Tot=              2.1270
+ Summary of Natural Population Analysis:
+                                       Natural Population
+                Natural  -----------------------------------------------
+    Atom No    Charge         Core      Valence    Rydberg      Total
+ -----------------------------------------------------------------------
+      O    1   -0.91574      1.99986     6.90723    0.00865     8.91574
+      H    2    0.45787      0.00000     0.54020    0.00193     0.54213
+      H    3    0.45787      0.00000     0.54020    0.00193     0.54213
+ =======================================================================
+ Fitting point charges to electrostatic potential
+ Charges from ESP fit, RMS=   0.00051 RMS=   0.00153:
+ Charge=   0.00000 Dipole=     0.0000     0.0000    -2.0912 Tot=     2.0912
+              1
+     1  O   -0.712318
+     2  H    0.356159
+     3  H    0.356159
+ -----------------------------------------------------------------
+              Electrostatic Properties (Atomic Units)
+
+ -----------------------------------------------------------------
+    Center     Electric         -------- Electric Field --------
+               Potential          X             Y             Z
+ -----------------------------------------------------------------
+    1 Atom    -22.331585
+    2 Atom     -1.091296
+    3 Atom     -1.091296
+    4          -0.012345
+    5           0.023456
+ -----------------------------------------------------------------
+ Calling FoFJK, ICntrl=      2127 FMM=F ISym2X=1 I1Cent= 0 IOpClX= 0 NMat=1 NMatS=1 NMatT=0.
+ ***** Axes restored to original set *****
+ -------------------------------------------------------------------
+ Center     Atomic                   Forces (Hartrees/Bohr)
+ Number     Number              X              Y              Z
+ -------------------------------------------------------------------
+      1        8           0.000000000    0.000000000   -0.015093117
+      2        1           0.000000000    0.008215393    0.007546559
+      3        1           0.000000000   -0.008215393    0.007546559
+ -------------------------------------------------------------------
+ Normal termination of Gaussian 09
+"""
+
+if __name__ == '__main__':
+
+    print("a2mdio/gaussian log")
+    print("---")
+    lines = LOG.split('\n')
+    atom_numbers, coordinates = std_coordinates(lines)
+    assert atom_numbers == [8, 1, 1] and np.isclose(coordinates[1][1], 0.755453)
+    assert np.allclose(npa_charges(lines), [-0.91574, 0.45787, 0.45787])
+    assert np.allclose(mk_charges(lines), [-0.712318, 0.356159, 0.356159])
+    assert np.allclose(electrostatic_potential(lines), [-0.012345, 0.023456])
+    centers, fx = forces(lines)
+    assert centers == [1, 2, 3] and np.isclose(fx[1][1], 0.008215393)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i, charges in enumerate(['NPA', 'mk']):
+            files.append(os.path.join(tmp, 'water_{:d}.g09.out'.format(i)))
+            with open(files[-1], 'w') as f:
+                f.write(LOG)
+        glog = GaussianLog(files[0], method='dft-B3LYP', charges='NPA', ep=True, forces=True, verbose=False)
+        out = glog.read()
+        print(out['energy'], out['dipole'], out['energy_decomposition'])
+        assert np.isclose(out['energy'], -76.4089533829)
+        assert np.allclose(out['dipole'], [0.0, 0.0, -2.1270])
+        assert np.isclose(out['energy_decomposition']['kinetic'], 75.95185212930)
+        assert np.allclose(out['charges'], npa_charges(lines))
+        assert np.allclose(out['ep'], electrostatic_potential(lines))
+        assert out['forces'] == forces(lines) and out['coordinates'] == std_coordinates(lines)
+
+        # a missing section is read as None
+        out = GaussianLog(files[0], method='MP2', charges='MK', verbose=False).read()
+        assert out['energy'] is None and np.allclose(out['charges'], mk_charges(lines))
+
+        many = list(GaussianLog.read_many(files, method='', charges='MK', workers=2))
+        assert len(many) == 2 and all(np.allclose(out['charges'], mk_charges(lines)) for out in many)
+    print("DONE")
@@ -0,0 +1,41 @@
+from a2mdio.volumes import Volume, rotation_grid
+from scipy.ndimage import affine_transform
+from scipy import signal as sig
+import numpy as np
+import time
+
+if __name__ == '__main__':
+
+    print("a2mdio/volume convolution")
+    print("---")
+    rotations = rotation_grid(64)
+    assert np.allclose(np.einsum('nij,nkj->nik', rotations, rotations), np.identity(3))
+    assert np.allclose(np.linalg.det(rotations), 1.0)
+
+    # an asymmetric pattern, placed in an empty volume
+    ix, iy, iz = np.meshgrid(*[np.arange(15, dtype='float64')] * 3, indexing='ij')
+    pattern = np.zeros((15, 15, 15))
+    for c, w in [((7, 7, 7), 1.0), ((10, 7, 7), 0.6), ((7, 11, 7), 0.3), ((5, 5, 10), 0.8)]:
+        pattern += w * np.exp(-((ix - c[0]) ** 2 + (iy - c[1]) ** 2 + (iz - c[2]) ** 2) / 2.0)
+    static = np.zeros((40, 36, 32))
+    static[12:27, 9:24, 5:20] = pattern
+    volume = Volume(dxvalues=static, r0=np.array([1.0, 2.0, 3.0]), basis=np.identity(3) * 0.5, verbose=False)
+
+    rotations = np.concatenate([rotation_grid(23), np.identity(3)[np.newaxis]], axis=0)
+    start = time.time()
+    scores, index, translations, coordinates = volume.convolve_rotations(pattern, rotations, top_k=5, workers=2)
+    print("TE {:8.4f} best score {:12.6e} rotation {:d} translation {:s}".format(
+        time.time() - start, scores[0], index[0], str(translations[0])
+    ))
+    assert index[0] == rotations.shape[0] - 1 and np.array_equal(translations[0], [12, 9, 5])
+    assert np.allclose(coordinates[0], [7.0, 6.5, 5.5])
+    assert np.all(np.diff(scores) <= 0) and scores.size == 5
+
+    # against a direct correlation, for a rotation of the grid
+    center = np.full(3, 7.0)
+    rotated = affine_transform(pattern, rotations[3].T, offset=center - rotations[3].T.dot(center), order=1)
+    reference = sig.correlate(static, rotated, mode='valid') / pattern.size
+    scores, index, translations, _ = volume.convolve_rotations(pattern, rotations[3:4], top_k=3)
+    assert np.isclose(scores[0], reference.max())
+    assert np.isclose(reference[tuple(translations[0])], scores[0])
+    print("DONE")
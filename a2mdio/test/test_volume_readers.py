@@ -0,0 +1,78 @@
+from a2mdio.volumes import Volume
+from a2mdio.qm import CubeFile
+import numpy as np
+import tempfile
+import time
+import os
+
+if __name__ == '__main__':
+
+    print("a2mdio/volume readers")
+    print("---")
+    values = np.random.rand(23, 17, 11)
+    r0 = np.array([-1.0, 2.0, 0.5])
+    basis = np.identity(3) * 0.25
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dx_file = os.path.join(tmp, 'volume.dx')
+        Volume(dxvalues=values, r0=r0, basis=basis, verbose=False).write(dx_file)
+        with open(dx_file, 'a') as f:
+            f.write('attribute "dep" string "positions"\n')
+            f.write('object "regular positions regular connections" class field\n')
+
+        start = time.time()
+        volume = Volume(filename=dx_file, verbose=False)
+        volume.read()
+        print("dx TE {:8.4f}".format(time.time() - start))
+        assert volume.shape == values.shape
+        assert np.allclose(volume.get_volume(), values, rtol=1e-10)
+        assert np.allclose(volume.get_r0(), r0) and np.allclose(volume.get_basis(), basis)
+
+        # the tensor is kept on disk, and reused while the dx file does not change
+        backing = os.path.join(tmp, 'volume.npy')
+        volume = Volume(filename=dx_file, verbose=False)
+        volume.read(memmap=backing)
+        assert isinstance(volume.get_volume(), np.memmap)
+        assert np.allclose(volume.get_volume(), values, rtol=1e-10)
+        modified = os.path.getmtime(backing)
+        volume = Volume(filename=dx_file, verbose=False)
+        volume.read(memmap=backing)
+        assert os.path.getmtime(backing) == modified
+        assert np.allclose(volume.get_volume(), values, rtol=1e-10)
+
+        # binary formats keep origin and basis, optionally quantized to float32
+        for extension, dtype, tolerance in [('npz', None, 0.0), ('h5', 'float32', 1e-6)]:
+            binary_file = os.path.join(tmp, 'volume.' + extension)
+            start = time.time()
+            Volume(dxvalues=values, r0=r0, basis=basis, verbose=False).write(binary_file, dtype=dtype)
+            volume = Volume(filename=binary_file, verbose=False)
+            volume.read()
+            print("{:4s} TE {:8.4f} size {:8d} dx size {:8d}".format(
+                extension, time.time() - start, os.path.getsize(binary_file), os.path.getsize(dx_file)
+            ))
+            assert np.allclose(volume.get_volume(), values, rtol=tolerance, atol=0.0)
+            assert np.array_equal(volume.get_r0(), r0) and np.array_equal(volume.get_basis(), basis)
+        volume.write(os.path.join(tmp, 'exported.dx'))
+        exported = Volume(filename=os.path.join(tmp, 'exported.dx'), verbose=False)
+        exported.read()
+        assert np.allclose(exported.get_volume(), values, rtol=1e-6)
+
+        # cube, 6 values per line and row, with two atoms
+        cube_file = os.path.join(tmp, 'volume.cube')
+        with open(cube_file, 'w') as f:
+            f.write(" cube\n density\n")
+            f.write("{:5d}{:12.6f}{:12.6f}{:12.6f}\n".format(2, *r0))
+            for i in range(3):
+                f.write("{:5d}{:12.6f}{:12.6f}{:12.6f}\n".format(values.shape[i], *basis[i, :]))
+            f.write("{:5d}{:12.6f}{:12.6f}{:12.6f}{:12.6f}\n".format(8, 8.0, 0.0, 0.0, 0.0))
+            f.write("{:5d}{:12.6f}{:12.6f}{:12.6f}{:12.6f}\n".format(1, 1.0, 0.0, 0.0, 1.8))
+            for i in range(values.shape[0]):
+                for j in range(values.shape[1]):
+                    row = values[i, j, :]
+                    for k in range(0, row.size, 6):
+                        f.write(''.join("{:13.5E}".format(v) for v in row[k:k + 6]) + "\n")
+        cube = CubeFile(cube_file, memmap=os.path.join(tmp, 'volume.cube.npy'))
+        assert cube.cube_tensor.shape == values.shape and cube.cube_tensor.dtype == np.float32
+        assert np.allclose(cube.cube_tensor, values, rtol=1e-4)
+        assert np.allclose(cube.origin, r0) and np.allclose(cube.basis, basis)
+    print("DONE")
@@ -0,0 +1,46 @@
+from a2mdio.volumes import Volume, create_orthogonal_basis
+import a2mdio.volumes
+import numpy as np
+import time
+
+if __name__ == '__main__':
+
+    print("a2mdio/volume rotation")
+    print("---")
+    shape = (48, 40, 36)
+    r0 = np.array([0.4, -0.3, 0.2])
+    ix, iy, iz = np.meshgrid(*[np.arange(n, dtype='float64') for n in shape], indexing='ij')
+    linear = 0.5 + 0.1 * ix - 0.2 * iy + 0.05 * iz
+    smooth = np.exp(-((ix - 24.0) ** 2 + (iy - 20.0) ** 2 + (iz - 18.0) ** 2) / 60.0)
+    basis = create_orthogonal_basis(np.array([1.0, 0.3, 0.2]))
+
+    # the voxels, rotated back to the tensor, where the fields are known
+    coordinates = np.stack([ix, iy, iz], axis=-1).reshape(-1, 3) + r0
+    rotated = coordinates.dot(basis.T) - r0
+    cell = np.floor(rotated)
+    inside = np.all((cell >= 1) & (cell < np.array(shape) - 1), axis=1).reshape(shape)
+
+    volume = Volume(dxvalues=linear.copy(), r0=r0, verbose=False)
+    start = time.time()
+    volume.rotate(basis)
+    print("trilinear TE {:8.4f}".format(time.time() - start))
+    expected = (0.5 + rotated.dot(np.array([0.1, -0.2, 0.05]))).reshape(shape)
+    assert np.allclose(volume.get_volume()[inside], expected[inside])
+    assert np.all(volume.get_volume()[~inside] == 0.0)
+
+    # slabs of any size give the same tensor
+    reference = Volume(dxvalues=smooth.copy(), r0=r0, verbose=False)
+    reference.rotate(basis, order=3)
+    a2mdio.volumes.VOLUME_SLAB_SIZE = 1000
+    volume = Volume(dxvalues=smooth.copy(), r0=r0, verbose=False)
+    volume.rotate(basis, order=3)
+    assert np.array_equal(volume.get_volume(), reference.get_volume())
+    d = rotated - np.array([24.0, 20.0, 18.0])
+    expected = np.exp(-(d * d).sum(axis=1) / 60.0).reshape(shape)
+    error = np.abs(volume.get_volume() - expected)[inside].max()
+    print("cubic max abs error {:12.4e}".format(error))
+    assert error < 1e-2
+
+    center = Volume(dxvalues=smooth.copy(), r0=r0, verbose=False).get_mass_center()
+    assert np.allclose(center, np.array([24.0, 20.0, 18.0]), atol=1e-2)
+    print("DONE")
@@ -0,0 +1,68 @@
+from a2mdio.qm import WaveFunction, WaveFunctionHDF5
+import numpy as np
+import tempfile
+import time
+import os
+
+if __name__ == '__main__':
+
+    print("a2mdio/wavefunction orbitals")
+    print("---")
+    # 12 atoms with a triple zeta like set of s, p and d primitives, random orbitals
+    n_atoms = 12
+    coords = np.array([[2.6 * (i % 3), 2.6 * ((i // 3) % 2), 2.6 * (i // 6)] for i in range(n_atoms)], dtype=float)
+    shell = [(0, e) for e in [4560., 682., 154., 42., 13., 4.3, 1.6, 0.5, 0.15, 0.04]]
+    shell += [(p, e) for e in [18., 4.0, 1.1, 0.35, 0.1, 0.04] for p in [1, 2, 3]]
+    shell += [(d, 0.8) for d in range(4, 10)]
+    centers = np.repeat(np.arange(n_atoms), len(shell))
+    syms = np.tile([s for s, _ in shell], n_atoms)
+    exponents = np.tile([e for _, e in shell], n_atoms)
+    n_orbitals = 4 * n_atoms
+    coeff = np.random.randn(n_orbitals, centers.size) * ((2 * exponents / np.pi) ** 0.75) * 0.3
+    occ = np.zeros(n_orbitals)
+    occ[:3 * n_atoms] = 2.0
+    wfn = WaveFunction(
+        coeff, None, occ, exponents, syms, centers, coords, None,
+        np.full(n_atoms, 6.0), centers.size, n_orbitals, n_atoms, prefetch_dm=True
+    )
+    low = coords.min(axis=0) - 3.0
+    x = np.random.rand(10000, 3) * (coords.max(axis=0) + 3.0 - low) + low
+
+    # density matrix against the explicit sum over orbitals
+    reference_dm = np.zeros((wfn.nprims, wfn.nprims))
+    for i in range(n_orbitals):
+        reference_dm += occ[i] * np.outer(coeff[i, :], coeff[i, :])
+    assert np.allclose(wfn.density_matrix, reference_dm)
+    assert wfn.uses_orbitals()
+
+    start = time.time()
+    rho_orbitals = wfn.eval(x)
+    time_orbitals = time.time() - start
+    dm_only = WaveFunction(
+        None, wfn.density_matrix, occ, exponents, syms, centers, coords, None,
+        np.full(n_atoms, 6.0), centers.size, n_orbitals, n_atoms
+    )
+    assert not dm_only.uses_orbitals()
+    start = time.time()
+    rho_dm = dm_only.eval(x)
+    time_dm = time.time() - start
+    print("max abs error {:12.4e} TE orbitals {:8.4f} density matrix {:8.4f}".format(
+        np.abs(rho_orbitals - rho_dm).max(), time_orbitals, time_dm
+    ))
+    assert np.allclose(rho_orbitals, rho_dm, rtol=1e-10, atol=1e-12)
+
+    # only the representation used by eval is stored
+    with tempfile.TemporaryDirectory() as tmp:
+        wfnh5 = WaveFunctionHDF5(os.path.join(tmp, 'wfn.h5'), mode='w')
+        wfnh5.add(key='orbitals', wfn=wfn)
+        wfnh5.add(key='dm', wfn=dm_only)
+        wfnh5.close()
+        wfnh5 = WaveFunctionHDF5(os.path.join(tmp, 'wfn.h5'), mode='r')
+        _, wfn_orbitals = wfnh5['orbitals']
+        _, wfn_dm = wfnh5['dm']
+        wfnh5.close()
+    assert wfn_orbitals.density_matrix is None and wfn_orbitals.uses_orbitals()
+    assert wfn_dm.coeff is None and not wfn_dm.uses_orbitals()
+    assert np.allclose(wfn_orbitals.eval(x), rho_orbitals, rtol=1e-10, atol=1e-12)
+    assert np.allclose(wfn_dm.eval(x), rho_orbitals, rtol=1e-10, atol=1e-12)
+    print("DONE")
@@ -0,0 +1,94 @@
+from a2mdio.qm import WaveFunction, WaveFunctionHDF5, read_wfn
+import numpy as np
+import tempfile
+import time
+import os
+
+
+def fortran(x, digits):
+    # fortran Dw.d format, as in the wfn files
+    mantissa, exponent = "{:.{:d}E}".format(x, digits - 1).split('E')
+    exponent = 0 if x == 0.0 else int(exponent) + 1
+    sign = '-' if mantissa[0] == '-' else ''
+    number = "{:s}0.{:s}D{:+03d}".format(sign, mantissa.strip('-').replace('.', ''), exponent)
+    return number.rjust(digits + 8)
+
+
+def write_wfn(filename, coeff, occ, exponents, syms, centers, coords, charges, program):
+    with open(filename, 'w') as f:
+        f.write(" synthetic\n")
+        f.write("GAUSSIAN {:14d} MOL ORBITALS {:6d} PRIMITIVES {:8d} NUCLEI\n".format(
+            coeff.shape[0], coeff.shape[1], coords.shape[0]
+        ))
+        for i in range(coords.shape[0]):
+            f.write("  C{:5d}    (CENTRE{:3d}) {:12.8f}{:12.8f}{:12.8f}  CHARGE = {:4.1f}\n".format(
+                i + 1, i + 1, *coords[i, :], charges[i]
+            ))
+        for label, values in [('CENTRE ASSIGNMENTS  ', centers + 1), ('TYPE ASSIGNMENTS    ', syms + 1)]:
+            for j in range(0, values.size, 20):
+                f.write(label + ''.join("{:3d}".format(k) for k in values[j:j + 20]) + "\n")
+        for j in range(0, exponents.size, 5):
+            f.write("EXPONENTS " + ''.join(fortran(e, 7) for e in exponents[j:j + 5]) + "\n")
+        for i in range(coeff.shape[0]):
+            if program == 'g09':
+                f.write("MO{:5d}     MO 0.0        OCC NO = {:12.8f}  ORB. ENERGY = {:12.6f}\n".format(i + 1, occ[i], -1.0))
+            else:
+                f.write("MO{:4d}                     OCC NO = {:12.8f}  ORB. ENERGY = {:12.6f}\n".format(i + 1, occ[i], -1.0))
+            for j in range(0, coeff.shape[1], 5):
+                f.write(''.join(fortran(c, 8) for c in coeff[i, j:j + 5]) + "\n")
+        f.write("END DATA\n")
+        f.write(" TOTAL ENERGY =     -100.000000000000 THE VIRIAL(-V/T)=   2.00000000\n")
+
+
+if __name__ == '__main__':
+
+    print("a2mdio/wfn parser")
+    print("---")
+    # 12 atoms with a triple zeta like set of s, p and d primitives, random orbitals
+    n_atoms = 12
+    coords = np.array([[2.6 * (i % 3), 2.6 * ((i // 3) % 2), 2.6 * (i // 6)] for i in range(n_atoms)], dtype=float)
+    shell = [(0, e) for e in [4560., 682., 154., 42., 13., 4.3, 1.6, 0.5, 0.15, 0.04]]
+    shell += [(p, e) for e in [18., 4.0, 1.1, 0.35, 0.1, 0.04] for p in [1, 2, 3]]
+    shell += [(d, 0.8) for d in range(4, 10)]
+    centers = np.repeat(np.arange(n_atoms), len(shell))
+    syms = np.tile([s for s, _ in shell], n_atoms)
+    exponents = np.tile([e for _, e in shell], n_atoms)
+    n_orbitals = 4 * n_atoms
+    coeff = np.random.randn(n_orbitals, centers.size)
+    occ = np.zeros(n_orbitals)
+    occ[:3 * n_atoms] = 2.0
+    charges = np.full(n_atoms, 6.0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for program in ['g09', 'orca']:
+            filename = os.path.join(tmp, 'synthetic.{:s}.wfn'.format(program))
+            write_wfn(filename, coeff, occ, exponents, syms, centers, coords, charges, program)
+            start = time.time()
+            wfn = WaveFunction.from_file(filename, program=program, prefetch_dm=False)
+            print("{:4s} TE parser {:8.4f}".format(program, time.time() - start))
+            assert wfn.nprims == centers.size and wfn.norbs == n_orbitals and wfn.ncenters == n_atoms
+            assert np.array_equal(wfn.cent, centers) and np.array_equal(wfn.sym, syms)
+            assert np.allclose(wfn.exp, exponents, rtol=1e-6) and np.allclose(wfn.coords, coords)
+            assert np.allclose(wfn.coeff, coeff, rtol=1e-7, atol=1e-8) and np.array_equal(wfn.occ, occ)
+            assert np.array_equal(wfn.charges, charges) and wfn.types == ['C'] * n_atoms
+
+        wfnh5 = WaveFunctionHDF5(os.path.join(tmp, 'wfn.h5'), mode='w')
+        wfnh5.add_file('synthetic', filename, program='orca')
+        wfnh5.close()
+        wfnh5 = WaveFunctionHDF5(os.path.join(tmp, 'wfn.h5'), mode='r')
+        _, wfn_h5 = wfnh5['synthetic']
+        dataset = wfnh5.data['synthetic/coefficients']
+        assert dataset.chunks is not None and dataset.compression is not None
+        wfnh5.close()
+        assert np.array_equal(wfn_h5.coeff, wfn.coeff) and np.array_equal(wfn_h5.exp, wfn.exp)
+
+        with open(filename) as f:
+            truncated = f.read().replace('END DATA', '')
+        with open(filename, 'w') as f:
+            f.write(truncated)
+        try:
+            read_wfn(filename)
+            raise AssertionError("truncated file was read")
+        except IOError:
+            pass
+    print("DONE")
@@ -0,0 +1,45 @@
+from a2mdio.qm import WaveFunction
+import numpy as np
+import time
+
+if __name__ == '__main__':
+
+    print("a2mdio/wavefunction screening")
+    print("---")
+    # 12 atoms with a triple zeta like set of s, p and d primitives, random orbitals
+    n_atoms = 12
+    coords = np.array([[2.6 * (i % 3), 2.6 * ((i // 3) % 2), 2.6 * (i // 6)] for i in range(n_atoms)], dtype=float)
+    shell = [(0, e) for e in [4560., 682., 154., 42., 13., 4.3, 1.6, 0.5, 0.15, 0.04]]
+    shell += [(p, e) for e in [18., 4.0, 1.1, 0.35, 0.1, 0.04] for p in [1, 2, 3]]
+    shell += [(d, 0.8) for d in range(4, 10)]
+    centers = np.repeat(np.arange(n_atoms), len(shell))
+    syms = np.tile([s for s, _ in shell], n_atoms)
+    exponents = np.tile([e for _, e in shell], n_atoms)
+    n_orbitals = 3 * n_atoms
+    coeff = np.random.randn(n_orbitals, centers.size) * ((2 * exponents / np.pi) ** 0.75) * 0.3
+    wfn = WaveFunction(
+        coeff, None, np.full(n_orbitals, 2.0), exponents, syms, centers, coords, None,
+        np.full(n_atoms, 6.0), centers.size, n_orbitals, n_atoms, prefetch_dm=True
+    )
+    low = coords.min(axis=0) - 3.0
+    x = np.random.rand(10000, 3) * (coords.max(axis=0) + 3.0 - low) + low
+
+    # reference: all the primitives at all the points, in a single block
+    wfn.set_screening(None, block_size=x.shape[0])
+    start = time.time()
+    reference = wfn.eval(x)
+    time_dense = time.time() - start
+    for tolerance in [None, 1e-12, 1e-8]:
+        wfn.set_screening(tolerance)
+        start = time.time()
+        rho = wfn.eval(x)
+        time_screened = time.time() - start
+        error = np.abs(rho - reference).max()
+        print("tolerance {:>8s} max abs error {:12.4e} TE dense {:8.4f} screened {:8.4f}".format(
+            str(tolerance), error, time_dense, time_screened
+        ))
+        if tolerance is None:
+            assert np.allclose(rho, reference, rtol=1e-12, atol=1e-12)
+        else:
+            assert error < 1e3 * tolerance * n_atoms
+    print("DONE")
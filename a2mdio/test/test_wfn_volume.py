@@ -0,0 +1,47 @@
+from a2mdio.qm import WaveFunction, ElectronDensity
+import numpy as np
+import time
+
+if __name__ == '__main__':
+
+    print("a2mdio/wavefunction volume")
+    print("---")
+    # 12 atoms with a triple zeta like set of s, p and d primitives, random orbitals
+    n_atoms = 12
+    coords = np.array([[2.6 * (i % 3), 2.6 * ((i // 3) % 2), 2.6 * (i // 6)] for i in range(n_atoms)], dtype=float)
+    shell = [(0, e) for e in [4560., 682., 154., 42., 13., 4.3, 1.6, 0.5, 0.15, 0.04]]
+    shell += [(p, e) for e in [18., 4.0, 1.1, 0.35, 0.1, 0.04] for p in [1, 2, 3]]
+    shell += [(d, 0.8) for d in range(4, 10)]
+    centers = np.repeat(np.arange(n_atoms), len(shell))
+    syms = np.tile([s for s, _ in shell], n_atoms)
+    exponents = np.tile([e for _, e in shell], n_atoms)
+    n_orbitals = 3 * n_atoms
+    coeff = np.random.randn(n_orbitals, centers.size) * ((2 * exponents / np.pi) ** 0.75) * 0.3
+    wfn = WaveFunction(
+        coeff, None, np.full(n_orbitals, 2.0), exponents, syms, centers, coords, None,
+        np.full(n_atoms, 6.0), centers.size, n_orbitals, n_atoms, prefetch_dm=True
+    )
+
+    spacing, resolution = 3.0, 0.3
+    low = (coords - spacing).min(axis=0)
+    high = (coords + spacing).max(axis=0)
+    axes = [np.arange(low[i], high[i], resolution) for i in range(3)]
+    x = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+
+    start = time.time()
+    reference = wfn.eval(x)
+    time_points = time.time() - start
+    for block_size in [7, 2 ** 12, 2 ** 20]:
+        start = time.time()
+        volume = wfn.eval_volume(spacing, resolution, block_size=block_size)
+        time_volume = time.time() - start
+        assert isinstance(volume, ElectronDensity)
+        values = volume.get_volume()
+        error = np.abs(values.flatten() - reference).max() / reference.max()
+        print("block {:8d} max rel error {:12.4e} TE points {:8.4f} volume {:8.4f}".format(
+            block_size, error, time_points, time_volume
+        ))
+        assert values.shape == tuple(axis.size for axis in axes)
+        assert error < 1e-10
+    assert np.allclose(volume.get_r0(), low * 0.5292)
+    print("DONE")
@@ -1,8 +1,16 @@
 import time
 import sys
+import os
+import mmap
 import numpy as np
 from scipy import signal as sig
 
+VOLUME_READ_CHUNK = 2 ** 24  # bytes of text parsed at once when reading volumetric files
+VOLUME_WRITE_CHUNK = 2 ** 16  # lines of text formatted at once when writing dx files
+VOLUME_BINARY_FORMATS = ['.npz', '.h5', '.hdf5']  # extensions of the binary volumetric files
+VOLUME_SLAB_SIZE = 2 ** 18  # voxels resampled at once when rotating volumes
+SUPER_FIBONACCI_PSI = 1.533751168755204288118041  # root of x^4 = x + 4, for quasi-uniform rotations
+
 
 def create_orthogonal_basis(main_axis):
     main_axis /= np.linalg.norm(main_axis)
@@ -68,6 +76,26 @@ def roty(coords, angle):
     return ry.dot(coords)
 
 
+def rotation_grid(n):
+    """
+    quasi-uniform grid of rotations (super-Fibonacci spiral of unit quaternions)
+
+    :param n: number of rotations
+    :return: (n, 3, 3) rotation matrices
+    """
+    s = np.arange(n) + 0.5
+    r = np.sqrt(s / n)
+    big_r = np.sqrt(1.0 - s / n)
+    alpha = 2.0 * np.pi * s / np.sqrt(2.0)
+    beta = 2.0 * np.pi * s / SUPER_FIBONACCI_PSI
+    x, y, z, w = r * np.sin(alpha), r * np.cos(alpha), big_r * np.sin(beta), big_r * np.cos(beta)
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], axis=-1),
+        np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], axis=-1),
+        np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], axis=-1)
+    ], axis=1)
+
+
 def write_pdb(filename, coordinates):
     format_pdb = "{:6s}{:5d} {:^4s}{:1s}{:3s} {:1s}{:4d}{:1s}   {:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.2f}          {:>2s}{:2s}\n"
     with open(filename, 'w') as f:
@@ -82,6 +110,58 @@ def write_pdb(filename, coordinates):
             )
 
 
+def read_values(filename, start, shape, dtype='float64', memmap=None):
+    """
+    reads the values of a volumetric text file (dx, cube) at once. The payload, starting at byte
+    start and ending at the first line with text (if any), is parsed in chunks of whole lines into a
+    contiguous array in C order (x, y, z)
+
+    :param filename:
+    :param start: byte where the values start
+    :param shape: (nx, ny, nz)
+    :param dtype:
+    :param memmap: npy file backing the result. It is reused if it is newer than filename
+    :return: array or memory map (copy on write, so changes are not stored)
+    """
+    count = int(np.prod(shape))
+    if memmap is not None:
+        if os.path.isfile(memmap) and os.path.getmtime(memmap) >= os.path.getmtime(filename):
+            values = np.load(memmap, mmap_mode='c')
+            if values.shape == tuple(shape) and values.dtype == np.dtype(dtype):
+                return values
+        values = np.lib.format.open_memmap(memmap, mode='w+', dtype=dtype, shape=tuple(shape))
+    else:
+        values = np.empty(shape, dtype=dtype)
+    flat = values.reshape(-1)
+    i = 0
+    with open(filename, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            end = len(buffer)
+            for token in [b'attribute', b'object']:
+                position = buffer.find(token, start)
+                if position >= 0:
+                    end = min(end, position)
+            while start < end and i < count:
+                stop = buffer.find(b'\n', min(start + VOLUME_READ_CHUNK, end))
+                stop = end if stop < 0 or stop > end else stop
+                chunk = np.fromstring(buffer[start:stop], dtype='float64', sep=' ')
+                if i + chunk.size > count:
+                    raise IOError("too many values in {:s}".format(filename))
+                flat[i:i + chunk.size] = chunk
+                i += chunk.size
+                start = stop
+        finally:
+            buffer.close()
+    if i != count:
+        raise IOError("expected {:d} values in {:s}, found {:d}".format(count, filename, i))
+    if memmap is not None:
+        values.flush()
+        del values, flat
+        return np.load(memmap, mmap_mode='c')
+    return values
+
+
 # pyProb defined Errors
 
 class Error(Exception):
@@ -198,6 +278,7 @@ class Volume(VolumeBaseClass):
         else:
             self.__massCenter = masscenter
         self.__edge = edge
+        self.__fft = None
 
     # Default Methods
     def __iter__(self):
@@ -275,53 +356,60 @@ class Volume(VolumeBaseClass):
     def __get_center(self):
 
         total = np.sum(self.__dx)
-        cx = 0
-        cy = 0
-        cz = 0
-        for ix in range(self.__nx):
-            for iy in range(self.__ny):
-                for iz in range(self.__nz):
-                    ratio = self.__dx[ix, iy, iz] / total
-                    cx += ratio * ix
-                    cy += ratio * iy
-                    cz += ratio * iz
+        cx = np.dot(np.sum(self.__dx, axis=(1, 2)), np.arange(self.__nx)) / total
+        cy = np.dot(np.sum(self.__dx, axis=(0, 2)), np.arange(self.__ny)) / total
+        cz = np.dot(np.sum(self.__dx, axis=(0, 1)), np.arange(self.__nz)) / total
 
         self.__massCenter = np.array([cx, cy, cz]) + self.__r0
         return np.array([cx, cy, cz])
 
-    def __interpolate(self, coordinates, interpolate=True):
+    def __interpolate(self, coordinates, interpolate=True, order=1, out=None, tensor=None):
+        """
+        resamples the tensor at coordinates (in voxels, shifted by r0). Values are interpolated with
+        splines of the given order (1, trilinear; 3, cubic) or taken from the lower voxel. Points whose
+        lower voxel lies on the first or last layers, or outside of the tensor, are set to zero
+        :param coordinates: (n, 3)
+        :param interpolate:
+        :param order: 1 or 3
+        :param out: (n,) array for the result
+        :param tensor: tensor to sample, by default the volume (e.g. prefiltered for cubic splines)
+        :return:
+        """
+        from scipy.ndimage import map_coordinates
+        if tensor is None:
+            tensor = self.__dx
+        if out is None:
+            out = np.zeros(coordinates.shape[0])
+        u = coordinates - self.get_r0()
+        cell = np.floor(u)
+        inside = np.all((cell >= 1) & (cell < np.array([self.__nx, self.__ny, self.__nz]) - 1), axis=1)
+        if interpolate:
+            out[inside] = map_coordinates(tensor, u[inside].T, order=order, mode='mirror', prefilter=False)
+        else:
+            idx = cell[inside].astype('int64')
+            out[inside] = self.__dx[idx[:, 0], idx[:, 1], idx[:, 2]]
+        out[~inside] = 0.0
+        return out
+
+    def __resample(self, transform, interpolate=True, order=1, slab_size=None):
+        """
+        resamples the whole tensor at transform(coordinates of the voxels), by slabs of at most
+        slab_size voxels (by default, VOLUME_SLAB_SIZE)
+        """
+        from scipy.ndimage import spline_filter
+        if slab_size is None:
+            slab_size = VOLUME_SLAB_SIZE
+        tensor = self.__dx
+        if interpolate and order > 1:
+            tensor = spline_filter(np.asarray(self.__dx, dtype='float64'), order=order)
         ndx = np.zeros((self.__nx, self.__ny, self.__nz))
-        ix = 0;
-        iy = 0;
-        iz = 0
-        n = 0
-        r0 = self.get_r0()
-        for c in coordinates:
-            cx = int(c[0] - r0[0])
-            cy = int(c[1] - r0[1])
-            cz = int(c[2] - r0[2])
-            if any([(cx >= (self.__nx - 1)), (cy >= (self.__ny - 1)), (cz >= (self.__nz - 1))]):
-                ndx[ix, iy, iz] = 0.0
-                n += 1
-            elif any([(cx < 1), (cy < 1), (cz < 1)]):
-                ndx[ix, iy, iz] = 0.0
-                n += 1
-            else:
-                deltax = c[0] - float(cx)
-                deltay = c[1] - float(cy)
-                deltaz = c[2] - float(cz)
-                ndx[ix, iy, iz] = self.__dx[cx, cy, cz]
-                if interpolate:
-                    ndx[ix, iy, iz] = (ndx[ix, iy, iz] + deltax * self.__dx[cx + 1, cy, cz]) / (1 + deltax)
-                    ndx[ix, iy, iz] = (ndx[ix, iy, iz] + deltay * self.__dx[cx, cy + 1, cz]) / (1 + deltay)
-                    ndx[ix, iy, iz] = (ndx[ix, iy, iz] + deltaz * self.__dx[cx, cy, cz + 1]) / (1 + deltaz)
-            iz += 1
-            if iz == self.__nz:
-                iy += 1
-                iz = 0
-            if iy == self.__ny:
-                iy = 0
-                ix += 1
+        n_planes = max(1, slab_size // max(1, self.__ny * self.__nz))
+        for start in range(0, self.__nx, n_planes):
+            stop = min(start + n_planes, self.__nx)
+            coordinates = transform(self.__set_coords_4_rotation(start, stop))
+            self.__interpolate(
+                coordinates, interpolate=interpolate, order=order, out=ndx[start:stop].reshape(-1), tensor=tensor
+            )
         return ndx
 
     def __rotx(self, coordinates, angle):
@@ -348,18 +436,13 @@ class Volume(VolumeBaseClass):
         )
         return coordinates.dot(rz.T)
 
-    def __set_coords_4_rotation(self):
-        i = 0
-        coordinates = np.zeros((self.__nx * self.__ny * self.__nz, 3))
-        r0 = self.get_r0()
-        for ix in range(self.__nx):
-            for iy in range(self.__ny):
-                for iz in range(self.__nz):
-                    coordinates[i, 0] = float(ix)
-                    coordinates[i, 1] = float(iy)
-                    coordinates[i, 2] = float(iz)
-                    coordinates[i, :] += r0
-                    i += 1
+    def __set_coords_4_rotation(self, start=0, stop=None):
+        if stop is None:
+            stop = self.__nx
+        coordinates = np.stack(np.meshgrid(
+            np.arange(start, stop), np.arange(self.__ny), np.arange(self.__nz), indexing='ij'
+        ), axis=-1).reshape(-1, 3).astype('float64')
+        coordinates += self.get_r0()
         return coordinates
 
     # Public Methods
@@ -403,6 +486,7 @@ class Volume(VolumeBaseClass):
             ] += volume
         except IndexError:
             raise IOError("volumes should have the same size")
+        self.__fft = None
 
     def convolve(self, movingelement):
         """
@@ -476,6 +560,69 @@ class Volume(VolumeBaseClass):
         )
         return cnvlvd[cy, cz], topconv_x, topconv_y, topconv_z
 
+    def convolve_rotations(self, movingelement, rotations, top_k=10, workers=1):
+        """
+        convolve rotations
+        correlates the moving element, rotated around its center, with the volume at every translation
+        that keeps it inside (as in a valid correlation), for a batch of rotations. The Fourier transform
+        of the volume is calculated once and cached; each rotation needs the transform of the moving
+        element and an inverse transform, spread over a pool of threads
+        :param movingelement: tensor or volumetric instance, with the same spacing as the volume
+        :param rotations: (n, 3, 3) rotation matrices, or a number of rotations of a quasi-uniform grid
+        :param top_k: number of best scores kept
+        :param workers: number of threads
+        :return: scores, rotation indices, translations (voxels) and coordinates of the origin of the
+        moving element, sorted from the best score
+        """
+        from scipy import fft
+        from scipy.ndimage import affine_transform
+        from concurrent.futures import ThreadPoolExecutor
+        if self.__dx is None:
+            raise AttributeError("must read a volumetric file before convolution")
+        try:
+            moving = movingelement.get_volume()
+        except AttributeError:
+            moving = movingelement
+        moving = np.asarray(moving, dtype='float64')
+        if np.isscalar(rotations):
+            rotations = rotation_grid(int(rotations))
+        rotations = np.asarray(rotations, dtype='float64')
+        shape = np.array(self.shape)
+        if np.any(np.array(moving.shape) > shape):
+            raise IOError("the moving element should not be larger than the volume")
+        valid = tuple(shape - np.array(moving.shape) + 1)
+
+        fft_shape = tuple(fft.next_fast_len(int(n), real=True) for n in shape)
+        if self.__fft is None or self.__fft[0] is not self.__dx or self.__fft[1] != fft_shape:
+            self.log("transforming the static volume")
+            self.__fft = (self.__dx, fft_shape, fft.rfftn(self.__dx, s=fft_shape))
+        static = self.__fft[2]
+        center = (np.array(moving.shape) - 1) / 2.0
+
+        def scan(i):
+            rotated = affine_transform(
+                moving, rotations[i].T, offset=center - rotations[i].T.dot(center), order=1, cval=0.0
+            )
+            correlation = fft.irfftn(static * np.conj(fft.rfftn(rotated, s=fft_shape)), s=fft_shape)
+            correlation = correlation[:valid[0], :valid[1], :valid[2]].reshape(-1) / moving.size
+            k = min(top_k, correlation.size)
+            best = np.argpartition(-correlation, k - 1)[:k]
+            return correlation[best], np.full(k, i), best
+
+        self.log("scanning {:d} rotations".format(rotations.shape[0]))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(scan, range(rotations.shape[0])))
+        else:
+            results = [scan(i) for i in range(rotations.shape[0])]
+        scores = np.concatenate([r[0] for r in results])
+        rotation_index = np.concatenate([r[1] for r in results])
+        best = np.concatenate([r[2] for r in results])
+        order = np.argsort(-scores, kind='stable')[:top_k]
+        translations = np.stack(np.unravel_index(best[order], valid), axis=1)
+        coordinates = self.__r0 + translations.dot(self.__X)
+        return scores[order], rotation_index[order], translations, coordinates
+
     ## Getters
     def get_basis(self):
         if self.__X is None:
@@ -563,80 +710,54 @@ class Volume(VolumeBaseClass):
         dx = fun(r).reshape(xx.size, yy.size, zz.size).T
         self.__dx = dx
 
-    def read(self):
+    def read(self, memmap=None):
         """
         read
-        reads a dx file and sets the tensor and the other attributes
+        reads a dx file and sets the tensor and the other attributes. The header is read line by line,
+        and the values at once. Binary files written by write (npz, hdf5) are read as well
+        :param memmap: npy file to keep the tensor of dx files as a memory map, see read_values
         :return:
         """
         if self.__fn is None:
             raise IOError("filename is not defined")
         self.log("reading %s" % self.__fn)
-        dx = None
-        ix = 0
-        iy = 0
-        iz = 0
-        i = 0
+        extension = os.path.splitext(self.__fn)[1].lower()
+        if extension in VOLUME_BINARY_FORMATS:
+            dx, self.__r0, self.__X = self.__read_binary(extension)
+            self.set_volume(dx)
+            self.log("%s reading is finished" % extension)
+            return True
         x = np.zeros((3, 3))
-        ny = None
-        nz = None
+        i = 0
+        shape = None
         try:
-            f = open(self.__fn)
+            f = open(self.__fn, 'rb')
         except FileNotFoundError:
             self.log("file %s was not found. dying" % self.__fn)
             sys.exit(1)
-        for line in f:
-            if line[0] == '#':
-                continue
-            terms = line.split()
-            if terms[0] == 'object':
-                if terms[3] == 'gridpositions':
-                    self.__nx = int(terms[5])
-                    self.__ny = int(terms[6])
-                    self.__nz = int(terms[7])
-                    nx = int(terms[5])
-                    ny = int(terms[6])
-                    nz = int(terms[7])
-                    dx = np.zeros((
-                        int(terms[5]),
-                        int(terms[6]),
-                        int(terms[7]),
-                    ))
-                    self.log(
-                        'volumetric tensor was created. Size x %d y %d z %d' % (
-                            nx, ny, nz
-                        )
-                    )
-                else:
-                    pass
-            elif terms[0] == 'origin':
-                self.__r0 = np.array(
-                    [float(terms[1]), float(terms[2]), float(terms[3])]
-                )
-                self.log(
-                    'origin coordinates were set to %4.3f %4.3f %4.3f' % (
-                        float(terms[1]), float(terms[2]), float(terms[3])
-                    )
-                )
-            elif terms[0] == 'delta':
-                x[i, i] = terms[i + 1]
-                i += 1
-            else:
-                for t in terms:
-                    try:
-                        dx[ix, iy, iz] = float(t)
-                    except TypeError:
-                        raise IOError('dx file format was not correct')
-                    except ValueError:
+        with f:
+            for line in iter(f.readline, b''):
+                terms = line.decode().split()
+                if len(terms) == 0 or terms[0][0] == '#':
+                    continue
+                if terms[0] == 'object':
+                    if terms[3] == 'gridpositions':
+                        shape = int(terms[5]), int(terms[6]), int(terms[7])
+                        self.log('volumetric tensor was created. Size x %d y %d z %d' % shape)
+                    elif 'data' in terms and 'follows' in terms:
                         break
-                    iz += 1
-                    if iz == nz:
-                        iy += 1
-                        iz = 0
-                    if iy == ny:
-                        ix += 1
-                        iy = 0
+                elif terms[0] == 'origin':
+                    self.__r0 = np.array([float(terms[1]), float(terms[2]), float(terms[3])])
+                    self.log('origin coordinates were set to %4.3f %4.3f %4.3f' % tuple(self.__r0))
+                elif terms[0] == 'delta':
+                    x[i, :] = [float(t) for t in terms[1:4]]
+                    i += 1
+            start = f.tell()
+        if shape is None:
+            raise IOError('dx file format was not correct')
+        dx = read_values(self.__fn, start, shape, memmap=memmap)
         self.__dx = dx
+        self.__nx, self.__ny, self.__nz = dx.shape
         self.shape = dx.shape
         self.__X = x
         self.log("dx reading is finished")
@@ -651,31 +772,28 @@ class Volume(VolumeBaseClass):
     def rotate_z(self, coordinates, angle):
         return self.__rotz(coordinates, angle)
 
-    def rotate(self, newbasis, interpolate=True):
+    def rotate(self, newbasis, interpolate=True, order=1):
         """
         rotate allows the rotation around the --mass center-- of the volume,
         to align an arbitrary axis x with the x axis of the tensor. If interpolate
-        is set to True, it performs a linear approximation of the values at each given
-        point
+        is set to True, it performs a trilinear (order 1) or cubic (order 3) interpolation
+        of the values at each given point
         :param newbasis:
         :param interpolate:
+        :param order:
         :return:
         """
         self.log('changing basis system')
 
-        ## Rotation of tensor coordinates
-        coordinates = self.__set_coords_4_rotation()
-        coordinates = coordinates.dot(newbasis.T)
+        ## Rotation of tensor coordinates, resampled by slabs
         self.log('interpolating volume tensor')
-        ndx = self.__interpolate(coordinates, interpolate=interpolate)
+        ndx = self.__resample(lambda coordinates: coordinates.dot(newbasis.T), interpolate=interpolate, order=order)
         self.__dx = ndx
         self.log('interpolation, done')
         return True
 
-    def rotate_around_x(self, angle, interpolate=True):
-        coordinates = self.__set_coords_4_rotation()
-        coordinates = self.__rotx(coordinates, angle)
-        ndx = self.__interpolate(coordinates, interpolate=interpolate)
+    def rotate_around_x(self, angle, interpolate=True, order=1):
+        ndx = self.__resample(lambda coordinates: self.__rotx(coordinates, angle), interpolate=interpolate, order=order)
         self.__dx = ndx
 
     def set_basis(self, basis):
@@ -725,7 +843,19 @@ class Volume(VolumeBaseClass):
         self.__ub = up_bounds
         return True
 
-    def write(self, filename):
+    def write(self, filename, dtype=None):
+        """
+        write
+        writes the tensor as a dx file, or as a compressed binary file (npz, or hdf5 with chunked
+        compression) keeping the origin and the basis
+        :param filename: format is chosen by extension
+        :param dtype: type of the stored values in binary files (e.g. float32), by default that of the tensor
+        :return:
+        """
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in VOLUME_BINARY_FORMATS:
+            return self.__write_binary(filename, extension, dtype)
+        values = np.asarray(self.__dx, dtype='float64').reshape(-1)
         f = open(filename, 'w')
         f.write('#\n')
         f.write(
@@ -740,17 +870,37 @@ class Volume(VolumeBaseClass):
         )
                 )
         f.write('object 3 class array type double rank 0 items %d data follows\n' % (self.__nx * self.__ny * self.__nz))
-        ll = []
-        for ix in range(self.__nx):
-            for iy in range(self.__ny):
-                for iz in range(self.__nz):
-                    ll.append(self.__dx[ix, iy, iz])
-                    if len(ll) == 3:
-                        f.write('{:12.11e} {:12.11e} {:12.11e}'.format(ll[0], ll[1], ll[2]) + '\n')
-                        ll = []
-        if len(ll) > 0:
-            try:
-                f.write('{:12.11e} {:12.11e}'.format(ll[0], ll[1]) + '\n')
-            except IndexError:
-                f.write('{:12.11e}'.format(ll[0]) + '\n')
+        # three values per line, formatted by chunks of lines
+        n_lines = values.size // 3
+        for start in range(0, n_lines, VOLUME_WRITE_CHUNK):
+            chunk = values[3 * start:3 * min(start + VOLUME_WRITE_CHUNK, n_lines)]
+            f.write(('%12.11e %12.11e %12.11e\n' * (chunk.size // 3)) % tuple(chunk.tolist()))
+        remainder = values[3 * n_lines:]
+        if remainder.size > 0:
+            f.write(' '.join('{:12.11e}'.format(v) for v in remainder) + '\n')
         f.close()
+
+    def __write_binary(self, filename, extension, dtype):
+        values = np.asarray(self.__dx)
+        if dtype is not None:
+            values = values.astype(dtype)
+        r0 = np.asarray(self.__r0, dtype='float64')
+        basis = np.asarray(self.__X, dtype='float64')
+        if extension == '.npz':
+            np.savez_compressed(filename, values=values, r0=r0, basis=basis)
+        else:
+            import h5py
+            with h5py.File(filename, 'w') as f:
+                f.create_dataset(
+                    'values', data=values, chunks=True, compression='gzip', shuffle=True
+                )
+                f.create_dataset('r0', data=r0)
+                f.create_dataset('basis', data=basis)
+
+    def __read_binary(self, extension):
+        if extension == '.npz':
+            with np.load(self.__fn) as f:
+                return f['values'], f['r0'], f['basis']
+        import h5py
+        with h5py.File(self.__fn, 'r') as f:
+            return f['values'][()], f['r0'][()], f['basis'][()]
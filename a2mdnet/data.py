@@ -241,8 +241,14 @@ class MolecularElectronDensityDataset(MolecularDataset):
             self, device, dtype, ids=None, model_parameters_path=None,
             molecular_data_path=None, density_data_path=None,
             mol_prop=None, prefetch=True, integration_method=integrate_from_dict,
-            match_method=match_fun_names
+            match_method=match_fun_names, density_cache=None, wfn_data_path=None
     ):
+        """
+        density samples are read from npy files in density_data_path (x, y, z, rho columns). If a
+        density cache (a2mdio.cache.DensityCache or its folder) and a WaveFunctionHDF5 file are given,
+        only the coordinates are read from the samples, and densities come from the cache, which
+        calculates them from the wave function of the molecule on the first use
+        """
         MolecularDataset.__init__(
             self, device, dtype, ids, model_parameters_path,
             molecular_data_path, prefetch, integration_method=integration_method,
@@ -256,11 +262,19 @@ class MolecularElectronDensityDataset(MolecularDataset):
         self.density_data_path = density_data_path
         self.density_buffer = []
 
+        if density_cache is not None and wfn_data_path is not None:
+            from a2mdio.cache import DensityCache
+            from a2mdio.qm import WaveFunctionHDF5
+            if type(density_cache) is not DensityCache:
+                density_cache = DensityCache(density_cache)
+            self.wfn_data = WaveFunctionHDF5(wfn_data_path)
+        else:
+            self.wfn_data = None
+        self.density_cache = density_cache
+
         if self.density_data_path is not None and prefetch:
             for item in self.ids:
-                self.density_buffer.append(
-                    np.load(self.density_data_path / '{:s}.npy'.format(item))
-                )
+                self.density_buffer.append(self.load_density(item))
 
         if mol_prop is None:
             self.mol_prop = None
@@ -271,6 +285,19 @@ class MolecularElectronDensityDataset(MolecularDataset):
     def __len__(self):
         return len(self.ids)
 
+    def load_density(self, identifier):
+        """
+        density sample of a molecule, as an array of x, y, z, rho columns
+        :param identifier:
+        :return:
+        """
+        density = np.load(self.density_data_path / '{:s}.npy'.format(identifier))
+        if self.wfn_data is None:
+            return density
+        _, wfn = self.wfn_data[identifier]
+        rho = self.density_cache.eval(wfn, density[:, :3])
+        return np.concatenate([density[:, :3], rho.reshape(-1, 1)], axis=1)
+
     def __getitem__(self, item):
         if self.density_data_path is None and self.mol_prop is None:
             return super(MolecularElectronDensityDataset, self).__getitem__(item=item)
@@ -280,7 +307,7 @@ class MolecularElectronDensityDataset(MolecularDataset):
 
                 if not self.prefetch:
 
-                    density = np.load(self.density_data_path / '{:s}.npy'.format(self.ids[item]))
+                    density = self.load_density(self.ids[item])
                     density = density[np.random.randint(0, density.shape[0], self.DENSITY_POINTS), :]
                     density = torch.tensor(density, dtype=torch.float, device=self.device)
                     output.append(density[:, :3])
@@ -2,7 +2,12 @@ import torch
 import torchani
 import torch.nn as nn
 from a2mdio.qm import WaveFunctionHDF5
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
+import os
+
+QM_DENSITY_CACHE_SIZE = 2 ** 30  # bytes of device memory held by the cached wave functions
 
 
 class TorchElementA2MDNN(nn.Module):
@@ -770,6 +775,13 @@ class QMDensityFun:
     def __call__(self, *args, **kwargs):
         return self.forward(*args)
 
+    def get_size(self):
+        """
+        bytes held on the device
+        """
+        tensors = [self.dm, self.exp, self.sym, self.centers, self.coords, self.sym_index]
+        return sum(t.element_size() * t.nelement() for t in tensors)
+
     def gto(self, x, i):
 
         center = self.centers[i]
@@ -807,6 +819,10 @@ class QMDensityFun:
 
         if cwfn.attrs['contains_density_matrix']:
             dm = cwfn['density_matrix'][:, :]
+        elif cwfn.attrs['contains_coefficients']:
+            coeff = cwfn['coefficients'][:, :]
+            occ = cwfn['occupation'][:]
+            dm = (coeff.T * occ) @ coeff
         else:
             raise IOError("missing DM")
 
@@ -821,26 +837,120 @@ class QMDensityFun:
 
 
 class QMDensityBatch:
-    def __init__(self, filename: str, index: List[str], device: torch.device, dtype: torch.dtype):
+    def __init__(
+            self, filename: str, index: List[str], device: torch.device, dtype: torch.dtype,
+            cache_size: int = QM_DENSITY_CACHE_SIZE
+    ):
+        """
+        QM Density Batch
+        ---
+        evaluates the reference densities of a batch of molecules. The HDF5 file is opened once, read-only,
+        and reopened in each process using the object (e.g. DataLoader workers). Wave functions are kept
+        on the device in a least recently used cache of at most cache_size bytes, and the keys of the
+        next batch can be loaded in the background while the current one is being used
+
+        :param filename: HDF5 file of wave functions
+        :param index: group of each index
+        :param device:
+        :param dtype:
+        :param cache_size: bytes
+        """
         self.filename = filename
         self.map_index2group = index
         self.dtype = dtype
         self.device = device
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.wfnh5 = None
+        self.pid = None
+        self.executor = None
+        self.pending = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(wfnh5=None, pid=None, executor=None, pending=None, cache=OrderedDict(), cache_bytes=0)
+        return state
+
+    def get_file(self):
+        if self.wfnh5 is None or self.pid != os.getpid():
+            load_qm = lambda cwfn: QMDensityFun(group=cwfn, dtype=self.dtype, device=self.device)
+            self.wfnh5 = WaveFunctionHDF5(self.filename, mode='r', wfn_init=load_qm)
+            self.pid = os.getpid()
+            self.executor = None
+            self.pending = None
+            self.cache.clear()
+            self.cache_bytes = 0
+        return self.wfnh5
+
+    def load(self, key: str):
+        """
+        returns the QMDensityFun of key, from the cache or from the file
+        """
+        wfnh5 = self.get_file()
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        else:
+            _, qmfun = wfnh5[key]
+            self.cache[key] = qmfun
+            self.cache_bytes += qmfun.get_size()
+        self.evict()
+        return self.cache[key]
 
-    def forward(self, index: torch.Tensor, coordinates: torch.Tensor):
+    def evict(self):
+        """
+        removes the least recently used wave functions until the cache fits in cache_size,
+        always keeping the last one
+        """
+        while self.cache_bytes > self.cache_size and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_bytes -= evicted.get_size()
+
+    def prefetch(self, index: torch.Tensor):
+        """
+        loads the wave functions of index in a background thread
+        """
+        self.wait()
+        self.get_file()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        keys = [self.map_index2group[i] for i in index.flatten().tolist()]
+        self.pending = self.executor.submit(lambda: [self.load(key) for key in keys])
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def forward(self, index: torch.Tensor, coordinates: torch.Tensor, next_index: torch.Tensor = None):
+        """
+
+        :param index: (n,) indices of the molecules
+        :param coordinates: (n, m, 3)
+        :param next_index: indices of the next batch, to prefetch
+        :return:
+        """
+        self.wait()
         index = index.split(1, dim=0)
         coordinates = coordinates.split(1, dim=0)
         out = []
-        load_qm = lambda cwfn: QMDensityFun(group=cwfn, dtype=self.dtype, device=self.device)
-        wfnh5 = WaveFunctionHDF5(self.filename, mode='r', wfn_init=load_qm)
 
         for i, x in zip(index, coordinates):
             i = i.item()
             x = x.squeeze(0)
             key = self.map_index2group[i]
-            _, qmfun = wfnh5[key]
+            qmfun = self.load(key)
             out.append(qmfun(x))
 
         out = torch.stack(out, dim=0)
-        wfnh5.close()
+        if next_index is not None:
+            self.prefetch(next_index)
         return out
+
+    def close(self):
+        self.wait()
+        self.cache.clear()
+        self.cache_bytes = 0
+        if self.wfnh5 is not None and self.pid == os.getpid():
+            self.wfnh5.close()
+        self.wfnh5 = None
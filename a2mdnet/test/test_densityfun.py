@@ -1,7 +1,7 @@
 import torch
 import time
 import os
-from a2mdnet.modules import QMDensityFun
+from a2mdnet.modules import QMDensityFun, QMDensityBatch
 from a2mdio.qm import WaveFunction, WaveFunctionHDF5
 from a2mdtest.a2mdtests import methane, benzene
 
@@ -35,6 +35,19 @@ if __name__ == '__main__':
             print("TE : {:12.6f}".format(end - start))
 
     wfnh5.close()
+
+    # batches reuse the open file and the wave functions already on the device
+    batch = QMDensityBatch('.wfn.h5py', ['benzene', 'methane'], device=device, dtype=torch.float)
+    index = torch.tensor([0, 1, 0])
+    x = torch.rand(3, 1000, 3, dtype=torch.float, device=device)
+    first = batch.forward(index, x, next_index=torch.tensor([1]))
+    second = batch.forward(index, x)
+    assert list(batch.cache.keys()) == ['methane', 'benzene']
+    assert torch.allclose(first, second)
+    batch.cache_size = 1
+    batch.forward(index[:1], x[:1])
+    assert list(batch.cache.keys()) == ['benzene']
+    batch.close()
     os.remove('.wfn.h5py')
     print("DONE!")
 
@@ -1,8 +1,10 @@
 from a2md.models import a2md_from_mol
-from a2md.integrate import integrate_density_functional
+from a2md.integrate import integrate_density_functional, BECKE_TOLERANCE
 from a2md.integrate import mse_functional, dkl_functional, vdwvolume_functional
+from a2md.integrate import get_molecular_grid, density_report
 from a2mdio.molecules import Mol2
 from a2mdio.qm import WaveFunction
+from a2mdio.cache import DensityCache
 import json
 import numpy as np
 import click
@@ -12,9 +14,13 @@ import logging
 logger = logging.getLogger('')
 
 
-def admin_sources(mm, reference, reference_type):
+def admin_sources(mm, reference, reference_type, density_cache=None, screening=None):
     if reference_type == 'wfn':
         reference_d = WaveFunction.from_file(filename=reference, program='g09', prefetch_dm=True)
+        if screening is not None:
+            reference_d.set_screening(screening)
+        if density_cache is not None:
+            reference_d = DensityCache(density_cache).bind(reference_d)
     elif reference_type == 'a2md':
         reference_d = a2md_from_mol(mm)
         with open(reference) as f:
@@ -25,6 +31,19 @@ def admin_sources(mm, reference, reference_type):
     return reference_d
 
 
+def json_finite(value):
+    """
+    replaces the non finite floats of a record by None, which json writes as null
+    """
+    if isinstance(value, dict):
+        return dict((k, json_finite(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [json_finite(v) for v in value]
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
 @click.group()
 def cli():
     """
@@ -40,12 +59,19 @@ def cli():
 @click.command()
 @click.option('--reference_type', default='wfn', help='type of reference')
 @click.option('--candidate_type', default='wfn', help='type of candidate')
-@click.option('--grid', default='coarse', help='coarse, medium or tight')
+@click.option('--grid', default='coarse', help='coarse, medium, tight or becke')
 @click.option('--resolution', default=100, help="radial resolution")
+@click.option('--grid_cache', default=None, help='folder where molecular grids are stored')
+@click.option('--tolerance', default=BECKE_TOLERANCE, help='absolute error of becke grids')
+@click.option('--density_cache', default=None, help='folder where wfn densities are stored')
+@click.option('--screening', default=None, type=float, help='screening tolerance of wfn primitives')
 @click.argument("name")
 @click.argument("reference")
 @click.argument("candidate")
-def mse(name, reference, candidate, reference_type, candidate_type, grid, resolution):
+def mse(
+        name, reference, candidate, reference_type, candidate_type, grid, resolution, grid_cache, tolerance,
+        density_cache, screening
+):
     """
 
     Integrates mean squared error
@@ -59,23 +85,30 @@ def mse(name, reference, candidate, reference_type, candidate_type, grid, resolu
     """
     start = time.time()
     mm = Mol2(name)
-    reference_d = admin_sources(mm, reference, reference_type)
-    candidate_d = admin_sources(mm, candidate, candidate_type)
+    reference_d = admin_sources(mm, reference, reference_type, density_cache, screening)
+    candidate_d = admin_sources(mm, candidate, candidate_type, density_cache, screening)
 
     msef = mse_functional(ref=reference_d.eval, fun=candidate_d.eval)
-    msev = integrate_density_functional(msef, mm, res=resolution, grid=grid)
+    msev = integrate_density_functional(msef, mm, res=resolution, grid=grid, cache=grid_cache, tolerance=tolerance)
     print("{:24s} {:24s} MSE {:18.8e} {:8.4f}".format(reference, candidate, msev, time.time() - start))
 
 
 @click.command()
 @click.option('--reference_type', default='wfn', help='type of reference')
 @click.option('--candidate_type', default='wfn', help='type of candidate')
-@click.option('--grid', default='coarse', help='coarse, medium or tight')
+@click.option('--grid', default='coarse', help='coarse, medium, tight or becke')
 @click.option('--resolution', default=100, help="radial resolution")
+@click.option('--grid_cache', default=None, help='folder where molecular grids are stored')
+@click.option('--tolerance', default=BECKE_TOLERANCE, help='absolute error of becke grids')
+@click.option('--density_cache', default=None, help='folder where wfn densities are stored')
+@click.option('--screening', default=None, type=float, help='screening tolerance of wfn primitives')
 @click.argument("name")
 @click.argument("reference")
 @click.argument("candidate")
-def dkl(name, reference, candidate, reference_type, candidate_type, grid, resolution):
+def dkl(
+        name, reference, candidate, reference_type, candidate_type, grid, resolution, grid_cache, tolerance,
+        density_cache, screening
+):
     """
 
     Integrates kullback-leibler divergence between two electron density functions
@@ -88,22 +121,28 @@ def dkl(name, reference, candidate, reference_type, candidate_type, grid, resolu
     """
     start = time.time()
     mm = Mol2(name)
-    reference_d = admin_sources(mm, reference, reference_type)
-    candidate_d = admin_sources(mm, candidate, candidate_type)
+    reference_d = admin_sources(mm, reference, reference_type, density_cache, screening)
+    candidate_d = admin_sources(mm, candidate, candidate_type, density_cache, screening)
 
     dklf = dkl_functional(ref=reference_d.eval, fun=candidate_d.eval)
-    dklv = integrate_density_functional(dklf, mm, res=resolution, grid=grid)
+    dklv = integrate_density_functional(dklf, mm, res=resolution, grid=grid, cache=grid_cache, tolerance=tolerance)
     print("{:24s} {:24s} DKL {:18.8e} {:8.4f}".format(reference, candidate, dklv, time.time() - start))
 
 
 @click.command()
 @click.option('--reference_type', default='wfn', help='wfn or a2md')
 @click.option('--epsilon', default=1e-3, help='volume surface density value')
-@click.option('--grid', default='coarse', help='coarse, medium, tight')
+@click.option('--grid', default='coarse', help='coarse, medium, tight or becke')
 @click.option('--resolution', default=100, help='radial resolution')
+@click.option('--grid_cache', default=None, help='folder where molecular grids are stored')
+@click.option('--tolerance', default=BECKE_TOLERANCE, help='absolute error of becke grids')
+@click.option('--density_cache', default=None, help='folder where wfn densities are stored')
+@click.option('--screening', default=None, type=float, help='screening tolerance of wfn primitives')
 @click.argument('name')
 @click.argument('reference')
-def volume(name, reference, reference_type, epsilon, grid, resolution):
+def volume(
+        name, reference, reference_type, epsilon, grid, resolution, grid_cache, tolerance, density_cache, screening
+):
     """
 
     Evaluates the volume enclosed by an isodensity surface
@@ -116,10 +155,10 @@ def volume(name, reference, reference_type, epsilon, grid, resolution):
     """
     start = time.time()
     mm = Mol2(name)
-    reference_d = admin_sources(mm, reference, reference_type)
+    reference_d = admin_sources(mm, reference, reference_type, density_cache, screening)
     volf = vdwvolume_functional(reference_d.eval, eps=epsilon)
 
-    vol = integrate_density_functional(volf, mm, res=resolution, grid=grid)
+    vol = integrate_density_functional(volf, mm, res=resolution, grid=grid, cache=grid_cache, tolerance=tolerance)
     print("{:24s} VOL(au) {:18.8e} {:8.4f}".format(reference, vol, time.time() - start))
 
 
@@ -127,11 +166,15 @@ def volume(name, reference, reference_type, epsilon, grid, resolution):
 @click.option('--reference_type', default='wfn', help='wfn or a2md')
 @click.option('--candidate_type', default='wfn', help='wfn or a2md')
 @click.option('--metric', default='mse', help='rmse, mse or mlse')
+@click.option('--density_cache', default=None, help='folder where wfn densities are stored')
+@click.option('--screening', default=None, type=float, help='screening tolerance of wfn primitives')
 @click.argument('name')
 @click.argument('reference')
 @click.argument('candidate')
 @click.argument('coordinates')
-def compare_sample(name, reference, candidate, coordinates, metric, reference_type, candidate_type):
+def compare_sample(
+        name, reference, candidate, coordinates, metric, reference_type, candidate_type, density_cache, screening
+):
     """
 
     Compares a given metric (MSE, MLSE, RMSE) between two EDs in a set of coordinates
@@ -159,8 +202,8 @@ def compare_sample(name, reference, candidate, coordinates, metric, reference_ty
 
     coordinates = np.loadtxt(coordinates)
 
-    reference_d = admin_sources(mm, reference, reference_type)
-    candidate_d = admin_sources(mm, candidate, candidate_type)
+    reference_d = admin_sources(mm, reference, reference_type, density_cache, screening)
+    candidate_d = admin_sources(mm, candidate, candidate_type, density_cache, screening)
     reference_p = reference_d.eval(coordinates)
     candidate_p = candidate_d.eval(coordinates)
 
@@ -168,10 +211,70 @@ def compare_sample(name, reference, candidate, coordinates, metric, reference_ty
     print("{:24s} {:24s} SAMPLE-{:s} {:18.8e} {:8.4f}".format(reference, candidate, metric, value, time.time() - start))
 
 
+@click.command()
+@click.option('--reference_type', default='wfn', help='type of reference')
+@click.option('--candidate_type', default='a2md', help='type of candidate')
+@click.option('--epsilon', default=1e-3, help='volume surface density value')
+@click.option('--grid', default='coarse', help='coarse, medium, tight or becke')
+@click.option('--resolution', default=100, help="radial resolution")
+@click.option('--grid_cache', default=None, help='folder where molecular grids are stored')
+@click.option('--tolerance', default=BECKE_TOLERANCE, help='absolute error of becke grids')
+@click.option('--density_cache', default=None, help='folder where wfn densities are stored')
+@click.option('--screening', default=None, type=float, help='screening tolerance of wfn primitives')
+@click.option('--output', default=None, help='json file for the report. Default: standard output')
+@click.argument('names_file')
+def report(
+        names_file, reference_type, candidate_type, epsilon, grid, resolution, grid_cache, tolerance, density_cache,
+        screening, output
+):
+    """
+
+    Compares pairs of electron densities, evaluating each one once on the molecular grid. MSE, MLSE,
+    DKL, volumes, kinetic and exchange energies, charges and absolute errors are reported for each
+    molecule and for each of its atoms
+
+    The names file is a json list of entries with name, reference and candidate keys. Entries may set
+    their own reference_type and candidate_type
+
+    Example:
+
+        report --reference_type=wfn --candidate_type=a2md --grid=becke --output=report.json names.json
+
+
+    """
+    with open(names_file) as f:
+        names = json.load(f)
+    records = []
+    for entry in names:
+        start = time.time()
+        mm = Mol2(entry['name'])
+        reference_d = admin_sources(
+            mm, entry['reference'], entry.get('reference_type', reference_type), density_cache, screening
+        )
+        candidate_d = admin_sources(
+            mm, entry['candidate'], entry.get('candidate_type', candidate_type), density_cache, screening
+        )
+        mg = get_molecular_grid(mm, grid=grid, res=resolution, cache=grid_cache, tolerance=tolerance)
+        record = dict(name=entry['name'], reference=entry['reference'], candidate=entry['candidate'])
+        record.update(density_report(mg, reference_d.eval, candidate_d.eval, eps=epsilon))
+        record['points'] = mg.get_number_points()
+        record['time'] = time.time() - start
+        records.append(record)
+        logger.info("{:24s} {:24s} REPORT {:8.4f}".format(entry['reference'], entry['candidate'], record['time']))
+
+    records = json_finite(records)
+    if output is None:
+        print(json.dumps(records, indent=4, allow_nan=False))
+    else:
+        with open(output, 'w') as f:
+            json.dump(records, f, indent=4, allow_nan=False)
+
+
 cli.add_command(mse)
 cli.add_command(dkl)
 cli.add_command(volume)
 cli.add_command(compare_sample)
+cli.add_command(report)
 
 if __name__ == '__main__':
     cli()
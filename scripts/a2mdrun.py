@@ -1,11 +1,14 @@
-from a2md.models import a2md_from_mol
+from a2md.models import a2md_from_mol, VOLUME_BLOCK_SIZE
 from a2md import utils
 from a2mdio.molecules import Mol2
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import json
 import click
 import time
 import sys
+import os
+import hashlib
 import logging
 
 logger = logging.getLogger('')
@@ -23,13 +26,17 @@ def cli():
 
 
 @click.command()
-@click.option('--output', default=None, help='file to save the info')
+@click.option('--output', default=None, help='file to save the volume, either .dx or binary .npz/.h5')
 @click.option('--expand', default=2.0, help='file to save the info')
 @click.option('--res', default=0.25, help='file to save the info')
 @click.option('--kind', default='density', help='either density or ep')
+@click.option('--workers', default=1, help='number of threads evaluating the grid')
+@click.option('--block_size', default=VOLUME_BLOCK_SIZE, help='maximum number of grid points evaluated at once')
+@click.option('--ep_tolerance', default=None, type=float, help='relative error of the tabulated ep radial terms')
+@click.option('--multipole_theta', default=None, type=float, help='opening criterion of the far-field ep multipoles')
 @click.argument('name')
 @click.argument('param_file')
-def write_dx(name, param_file, output, expand, res, kind):
+def write_dx(name, param_file, output, expand, res, kind, workers, block_size, ep_tolerance, multipole_theta):
     """
     writes a dx volumetric file. This type of file can be used to 3d-visualize electron density using
     software as chimera, PyMol or VMD
@@ -47,8 +54,10 @@ def write_dx(name, param_file, output, expand, res, kind):
     dm.parametrize()
     with open(param_file) as f:
         dm.read(json.load(f))
+    dm.set_ep_tolerance(ep_tolerance)
+    dm.set_multipole_theta(multipole_theta)
 
-    dx = dm.eval_volume(spacing=expand, resolution=res, kind=kind)
+    dx = dm.eval_volume(spacing=expand, resolution=res, kind=kind, block_size=block_size, workers=workers)
     if output is None:
         dx.write(name.replace('.mol2', '') + '.dx')
     else:
@@ -114,22 +123,43 @@ def evaluate(name, param_file, coordinates, output):
 @click.option('--scheme', default='default', help='either default, harmonic, extended, spheric')
 @click.option('--regularization_constant', default=None, help='defines penalty on coefficient norm', type=float)
 @click.option('--output', default=None, help="file where to store the output parameters")
-@click.option('--cluster', default=None, help="use rbf to clusterize by distance signature")  # to modify in the future
+@click.option('--cluster', default=None, help="either rbf (distance signature) or graph (topology)")
+@click.option('--memory_budget', default=None, help="size (MB) of the design matrix chunks", type=float)
 @click.option('--verbose', default=0, help="0 for no output, 1 for error, 2 for info")
 @click.argument('name')
-@click.argument('sample')
-def fit(name, sample, opt_mode, scheme, regularization_constant, output, cluster, verbose):
+@click.argument('sample', nargs=-1, required=True)
+def fit(name, sample, opt_mode, scheme, regularization_constant, output, cluster, memory_budget, verbose):
     """
-    Fits a linear density model to a density sa
-
-
+    Fits a linear density model to a density sample. The sample may be split
+    in several npy/csv files (shards). npy files are memory-mapped, so samples
+    larger than memory can be fitted using --memory_budget
+    """
+    __fit_call(name, list(sample), opt_mode, scheme, regularization_constant, output, cluster, verbose, memory_budget)
 
 
+def __read_sample(sample):
     """
-    __fit_call(name, sample, opt_mode, scheme, regularization_constant, output, cluster, verbose)
+    reads a sample file. npy files are memory-mapped instead of read, csv files
+    are read into memory
+    """
+    try:
+        logger.info("reading sample file as npy")
+        return np.load(sample, mmap_mode='r')
+    except FileNotFoundError:
+        logger.error("could not find the {:s} file".format(sample))
+        sys.exit(1)
+    except (OSError, ValueError):
+        try:
+            logger.info("reading npy was unsuccesful. Trying csv")
+            return np.loadtxt(sample)
+        except ValueError:
+            logger.error("could not read sample file neither as npy nor csv")
+            sys.exit(1)
 
 
-def __fit_call(name, sample, opt_mode, scheme, regularization_constant, output, cluster, verbose):
+def __fit_call(
+        name, sample, opt_mode, scheme, regularization_constant, output, cluster, verbose, memory_budget=None
+):
     """
     ajusts the parameters of a density model to a sample of electron density
     """
@@ -141,24 +171,12 @@ def __fit_call(name, sample, opt_mode, scheme, regularization_constant, output,
         logging.basicConfig(level=logging.INFO)
 
     start = time.time()
-    logger.info("reading inputs {:s} {:s} ".format(name, sample))
+    logger.info("reading inputs {:s} {:s} ".format(name, str(sample)))
     mm = Mol2(name)
-    sample_file = sample
-    try:
-        logger.info("reading sample file as npy")
-        sample = np.load(sample)
-    except FileNotFoundError:
-        logger.error("could not find the {:s} file".format(sample))
-    except OSError:
-        try:
-            logger.info("reading npy was unsuccesful. Trying csv")
-            sample = np.loadtxt(sample)
-        except ValueError:
-            logger.error("could not read sample file neither as npy nor csv")
-            sys.exit()
-    except ValueError:
-        logger.info("reading npy was unsuccesful. Trying csv")
-        sample = np.loadtxt(sample)
+    if isinstance(sample, str):
+        sample = [sample]
+    sample_file = ",".join(sample)
+    sample = [__read_sample(s) for s in sample]
 
     logger.info("reading of mol2 and sample file was succesful")
     logger.info("defining model")
@@ -186,6 +204,10 @@ def __fit_call(name, sample, opt_mode, scheme, regularization_constant, output,
             logger.info("radial basis functions are used as symmetry function")
             rbf = utils.RBFSymmetryCluster(verbose=False)
             dm.clustering(rbf.cluster)
+        elif cluster == 'graph':
+            logger.info("graph hashing of elements and bonds is used as symmetry function")
+            graph = utils.GraphHashCluster(verbose=False)
+            dm.clustering(graph.cluster)
         else:
             logger.error("no found cluster method {:s}. Aborting".format(cluster))
             sys.exit(1)
@@ -195,7 +217,12 @@ def __fit_call(name, sample, opt_mode, scheme, regularization_constant, output,
         dm.set_regularization_constant(regularization_constant)
 
     logger.info("starting optimization, using a opt_mode={:s}".format(opt_mode))
-    dm.optimize(sample[:, :3], sample[:, 3], optimization_mode=opt_mode)
+    if memory_budget is not None:
+        memory_budget = int(memory_budget * 1024 * 1024)
+    dm.optimize(
+        [s[:, :3] for s in sample], [s[:, 3] for s in sample],
+        optimization_mode=opt_mode, memory_budget=memory_budget
+    )
     logger.info("finished optimization")
 
     if output is None:
@@ -212,32 +239,183 @@ def __fit_call(name, sample, opt_mode, scheme, regularization_constant, output,
     print("FIT NAME:{:s} SAMPLE:{:s} MODE:{:s}, TE:{:12.4f}".format(name, sample_file, opt_mode, time.time() - start))
 
 
+def __file_checksum(file_name, block_size=2 ** 20):
+    """
+    sha256 of a file, read in blocks
+    """
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def __read_manifest(manifest):
+    """
+    reads a fit-many manifest (json lines) and returns the last record of each output file
+    """
+    records = dict()
+    if not os.path.exists(manifest):
+        return records
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['output']] = record
+    return records
+
+
+def __fit_many_task(entry, options, log_file, previous=None):
+    """
+    fits a single entry of fit-many, logging to its own file. When a previous record is supplied,
+    the fit is skipped if the output exists and both input checksums and options match
+    """
+    task_start = time.time()
+    samples = entry['sample'] if isinstance(entry['sample'], list) else [entry['sample']]
+    record = dict(
+        mol2=entry['mol2'], sample=entry['sample'], output=entry['output'], log=log_file,
+        options=options, worker=os.getpid(), status='failed'
+    )
+    try:
+        record['checksums'] = {name: __file_checksum(name) for name in [entry['mol2']] + samples}
+    except IOError as e:
+        record['error'] = str(e)
+        record['time'] = time.time() - task_start
+        return record
+
+    if previous is not None and previous.get('status') in ('done', 'skipped') and os.path.exists(entry['output']) and \
+            previous.get('checksums') == record['checksums'] and previous.get('options') == options:
+        record['status'] = 'skipped'
+        record['time'] = time.time() - task_start
+        return record
+
+    verbose = options['verbose']
+    if verbose == 0:
+        level = logging.CRITICAL
+    elif verbose == 1:
+        level = logging.ERROR
+    else:
+        level = logging.INFO
+    # the task only changes the logging setup while it runs, as it may run in the cli process (one worker)
+    previous_level = logger.level
+    previous_handlers = [(handler, handler.level) for handler in logger.handlers]
+    console_handler = None
+    if not previous_handlers:
+        console_handler = logging.StreamHandler()
+        logger.addHandler(console_handler)
+    for handler in logger.handlers:
+        handler.setLevel(level)
+    file_handler = logging.FileHandler(log_file, mode='w')
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(file_handler)
+    try:
+        __fit_call(
+            entry['mol2'], samples, opt_mode=options['opt_mode'],
+            regularization_constant=options['regularization_constant'], output=entry['output'],
+            cluster=options['cluster'], verbose=verbose, scheme=options['scheme'],
+            memory_budget=options['memory_budget']
+        )
+        record['status'] = 'done'
+    except SystemExit:
+        record['error'] = "fit aborted, see {:s}".format(log_file)
+    except Exception as e:
+        logger.exception("fit failed")
+        record['error'] = "{:s}: {:s}".format(type(e).__name__, str(e))
+    finally:
+        logger.removeHandler(file_handler)
+        file_handler.close()
+        if console_handler is not None:
+            logger.removeHandler(console_handler)
+        for handler, handler_level in previous_handlers:
+            handler.setLevel(handler_level)
+        logger.setLevel(previous_level)
+    record['time'] = time.time() - task_start
+    return record
+
+
 @click.command()
 @click.option('--opt_mode', default='restricted', help='either restricted, unrestricted or semirestricted')
 @click.option('--regularization_constant', default=None, help='defines penalty on coefficient norm', type=float)
 @click.option('--scheme', default='default', help='either default, harmonic, extended, spheric')
-@click.option('--cluster', default=None, help="use rbf to clusterize by distance signature")  # to modify in the future
+@click.option('--cluster', default=None, help="either rbf (distance signature) or graph (topology)")
+@click.option('--memory_budget', default=None, help="size (MB) of the design matrix chunks", type=float)
+@click.option('--workers', default=1, help="number of worker processes")
+@click.option('--manifest', default=None, help="progress file (json lines). Default: names file with .manifest extension")
+@click.option('--log_path', default=None, help="path for the per molecule log files. Default: next to the outputs")
+@click.option('--resume', is_flag=True, help="skip the entries already fitted with the same inputs and options")
 @click.option('--verbose', default=0, help="0 for no output, 1 for error, 2 for info")
 @click.argument('names_file')
-def fit_many(names_file, opt_mode, regularization_constant, scheme, cluster, verbose):
+def fit_many(
+        names_file, opt_mode, regularization_constant, scheme, cluster, memory_budget, workers,
+        manifest, log_path, resume, verbose
+):
     """
-    fits many compounds
+    fits many compounds. Each sample entry may be either a file or a list of files (shards).
+    Entries are distributed among a pool of worker processes, each one logging to its own file.
+    Progress is appended to a manifest, which allows to resume interrupted runs
     """
     with open(names_file) as f:
         names = json.load(f)
-    mol2_ = [i['mol2'] for i in names]
-    out_ = [i['output'] for i in names]
-    sample_ = [i['sample'] for i in names]
-    n = len(mol2_)
+    if manifest is None:
+        manifest = os.path.splitext(names_file)[0] + '.manifest'
+    options = dict(
+        opt_mode=opt_mode, regularization_constant=regularization_constant, scheme=scheme,
+        cluster=cluster, memory_budget=memory_budget, verbose=verbose
+    )
+    previous = __read_manifest(manifest) if resume else dict()
+
+    tasks = []
+    for entry in names:
+        log_file = os.path.splitext(entry['output'])[0] + '.log'
+        if log_path is not None:
+            log_file = os.path.join(log_path, os.path.basename(log_file))
+        tasks.append((entry, options, log_file, previous.get(entry['output'])))
+
     global_start = time.time()
-    for i, (m, s, o) in enumerate(zip(mol2_, sample_, out_)):
-        __fit_call(
-            m, s, opt_mode=opt_mode, regularization_constant=regularization_constant, output=o,
-            cluster=cluster, verbose=verbose, scheme=scheme
-        )
+    records = []
+    with open(manifest, 'a') as f:
+        def register(record):
+            records.append(record)
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(__fit_many_task, *task) for task in tasks]
+                for future in as_completed(futures):
+                    register(future.result())
+        else:
+            for task in tasks:
+                register(__fit_many_task(*task))
     global_end = time.time()
     time_elapsed = global_end - global_start
-    print("FIT_MANY, {:8d} molecules, TE={:8.4f} s, TEPM={:8.4f} s/mol".format(n, time_elapsed, time_elapsed / n))
+
+    done = [r for r in records if r['status'] == 'done']
+    n = len(done)
+    n_skipped = sum(1 for r in records if r['status'] == 'skipped')
+    n_failed = len(records) - n - n_skipped
+    worker_stats = dict()
+    for r in done:
+        count, busy = worker_stats.get(r['worker'], (0, 0.0))
+        worker_stats[r['worker']] = (count + 1, busy + r['time'])
+
+    print("FIT_MANY, {:8d} molecules, TE={:8.4f} s, TEPM={:8.4f} s/mol, SKIPPED={:d}, FAILED={:d}, WORKERS={:d}".format(
+        n, time_elapsed, time_elapsed / max(n, 1), n_skipped, n_failed, workers
+    ))
+    for r in records:
+        if r['status'] == 'failed':
+            print("FAILED {:s} : {:s}".format(r['output'], r.get('error', '')))
+    for worker, (count, busy) in sorted(worker_stats.items()):
+        print("WORKER {:8d}, {:8d} molecules, TE={:8.4f} s, TEPM={:8.4f} s/mol, {:8.4f} mol/s".format(
+            worker, count, busy, busy / count, count / max(busy, 1e-12)
+        ))
 
 
 @click.command()
@@ -92,7 +92,7 @@ def __update_mol2(name, wfn, gaussian_log, output, charges):
     mm.write(output)
 
 
-def __update_many_mol2(inp, suffix, wfn_suffix, g09_suffix, input_type, charges):
+def __update_many_mol2(inp, suffix, wfn_suffix, g09_suffix, input_type, charges, workers=1):
     """
     updates many mol2 files at the same time
     """
@@ -108,17 +108,18 @@ def __update_many_mol2(inp, suffix, wfn_suffix, g09_suffix, input_type, charges)
         print("unknown format. use either csv or json")
         sys.exit()
 
-    for i, name in enumerate(input_contents):
+    # each log is read once, and the logs are spread over the workers
+    logs = GaussianLog.read_many(
+        [name + g09_suffix for name in input_contents], method='', charges=charges, workers=workers
+    )
+    for name, gdict in zip(input_contents, logs):
         mm = Mol2(name + '.mol2')
         wfn = name + wfn_suffix
-        gaussian_log = name + g09_suffix
         wfn_instance = WaveFunction.from_file(filename=wfn, program='g09', prefetch_dm=False)
-        glog = GaussianLog(file=gaussian_log, method='', charges=charges, verbose=False)
         mm.coordinates = wfn_instance.get_coordinates() * UNITS_TABLE['au']['angstrom']
-        try:
-            gdict = glog.read()
+        if gdict['charges'] is not None:
             mm.charges = np.array(gdict['charges'], dtype='float64')
-        except RuntimeError:
+        else:
             print('error : cant read file {:s}'.format(name + g09_suffix))
             print('-- skipping charges for {:s}'.format(name + '.mol2'))
         mm.write(name + suffix)
@@ -202,9 +203,8 @@ def __rename_mol2_as(name, out, reference):
 
 
 def __store_wfn(name, out, save_dm, save_coeff, program):
-    wfn = WaveFunction.from_file(name, program=program)
     f = WaveFunctionHDF5(out, mode='w-')
-    f.add(name.replace('.g09', ''), wfn, save_dm=save_dm, save_coeff=save_coeff)
+    f.add_file(name.replace('.g09', ''), name, program=program, save_dm=save_dm, save_coeff=save_coeff)
     f.close()
 
 
@@ -216,9 +216,16 @@ def __many_store_wfn(name, out, save_dm, save_coeff, program):
 
     for wfn_name in contents:
         print(".. {:s}".format(wfn_name))
-        wfn = WaveFunction.from_file(wfn_name, program=program)
-        g.add(wfn_name.replace('.wfn', ''), wfn, save_dm=save_dm, save_coeff=save_coeff)
-    f.close()
+        g.add_file(wfn_name.replace('.wfn', ''), wfn_name, program=program, save_dm=save_dm, save_coeff=save_coeff)
+    g.close()
+
+
+def __write_wfn_dx(name, output, expand, res, program, screening):
+    wfn = WaveFunction.from_file(name, program=program, prefetch_dm=False)
+    if screening is not None:
+        wfn.set_screening(screening)
+    dx = wfn.eval_volume(spacing=expand, resolution=res)
+    dx.write(output)
 
 
 @click.group()
@@ -330,10 +337,11 @@ def update_mol2(name, wfn, gaussian_log, output, charges):
 @click.command()
 @click.option('--charges', default='npa', help='either MK or NPA')
 @click.option('--suffix', default='.n.mol2', help='updated files will have name + suffix')
+@click.option('--workers', default=1, help='number of processes reading the gaussian outputs')
 @click.argument('name')
 @click.argument('wfn_suffix')
 @click.argument('g09_suffix')
-def many_update_mol2(name, wfn_suffix, g09_suffix, charges, suffix):
+def many_update_mol2(name, wfn_suffix, g09_suffix, charges, suffix, workers):
     """
 
     Generates new mol2 files by including charge information from Gaussian09 outputs and from
@@ -350,7 +358,7 @@ def many_update_mol2(name, wfn_suffix, g09_suffix, charges, suffix):
         name, suffix,
         wfn_suffix=wfn_suffix,
         g09_suffix=g09_suffix, input_type='txt',
-        charges=charges
+        charges=charges, workers=workers
     )
 
 
@@ -503,6 +511,26 @@ def many_compile_wfn(name, out, save_dm, save_coeff, program):
     __many_store_wfn(name, out, save_dm, save_coeff, program)
 
 
+@click.command()
+@click.option('--expand', default=4.0, help='amount of space around the molecule (Bohr)')
+@click.option('--res', default=0.25, help='resolution of the grid (Bohr)')
+@click.option('--program', default='g09', help='either orca or g09')
+@click.option('--screening', default=None, type=float, help='screening tolerance of the primitives')
+@click.argument('name')
+@click.argument('output')
+def write_wfn_dx(name, output, expand, res, program, screening):
+    """
+
+    Writes the electron density of a wavefunction as a dx volumetric file, to compare with
+    the maps of a2mdrun write-dx
+
+    Example:
+        write-wfn-dx --expand=3.0 --res=0.25 --screening=1e-12 benzene.wfn benzene.wfn.dx
+
+    """
+    __write_wfn_dx(name, output, expand, res, program, screening)
+
+
 cli.add_command(prepare_qm)
 cli.add_command(update_mol2)
 cli.add_command(convert_sample)
@@ -511,6 +539,7 @@ cli.add_command(extract_forces)
 cli.add_command(random_rotation)
 cli.add_command(relabel_mol2)
 cli.add_command(compile_wfn)
+cli.add_command(write_wfn_dx)
 
 cli.add_command(many_prepare_qm)
 cli.add_command(many_update_mol2)